@@ -1,11 +1,32 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
-import google.generativeai as genai
-import boto3
 import json
 import requests
+import threading
+import hashlib
+import sqlite3
+import time
+import uuid
+import traceback
+import ast
+import math
+import re
+import queue
+import fnmatch
+import posixpath
+import random
+import subprocess
+import shutil
+import tempfile
+from urllib.parse import urlparse, unquote
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 
 # Load environment variables from .env file
 load_dotenv()
@@ -13,95 +34,2745 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)  # Enable CORS for frontend requests
 
-# Configure Gemini API
+# Upstream configuration. Nothing is validated or connected at import time:
+# the Gemini model and the SageMaker client are created on first use in
+# each process (see get_gemini_model / get_sagemaker_client), so the module
+# imports quickly, works in tests and forks cleanly under a multi-worker
+# server. Missing settings are reported by /health and by the requests
+# that need them.
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-
-if not GEMINI_API_KEY:
-    print("ERROR: GEMINI_API_KEY not found in environment variables!")
-    print("Please set it with: export GEMINI_API_KEY='your_key_here'")
-    exit(1)
-else:
-    genai.configure(api_key=GEMINI_API_KEY)
-    # Use a fast, free model
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    print(f"✓ Gemini API configured with model: gemini-2.5-flash")
+# Use a fast, free model
+GEMINI_MODEL_NAME = os.environ.get('GEMINI_MODEL_NAME', 'gemini-2.5-flash')
 
 # Configure AWS SageMaker for Trainium
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 AWS_SESSION_TOKEN = os.environ.get('AWS_SESSION_TOKEN')
 AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION')
-
-if not all([AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN, AWS_DEFAULT_REGION]):
-    print("ERROR: Missing AWS credentials in environment variables!")
-    print("Required: AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN, AWS_DEFAULT_REGION")
-    exit(1)
-
-sagemaker_client = boto3.client(
-    'sagemaker-runtime',
-    region_name=AWS_DEFAULT_REGION,
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    aws_session_token=AWS_SESSION_TOKEN
-)
 TRAINIUM_ENDPOINT = os.environ.get('TRAINIUM_ENDPOINT')
 
-if not TRAINIUM_ENDPOINT:
-    print("ERROR: TRAINIUM_ENDPOINT not found in environment variables!")
-    print("Please set it with: export TRAINIUM_ENDPOINT='your_endpoint_name'")
-    exit(1)
-print(f"✓ SageMaker configured for endpoint: {TRAINIUM_ENDPOINT}")
+# Per-attempt deadline for Trainium calls; retries are done by the upstream
+# layer below, so botocore's own retries are turned off
+TRAINIUM_TIMEOUT = float(os.environ.get('TRAINIUM_TIMEOUT', '60'))
+
+class ConfigError(Exception):
+    """A required setting for an upstream is missing."""
+
+def gemini_config_error():
+    """Why Gemini cannot be used, or None if it is configured."""
+    if not GEMINI_API_KEY:
+        return "GEMINI_API_KEY not configured"
+    return None
+
+def trainium_config_error():
+    """Why the Trainium endpoint cannot be used, or None if it is configured."""
+    missing = [name for name, value in [('AWS_ACCESS_KEY_ID', AWS_ACCESS_KEY_ID),
+                                        ('AWS_SECRET_ACCESS_KEY', AWS_SECRET_ACCESS_KEY),
+                                        ('AWS_SESSION_TOKEN', AWS_SESSION_TOKEN),
+                                        ('AWS_DEFAULT_REGION', AWS_DEFAULT_REGION),
+                                        ('TRAINIUM_ENDPOINT', TRAINIUM_ENDPOINT)] if not value]
+    if missing:
+        return f"{', '.join(missing)} not configured"
+    return None
 
-def document_github_repo_raw(url, branch="main", include_exts=None, token=None, max_file_size=200000):
+# Process-local clients; assign fakes to these to run offline
+model = None
+sagemaker_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def _check_client_pid():
+    """Drop clients inherited from a parent process (lock held); they are rebuilt on first use."""
+    global model, sagemaker_client, _client_pid
+    if _client_pid is not None and _client_pid != os.getpid():
+        model = sagemaker_client = None
+    _client_pid = os.getpid()
+
+def get_gemini_model():
+    """The process's Gemini model, created on first use. Raises ConfigError if unconfigured."""
+    global model
+    with _client_lock:
+        _check_client_pid()
+        if model is None:
+            error = gemini_config_error()
+            if error:
+                raise ConfigError(error)
+            # Imported here: google.generativeai takes most of a second to import
+            import google.generativeai as genai
+            genai.configure(api_key=GEMINI_API_KEY)
+            model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+            print(f"✓ Gemini API configured with model: {GEMINI_MODEL_NAME}")
+        return model
+
+def get_sagemaker_client():
+    """The process's sagemaker-runtime client, created on first use. Raises ConfigError if unconfigured."""
+    global sagemaker_client
+    with _client_lock:
+        _check_client_pid()
+        if sagemaker_client is None:
+            error = trainium_config_error()
+            if error:
+                raise ConfigError(error)
+            import boto3
+            from botocore.config import Config
+            sagemaker_client = boto3.client(
+                'sagemaker-runtime',
+                region_name=AWS_DEFAULT_REGION,
+                aws_access_key_id=AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                aws_session_token=AWS_SESSION_TOKEN,
+                config=Config(connect_timeout=10, read_timeout=TRAINIUM_TIMEOUT, retries={'max_attempts': 0})
+            )
+            print(f"✓ SageMaker configured for endpoint: {TRAINIUM_ENDPOINT}")
+        return sagemaker_client
+
+class Metrics:
     """
-    Use git tree API to list files (one API request), then fetch content from
-    raw.githubusercontent.com for each file (avoids per-file GitHub API requests).
+    Thread-safe counters and latency histograms for the pipeline stages,
+    rendered in the Prometheus text exposition format at /metrics.
+    Collectors registered with add_collector() contribute gauges computed
+    at scrape time (cache and queue sizes).
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, prefix="backend"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}  # name -> {labels: value}
+        self._histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Time a pipeline stage; failures also count towards stage_errors_total."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("stage_duration_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+    def summary(self):
+        """Count, total and mean of every histogram series, keyed by name then labels."""
+        with self._lock:
+            return {
+                name: {
+                    ",".join(f"{k}={v}" for k, v in key) or "all": {
+                        'count': state[-1],
+                        'sum': state[-2],
+                        'mean': state[-2] / state[-1] if state[-1] else 0.0
+                    }
+                    for key, state in series.items()
+                }
+                for name, series in self._histograms.items()
+            }
+
+    def add_collector(self, collector):
+        """collector() returns (name, kind, help, labels, value) tuples."""
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {k: list(v) for k, v in series.items()} for name, series in self._histograms.items()}
+        for name, series in sorted(counters.items()):
+            full = f"{self.prefix}_{name}"
+            kind, help_text = self._help.get(name, ("counter", name))
+            lines += [f"# HELP {full} {help_text}", f"# TYPE {full} {kind}"]
+            for key, value in sorted(series.items()):
+                lines.append(f"{full}{self._labels(key)} {value}")
+        for name, series in sorted(histograms.items()):
+            full = f"{self.prefix}_{name}"
+            _, help_text = self._help.get(name, ("histogram", name))
+            lines += [f"# HELP {full} {help_text}", f"# TYPE {full} histogram"]
+            for key, state in sorted(series.items()):
+                for bound, count in zip(self.BUCKETS, state):
+                    lines.append(f"{full}_bucket{self._labels(key, [('le', bound)])} {count}")
+                lines.append(f"{full}_bucket{self._labels(key, [('le', '+Inf')])} {state[-1]}")
+                lines.append(f"{full}_sum{self._labels(key)} {state[-2]}")
+                lines.append(f"{full}_count{self._labels(key)} {state[-1]}")
+        gauges = {}
+        for collector in self._collectors:
+            for name, kind, help_text, labels, value in collector():
+                gauges.setdefault((name, kind, help_text), []).append((tuple(sorted(labels.items())), value))
+        for (name, kind, help_text), series in sorted(gauges.items()):
+            full = f"{self.prefix}_{name}"
+            lines += [f"# HELP {full} {help_text}", f"# TYPE {full} {kind}"]
+            for key, value in series:
+                lines.append(f"{full}{self._labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("stage_duration_seconds", "histogram",
+                 "Latency of pipeline stages (github_repo, github_tree, github_raw, github_archive, packing, trainium_invoke, "
+                 "gemini_generate)")
+metrics.describe("stage_errors_total", "counter", "Failed pipeline stage calls")
+metrics.describe("fetched_files_total", "counter", "Files ingested, by source (network, cache, archive)")
+metrics.describe("fetched_bytes_total", "counter", "Bytes of file content ingested, by source")
+metrics.describe("trainium_prompt_chars_total", "counter", "Characters sent to the Trainium endpoint")
+metrics.describe("planner_skipped_files_total", "counter", "Files skipped before download, by reason")
+metrics.describe("incremental_reuse_total", "counter", "Analyses answered from a stored snapshot, by level (tree, context)")
+metrics.describe("coalesced_requests_total", "counter",
+                 "Requests that shared an identical in-flight analysis or diagram call, by kind")
+metrics.describe("analysis_fallbacks_total", "counter",
+                 "Analyses answered with a fallback diagram after a model failure or for lack of time")
+metrics.describe("analysis_routes_total", "counter",
+                 "Model analyses by path the latency router chose (full, direct, cached, static)")
+metrics.describe("mermaid_outputs_total", "counter",
+                 "Generated diagrams by outcome (valid, repaired, model_fixed, invalid)")
+metrics.describe("upstream_retries_total", "counter", "Retried upstream calls, by service")
+metrics.describe("upstream_hedges_total", "counter", "Hedged (duplicate) upstream attempts, by service")
+metrics.describe("upstream_short_circuited_total", "counter", "Upstream calls refused by an open circuit breaker")
+metrics.describe("upstream_circuit_opened_total", "counter", "Times an upstream circuit breaker opened")
+metrics.describe("batch_repos_total", "counter", "Repositories analyzed by /analyze-batch, by status")
+metrics.describe("github_paced_requests_total", "counter", "GitHub API requests delayed to stay within the rate limit")
+metrics.describe("github_conditional_requests_total", "counter",
+                 "GitHub API answers with an ETag, by outcome (not_modified, modified, new)")
+
+# GitHub fetch tuning: number of concurrent raw downloads per repo and the
+# maximum number of pooled keep-alive connections per host
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', '16'))
+FETCH_MAX_PER_HOST = int(os.environ.get('FETCH_MAX_PER_HOST', '16'))
+
+# GitHub endpoints (overridable for GitHub Enterprise or local stand-ins)
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+GITHUB_RAW_URL = os.environ.get('GITHUB_RAW_URL', 'https://raw.githubusercontent.com').rstrip('/')
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """
+    Return the process-wide requests.Session used for GitHub traffic.
+    Connections are kept alive and pooled, with at most FETCH_MAX_PER_HOST
+    open connections per host (extra requests wait for a free connection).
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=FETCH_MAX_PER_HOST, pool_block=True)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+# Upstream call policy. Each service gets a per-attempt deadline, a number
+# of jittered retries and an optional hedge delay (0 disables hedging);
+# CIRCUIT_FAILURE_THRESHOLD consecutive failures open its circuit breaker
+# for CIRCUIT_RESET_SECONDS.
+GITHUB_TIMEOUT = float(os.environ.get('GITHUB_TIMEOUT', '10'))
+GITHUB_RETRIES = int(os.environ.get('GITHUB_RETRIES', '3'))
+GITHUB_MAX_RETRY_WAIT = float(os.environ.get('GITHUB_MAX_RETRY_WAIT', '30'))
+TRAINIUM_RETRIES = int(os.environ.get('TRAINIUM_RETRIES', '2'))
+TRAINIUM_HEDGE_AFTER_MS = float(os.environ.get('TRAINIUM_HEDGE_AFTER_MS', '0'))
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', '60'))
+GEMINI_RETRIES = int(os.environ.get('GEMINI_RETRIES', '2'))
+GEMINI_HEDGE_AFTER_MS = float(os.environ.get('GEMINI_HEDGE_AFTER_MS', '0'))
+UPSTREAM_BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', '0.5'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', '30'))
+# Latency assumed for a model call until real calls have been measured
+TRAINIUM_LATENCY_PRIOR_MS = float(os.environ.get('TRAINIUM_LATENCY_PRIOR_MS', '5000'))
+GEMINI_LATENCY_PRIOR_MS = float(os.environ.get('GEMINI_LATENCY_PRIOR_MS', '8000'))
+
+class UpstreamTimeout(Exception):
+    """An upstream call did not answer within its deadline."""
+
+class CircuitOpenError(Exception):
+    """The upstream's circuit breaker is open; the call was not attempted."""
+
+RETRYABLE_ERROR_CODES = {"Throttling", "ThrottlingException", "TooManyRequestsException",
+                         "ServiceUnavailable", "ServiceUnavailableException", "InternalFailure",
+                         "ModelNotReadyException", "RequestTimeout", "RequestTimeoutException"}
+RETRYABLE_ERROR_NAMES = {"EndpointConnectionError", "ConnectTimeoutError", "ReadTimeoutError",
+                         "ConnectionClosedError", "ResourceExhausted", "ServiceUnavailable",
+                         "InternalServerError", "DeadlineExceeded", "TooManyRequests"}
+
+def is_retryable_error(e):
+    """
+    Whether a failed upstream call is worth retrying: timeouts, connection
+    errors, throttling and 5xx responses. Client errors (bad request,
+    missing endpoint, bad credentials) fail immediately.
+    """
+    if isinstance(e, (UpstreamTimeout, TimeoutError, ConnectionError,
+                      requests.ConnectionError, requests.Timeout)):
+        return True
+    if type(e).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        error = response.get("Error", {})
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return error.get("Code") in RETRYABLE_ERROR_CODES or status == 429 or status >= 500
+    status = getattr(e, "code", None)
+    if isinstance(status, int):
+        # google.api_core errors carry the HTTP status as .code
+        return status == 429 or status >= 500
+    return False
+
+class Upstream:
+    """
+    Call policy for one upstream service: a deadline per attempt, retries
+    with full-jitter exponential backoff, optional hedging and a circuit
+    breaker.
+
+    With isolate=True each attempt runs on a worker thread so the deadline
+    holds even when the client library has no timeout of its own (the
+    abandoned attempt finishes in the background). With hedge_after, a
+    second identical attempt is started if the first has not answered after
+    that many seconds and whichever answers first wins; only use it for
+    idempotent calls. After failure_threshold consecutive retryable
+    failures the circuit opens and calls fail fast with CircuitOpenError
+    until reset_timeout has passed, when one trial call is let through.
+
+    retry_response(result) may return a delay in seconds to retry a
+    response that did not raise (e.g. an HTTP 429), or None to accept it;
+    the last response is returned once retries run out.
+
+    The duration of successful calls (retries included) is tracked as a
+    smoothed mean and deviation; estimate() returns mean + 2 deviations,
+    or `prior` seconds before the first success.
     """
-    url_components = url.split("/")
+
+    def __init__(self, name, timeout, retries=2, backoff=None, max_backoff=10.0, hedge_after=None,
+                 failure_threshold=None, reset_timeout=None, isolate=True, retry_response=None,
+                 max_workers=32, prior=None):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = UPSTREAM_BACKOFF if backoff is None else backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after or None
+        self.failure_threshold = failure_threshold or CIRCUIT_FAILURE_THRESHOLD
+        self.reset_timeout = CIRCUIT_RESET_SECONDS if reset_timeout is None else reset_timeout
+        self.retry_response = retry_response
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"upstream-{name}") \
+            if isolate else None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._stats = {'calls': 0, 'failures': 0, 'retries': 0, 'hedges': 0, 'timeouts': 0,
+                       'short_circuited': 0, 'circuit_opened': 0}
+        self.prior = prior
+        self._latency = None
+        self._latency_dev = 0.0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._trial or time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _observe(self, seconds, at_least=False):
+        """Fold a call's latency into the estimate; `at_least` only raises it (a call cut short)."""
+        with self._lock:
+            if at_least and (self._estimate() or 0.0) >= seconds:
+                return
+            if self._latency is None:
+                self._latency, self._latency_dev = seconds, seconds / 2
+            else:
+                self._latency_dev += 0.25 * (abs(seconds - self._latency) - self._latency_dev)
+                self._latency += 0.125 * (seconds - self._latency)
+
+    def _estimate(self):
+        if self._latency is None:
+            return self.prior
+        return self._latency + 2 * self._latency_dev
+
+    def estimate(self):
+        """Expected seconds for a call (pessimistic), the prior if none was measured yet, or None."""
+        with self._lock:
+            return self._estimate()
+
+    def _admit(self):
+        with self._lock:
+            self._stats['calls'] += 1
+            if self._opened_at is None:
+                return
+            waited = time.monotonic() - self._opened_at
+            if waited >= self.reset_timeout and not self._trial:
+                self._trial = True
+                return
+            self._stats['short_circuited'] += 1
+        metrics.inc("upstream_short_circuited_total", service=self.name)
+        raise CircuitOpenError(f"{self.name} is unavailable (circuit open, retrying in "
+                               f"{max(0.0, self.reset_timeout - waited):.0f}s)")
+
+    def _record(self, ok):
+        """ok: True (success), False (retryable failure) or None (error that says nothing about health)."""
+        with self._lock:
+            trial, self._trial = self._trial, False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            if ok is None:
+                return
+            self._stats['failures'] += 1
+            self._failures += 1
+            if not (trial or self._failures >= self.failure_threshold):
+                return
+            self._opened_at = time.monotonic()
+            self._stats['circuit_opened'] += 1
+        print(f"  Circuit for {self.name} opened after {self._failures} consecutive failures")
+        metrics.inc("upstream_circuit_opened_total", service=self.name)
+
+    def _attempt(self, fn, args, kwargs, timeout):
+        if self._executor is None:
+            return fn(*args, **kwargs)
+        start = time.monotonic()
+        pending = {self._executor.submit(fn, *args, **kwargs)}
+        if self.hedge_after is not None and self.hedge_after < timeout:
+            done, _ = wait(pending, timeout=self.hedge_after)
+            if not done:
+                self._count('hedges')
+                metrics.inc("upstream_hedges_total", service=self.name)
+                pending.add(self._executor.submit(fn, *args, **kwargs))
+        error = None
+        while pending:
+            remaining = timeout - (time.monotonic() - start)
+            done, pending = wait(pending, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+            if not done:
+                self._count('timeouts')
+                raise UpstreamTimeout(f"{self.name} did not answer within {timeout:.1f}s")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _sleep_before_retry(self, attempt, delay, deadline):
+        if not delay:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return False
+        self._count('retries')
+        metrics.inc("upstream_retries_total", service=self.name)
+        time.sleep(delay)
+        return True
+
+    def call(self, fn, *args, deadline=None, **kwargs):
+        """
+        fn(*args, **kwargs) under this upstream's policy. `deadline` (a
+        time.monotonic() value) bounds all attempts together. Raises
+        CircuitOpenError, UpstreamTimeout or the last error from fn.
+        """
+        self._admit()
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            timeout = self.timeout
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+            try:
+                if timeout <= 0:
+                    self._count('timeouts')
+                    raise UpstreamTimeout(f"{self.name}: deadline exceeded")
+                result = self._attempt(fn, args, kwargs, timeout)
+            except Exception as e:
+                # Running out of the caller's budget says nothing about the upstream's health
+                cut_short = isinstance(e, UpstreamTimeout) and timeout < self.timeout
+                if cut_short:
+                    # ...but the call took at least this long, which the latency estimate should know
+                    self._observe(time.monotonic() - start, at_least=True)
+                if not is_retryable_error(e) or cut_short:
+                    self._record(None)
+                    raise
+                if attempt >= self.retries or not self._sleep_before_retry(attempt, 0, deadline):
+                    self._record(False)
+                    raise
+                print(f"  {self.name} call failed ({type(e).__name__}: {e}), retrying")
+                attempt += 1
+                continue
+            delay = self.retry_response(result) if self.retry_response else None
+            if delay is None:
+                self._record(True)
+                self._observe(time.monotonic() - start)
+                return result
+            if attempt >= self.retries or delay > self.max_backoff or \
+                    not self._sleep_before_retry(attempt, delay, deadline):
+                self._record(False)
+                return result
+            getattr(result, "close", lambda: None)()
+            attempt += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        estimate = self.estimate()
+        return dict(stats, state=self.state, estimate_ms=round(1000 * estimate, 1) if estimate is not None else None)
+
+def github_retry_delay(resp):
+    """
+    Seconds to wait before retrying a GitHub response, 0 for the default
+    backoff, or None if it should be returned as is. Rate limited responses
+    (429, or 403 with no requests remaining) honour Retry-After and
+    X-RateLimit-Reset; 5xx responses are retried with backoff.
+    """
+    status = resp.status_code
+    rate_limited = status == 429 or (status == 403 and (resp.headers.get("Retry-After")
+                                                         or resp.headers.get("X-RateLimit-Remaining") == "0"))
+    if rate_limited:
+        retry_after = resp.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        reset = resp.headers.get("X-RateLimit-Reset")
+        if reset and reset.isdigit():
+            return max(0.0, int(reset) - time.time())
+        return 0.0
+    if status >= 500:
+        return 0.0
+    return None
+
+github_upstream = Upstream("github", GITHUB_TIMEOUT, retries=GITHUB_RETRIES, max_backoff=GITHUB_MAX_RETRY_WAIT,
+                           isolate=False, retry_response=github_retry_delay)
+trainium_upstream = Upstream("trainium", TRAINIUM_TIMEOUT, retries=TRAINIUM_RETRIES,
+                             hedge_after=TRAINIUM_HEDGE_AFTER_MS / 1000, prior=TRAINIUM_LATENCY_PRIOR_MS / 1000)
+gemini_upstream = Upstream("gemini", GEMINI_TIMEOUT, retries=GEMINI_RETRIES,
+                           hedge_after=GEMINI_HEDGE_AFTER_MS / 1000, prior=GEMINI_LATENCY_PRIOR_MS / 1000)
+upstreams = {u.name: u for u in (github_upstream, trainium_upstream, gemini_upstream)}
+
+class BlobCache:
+    """
+    Persistent on-disk cache of file contents keyed by git blob SHA.
+    Blobs are content-addressed, so an entry never goes stale: a changed file
+    simply has a new SHA. The cache is bounded to max_bytes and evicts the
+    least recently used blobs; hit/miss counters are kept for /cache-stats.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # sha -> size, least recently used first
+        self._total_bytes = 0
+        self._load_index()
+
+    def _path(self, sha):
+        return os.path.join(self.cache_dir, sha[:2], sha[2:])
+
+    def _load_index(self):
+        """Rebuild the LRU index from the files already on disk (oldest access first)."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        found = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for rest in os.listdir(prefix_dir):
+                st = os.stat(os.path.join(prefix_dir, rest))
+                found.append((st.st_mtime, prefix + rest, st.st_size))
+        for _, sha, size in sorted(found):
+            self._entries[sha] = size
+            self._total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        """Drop least recently used blobs until the cache fits in max_bytes (lock held)."""
+        while self._total_bytes > self.max_bytes and self._entries:
+            old_sha = next(iter(self._entries))
+            self._forget(old_sha)
+            self.evictions += 1
+            try:
+                os.remove(self._path(old_sha))
+            except OSError:
+                pass
+
+    @staticmethod
+    def git_blob_sha(data):
+        """SHA-1 of the git blob object for `data` (what the tree API reports as `sha`)."""
+        return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+    def get(self, sha):
+        """Return the cached bytes for a blob SHA, or None on a miss."""
+        with self._lock:
+            if not sha or sha not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(sha)
+        try:
+            with open(self._path(sha), "rb") as f:
+                data = f.read()
+            os.utime(self._path(sha))
+        except OSError:
+            with self._lock:
+                self._forget(sha)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, sha, data):
+        """Store a blob, ignoring content that does not hash to `sha`."""
+        if not sha or self.git_blob_sha(data) != sha or len(data) > self.max_bytes:
+            return
+        path = self._path(sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if sha in self._entries:
+                self._entries.move_to_end(sha)
+                return
+            self._entries[sha] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _forget(self, sha):
+        size = self._entries.pop(sha, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# Blob cache location and size bound (set BLOB_CACHE_DIR to an empty string to disable)
+BLOB_CACHE_DIR = os.environ.get('BLOB_CACHE_DIR', os.path.join('.cache', 'blobs'))
+BLOB_CACHE_MAX_BYTES = int(os.environ.get('BLOB_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+blob_cache = BlobCache(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES) if BLOB_CACHE_DIR else None
+
+DEFAULT_INCLUDE_EXTS = {".py", ".js", ".ts", ".java", ".cpp", ".c", ".h", ".html", ".css", ".go", ".rb", ".php"}
+
+class RepoFetchError(Exception):
+    """The repository listing or archive could not be fetched."""
+
+class RepoFile:
+    """
+    One ingested file: its text, or a note when it was skipped or failed.
+    `truncated` is set when only the first read_limit bytes were read.
+    """
+
+    def __init__(self, path, text=None, size=None, note=None, truncated=False):
+        self.path = path
+        self.text = text
+        self.size = size if size is not None else len(text or "")
+        self.note = note
+        self.truncated = truncated
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+def _parse_repo_url(url):
+    """
+    Return (owner, repo) from a GitHub repository URL (or "owner/repo").
+    Raises RepoFetchError if it does not name an owner and a repository.
+    """
+    url_components = url.strip().rstrip("/").split("/")
+    if len(url_components) < 2:
+        raise RepoFetchError(f"Not a GitHub repository URL: {url}")
     owner = url_components[-2]
     repo = url_components[-1].split(".")[0]
-    if include_exts is None:
-        include_exts = {".py", ".js", ".ts", ".java", ".cpp", ".c", ".h", ".html", ".css", ".go", ".rb", ".php"}
-    headers = {"Accept": "application/vnd.github.v3+json"}
-    if token:
-        headers["Authorization"] = f"token {token}"
-    tree_url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
-    r = requests.get(tree_url, headers=headers)
-    if r.status_code != 200:
-        return f"[Error] Could not fetch repo tree: {r.status_code} {r.text}"
-    tree = r.json().get("tree", [])
-    output_lines = []
+    # GitHub owners have no dots, so "https://github.com/foo" has no owner
+    if not owner or not repo or "." in owner or ":" in owner:
+        raise RepoFetchError(f"Not a GitHub repository URL: {url}")
+    return owner, repo
+
+def _is_included(path, include_exts):
+    _, ext = os.path.splitext(path)
+    return ext.lower() in include_exts
+
+# Paths that are almost never worth analyzing: vendored dependencies, build
+# output and generated code. Patterns are fnmatch globs matched against
+# "/<path>", so "*/vendor/*" also matches a top-level vendor/ folder.
+DEFAULT_EXCLUDE_GLOBS = [
+    "*/vendor/*", "*/node_modules/*", "*/third_party/*", "*/bower_components/*",
+    "*/dist/*", "*/build/*", "*/__generated__/*", "*/generated/*",
+    "*.min.js", "*.min.css", "*.bundle.js", "*_pb2.py", "*_pb2_grpc.py", "*.pb.go", "*.pb.h", "*.pb.cc",
+    "*.generated.*", "*_generated.*",
+]
+
+def _parse_globs(value):
+    """Comma-separated globs from an env var (None when unset)."""
+    if value is None:
+        return None
+    return [g.strip() for g in value.split(",") if g.strip()]
+
+FETCH_INCLUDE_GLOBS = _parse_globs(os.environ.get('FETCH_INCLUDE_GLOBS'))
+FETCH_EXCLUDE_GLOBS = _parse_globs(os.environ.get('FETCH_EXCLUDE_GLOBS'))
+FETCH_MAX_FILES = int(os.environ.get('FETCH_MAX_FILES', '2000'))
+
+def _matches_any(path, globs):
+    anchored = "/" + path
+    return any(fnmatch.fnmatch(anchored, g) or fnmatch.fnmatch(path, g) for g in globs)
+
+class FetchPlan:
+    """
+    Decides which files to download from metadata alone (tree or archive
+    member path and size), before any content is requested. A file is
+    fetched when its extension is in include_exts, it matches include_globs
+    (if given), matches none of exclude_globs (default FETCH_EXCLUDE_GLOBS,
+    else DEFAULT_EXCLUDE_GLOBS) and fewer than max_files (default
+    FETCH_MAX_FILES, 0 = no cap) files were selected before it.
+    Oversize files are not downloaded but still reported with a note.
+    to_dict() summarizes the decisions and the fetch work they saved.
+    """
+
+    def __init__(self, include_exts=None, max_file_size=200000, include_globs=None,
+                 exclude_globs=None, max_files=None):
+        self.include_exts = include_exts if include_exts is not None else DEFAULT_INCLUDE_EXTS
+        self.max_file_size = max_file_size
+        if include_globs is None:
+            include_globs = FETCH_INCLUDE_GLOBS
+        if exclude_globs is None:
+            exclude_globs = FETCH_EXCLUDE_GLOBS if FETCH_EXCLUDE_GLOBS is not None else DEFAULT_EXCLUDE_GLOBS
+        self.include_globs = list(include_globs or [])
+        self.exclude_globs = list(exclude_globs)
+        self.max_files = FETCH_MAX_FILES if max_files is None else max_files
+        self.considered = 0
+        self.selected = 0
+        self.selected_bytes = 0
+        self.skipped = {}
+        self.skipped_bytes = 0
+
+    def decide(self, path, size=None):
+        """
+        Return None if `path` should be fetched, otherwise the reason it is
+        skipped: 'extension', 'not_included', 'excluded', 'max_files' or
+        'size' (the caller reports oversize files with a note).
+        """
+        self.considered += 1
+        if not _is_included(path, self.include_exts):
+            reason = 'extension'
+        elif self.include_globs and not _matches_any(path, self.include_globs):
+            reason = 'not_included'
+        elif self.exclude_globs and _matches_any(path, self.exclude_globs):
+            reason = 'excluded'
+        elif size is not None and size > self.max_file_size:
+            reason = 'size'
+        elif self.max_files and self.selected >= self.max_files:
+            reason = 'max_files'
+        else:
+            self.selected += 1
+            self.selected_bytes += size or 0
+            return None
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+        self.skipped_bytes += size or 0
+        metrics.inc("planner_skipped_files_total", reason=reason)
+        return reason
+
+    def to_dict(self):
+        return {
+            'considered': self.considered,
+            'selected': self.selected,
+            'selected_bytes': self.selected_bytes,
+            'skipped': dict(self.skipped),
+            'skipped_files': sum(self.skipped.values()),
+            'skipped_bytes': self.skipped_bytes,
+            'max_files': self.max_files,
+            'include_globs': self.include_globs,
+            'exclude_globs': self.exclude_globs,
+        }
+
+def _skipped_file(path, size, max_file_size):
+    filename = os.path.basename(path)
+    return RepoFile(path, size=size, note=f"[Skipped {filename}: size {size} bytes > {max_file_size}]")
+
+# Per-file budget of the folder-grouped document (characters of indented text)
+DOCUMENT_FILE_CHARS = 50
+# Bytes that are always enough to fill that budget (UTF-8 is at most 4 bytes/char)
+DOCUMENT_READ_LIMIT = DOCUMENT_FILE_CHARS * 4
+
+def _format_file_body(text):
+    """Indent a file's text and cut it to the per-file document budget."""
+    indented = "\n".join("     " + line for line in text.splitlines())
+    indented = indented[:DOCUMENT_FILE_CHARS]
+    return [indented]
+
+def iter_document_lines(files, on_file=None):
+    """
+    Render RepoFile records into the folder-grouped document format, one
+    line at a time: a "Folder: <dir>:" header whenever the folder changes,
+    then "---> <file>". Only the current file is held in memory.
+    on_file(count, total) is called after each file (total None when unknown).
+    """
     current_folder = None
+    for count, f in enumerate(files, 1):
+        if on_file is not None:
+            on_file(count, None)
+        folder = os.path.dirname(f.path)
+        if folder != current_folder:
+            yield f"Folder: {folder or 'Root Folder'}:"
+            current_folder = folder
+        yield f"---> {f.filename}"
+        if f.note:
+            yield f"     {f.note}"
+        else:
+            yield from _format_file_body(f.text)
+        yield ""
+
+def _build_document(files, on_file=None):
+    return "\n".join(iter_document_lines(files, on_file))
+
+def _read_limited(chunks, read_limit):
+    """Join byte chunks, stopping once more than read_limit bytes were seen; return (data, truncated)."""
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if read_limit is not None and len(buf) > read_limit:
+            return bytes(buf[:read_limit]), True
+    return bytes(buf), False
+
+def _fetch_raw_file(session, raw_url, path, max_file_size, sha=None, cache=None, read_limit=None):
+    """
+    Download one raw file and return it as a RepoFile.
+    When a blob cache and the file's blob SHA are given, cached content is
+    used without any network request and fresh downloads are stored.
+    With read_limit, only that many bytes are read from the stream and the
+    connection is closed early (the RepoFile is then marked truncated).
+    """
+    if cache is not None and sha:
+        data = cache.get(sha)
+        if data is not None:
+            if len(data) > max_file_size:
+                return _skipped_file(path, len(data), max_file_size)
+            metrics.inc("fetched_files_total", source="cache")
+            metrics.inc("fetched_bytes_total", len(data), source="cache")
+            size = len(data)
+            truncated = read_limit is not None and size > read_limit
+            if truncated:
+                data = data[:read_limit]
+            return RepoFile(path, data.decode("utf-8", errors="replace"), size=size, truncated=truncated)
+    try:
+        with metrics.timer("github_raw"):
+            with github_upstream.call(session.get, raw_url, stream=True, timeout=GITHUB_TIMEOUT) as resp:
+                resp.raise_for_status()
+                size = int(resp.headers.get("content-length") or 0)
+                if size and size > max_file_size:
+                    return _skipped_file(path, size, max_file_size)
+                # Stop at max_file_size even when content-length is missing
+                limit = max_file_size if read_limit is None else min(read_limit, max_file_size)
+                data, truncated = _read_limited(resp.iter_content(chunk_size=16384), limit)
+                if truncated and read_limit is None:
+                    note = f"[Skipped {os.path.basename(path)}: more than {max_file_size} bytes]"
+                    return RepoFile(path, note=note)
+                encoding = resp.encoding or "utf-8"
+        if cache is not None and sha and not truncated:
+            cache.put(sha, data)
+        metrics.inc("fetched_files_total", source="network")
+        metrics.inc("fetched_bytes_total", len(data), source="network")
+        text = data.decode(encoding, errors="replace")
+        return RepoFile(path, text, size=size or len(data), truncated=truncated)
+    except Exception as e:
+        return RepoFile(path, note=f"[Error fetching raw {os.path.basename(path)}: {e}]")
+
+# GitHub API credentials: a pool of tokens (GITHUB_TOKENS, comma-separated,
+# or a single GITHUB_TOKEN) shared by all requests; unauthenticated without.
+# Below GITHUB_PACE_BELOW of a token's hourly limit, its remaining requests
+# are spread evenly until the limit resets. A token rate limited without
+# Retry-After or X-RateLimit-Reset rests for GITHUB_RATE_LIMIT_BACKOFF seconds.
+GITHUB_TOKENS = [t.strip() for t in (os.environ.get('GITHUB_TOKENS') or os.environ.get('GITHUB_TOKEN') or '').split(',')
+                 if t.strip()]
+GITHUB_PACE_BELOW = float(os.environ.get('GITHUB_PACE_BELOW', '0.2'))
+GITHUB_RATE_LIMIT_BACKOFF = float(os.environ.get('GITHUB_RATE_LIMIT_BACKOFF', '10'))
+GITHUB_ETAG_MAX_BYTES = int(os.environ.get('GITHUB_ETAG_MAX_BYTES', str(8 * 1024 * 1024)))
+GITHUB_ETAG_MEMORY_BYTES = int(os.environ.get('GITHUB_ETAG_MEMORY_BYTES', str(32 * 1024 * 1024)))
+
+class _TokenState:
+    def __init__(self, token):
+        self.token = token
+        self.limit = None
+        self.remaining = None
+        self.reset = 0.0
+        self.interval = 0.0
+        self.next_at = 0.0
+        self.requests = 0
+
+class GitHubScheduler:
+    """
+    Picks the credentials for every GitHub API request and paces them
+    against the rate-limit headers of earlier responses.
+
+    Requests rotate over the token pool, preferring the token that may be
+    used soonest with the most requests left. A token with nothing left
+    is skipped until its X-RateLimit-Reset; when every token is exhausted
+    the request waits for the first reset, or fails with RepoFetchError if
+    that is more than max_wait seconds away. A response rate limited on
+    one token is retried at once with the next.
+
+    get_json() sends the ETag of the last answer for the same URL as
+    If-None-Match, so unchanged metadata and trees come back as 304s
+    (which GitHub does not count against the limit) and are served from
+    `cache` (default: github_etag_cache).
+    """
+
+    def __init__(self, tokens=None, pace_below=None, max_wait=None, cache=None, backoff=None):
+        self._pool = [_TokenState(token) for token in (tokens or [])] or [_TokenState(None)]
+        self._adhoc = {}
+        self.pace_below = GITHUB_PACE_BELOW if pace_below is None else pace_below
+        self.max_wait = GITHUB_MAX_RETRY_WAIT if max_wait is None else max_wait
+        self.backoff = GITHUB_RATE_LIMIT_BACKOFF if backoff is None else backoff
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._next = 0
+        self.not_modified = 0
+        self.rate_limited = 0
+
+    def _acquire(self, token=None):
+        """Reserve a request on a token (the given one, or the best of the pool); returns its state."""
+        while True:
+            with self._lock:
+                now = time.time()
+                if token is not None:
+                    candidates = [self._adhoc.setdefault(token, _TokenState(token))]
+                else:
+                    # Start the scan at a rotating offset so equal tokens take turns
+                    candidates = self._pool[self._next:] + self._pool[:self._next]
+                    self._next = (self._next + 1) % len(self._pool)
+                for state in candidates:
+                    if state.remaining is not None and state.reset and now >= state.reset:
+                        state.remaining, state.interval = state.limit, 0.0
+                # A token with no known reset time is usable: its next response will tell
+                usable = [state for state in candidates
+                          if state.remaining is None or state.remaining > 0 or not state.reset]
+                if usable:
+                    state = min(usable, key=lambda st: (max(st.next_at, now),
+                                                        -(st.remaining if st.remaining is not None else 1e9)))
+                    wait_for = max(0.0, state.next_at - now)
+                    if wait_for > self.max_wait:
+                        raise RepoFetchError(f"GitHub rate limit nearly exhausted; next request allowed in "
+                                             f"{wait_for:.0f}s")
+                    state.next_at = max(state.next_at, now) + state.interval
+                    if state.remaining is not None:
+                        state.remaining -= 1
+                    state.requests += 1
+                else:
+                    state = None
+                    wait_for = min(st.reset for st in candidates) - now
+                    if wait_for > self.max_wait:
+                        raise RepoFetchError(f"GitHub API rate limit exhausted for all {len(candidates)} "
+                                             f"token(s); resets in {wait_for:.0f}s")
+            if wait_for > 0:
+                metrics.inc("github_paced_requests_total")
+                time.sleep(wait_for)
+            if state is not None:
+                return state
+
+    def _update(self, state, resp):
+        """Record the rate-limit headers of a response; returns True if it was rate limited."""
+        headers = resp.headers
+        remaining = headers.get("X-RateLimit-Remaining")
+        limit = headers.get("X-RateLimit-Limit")
+        reset = headers.get("X-RateLimit-Reset")
+        rate_limited = github_retry_delay(resp) is not None and resp.status_code in (403, 429)
+        with self._lock:
+            if remaining is not None and remaining.isdigit():
+                state.remaining = int(remaining)
+            if limit is not None and limit.isdigit():
+                state.limit = int(limit)
+            if reset is not None and reset.isdigit():
+                state.reset = float(reset)
+            if rate_limited:
+                self.rate_limited += 1
+                state.remaining = 0
+                retry_after = headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    state.reset = max(state.reset, time.time() + int(retry_after))
+                elif state.reset <= time.time():
+                    # Neither header says when to come back (e.g. a secondary rate limit)
+                    state.reset = time.time() + self.backoff
+            if state.limit and state.remaining is not None and state.remaining < state.limit * self.pace_below:
+                state.interval = max(0.0, state.reset - time.time()) / max(1, state.remaining)
+            else:
+                state.interval = 0.0
+        return rate_limited
+
+    def _send(self, session, url, token, headers, **kwargs):
+        """One GET, moving on to the next pooled token while responses are rate limited."""
+        attempts = 1 if token is not None else len(self._pool)
+        for attempt in range(attempts):
+            state = self._acquire(token)
+            request_headers = dict(headers)
+            if state.token:
+                request_headers["Authorization"] = f"token {state.token}"
+            resp = session.get(url, headers=request_headers, **kwargs)
+            if not self._update(state, resp) or attempt == attempts - 1:
+                return resp
+            resp.close()
+
+    def get(self, url, session=None, token=None, headers=None, timeout=None, **kwargs):
+        """GET a GitHub API URL with a pooled token (or `token`) under github_upstream's retry policy."""
+        if session is None:
+            session = get_http_session()
+        headers = dict({"Accept": "application/vnd.github.v3+json"}, **(headers or {}))
+        return github_upstream.call(self._send, session, url, token, headers,
+                                    timeout=timeout or GITHUB_TIMEOUT, **kwargs)
+
+    def get_json(self, url, session=None, token=None, what="resource"):
+        """
+        GET a GitHub API URL and return its parsed JSON body, revalidating
+        a stored copy with If-None-Match. Raises RepoFetchError unless the
+        answer is 200 or 304.
+        """
+        cache = self.cache if self.cache is not None else github_etag_cache
+        key = hashlib.sha256(f"{token or ''}\0{url}".encode("utf-8")).hexdigest()
+        stored = cache.get(key)
+        stored = json.loads(stored) if stored else None
+        headers = {"If-None-Match": stored["etag"]} if stored else {}
+        r = self.get(url, session=session, token=token, headers=headers)
+        if r.status_code == 304 and stored:
+            with self._lock:
+                self.not_modified += 1
+            metrics.inc("github_conditional_requests_total", outcome="not_modified")
+            return json.loads(stored["body"])
+        if r.status_code != 200:
+            raise RepoFetchError(f"Could not fetch {what}: {r.status_code} {r.text}")
+        etag = r.headers.get("ETag")
+        if etag:
+            metrics.inc("github_conditional_requests_total", outcome="modified" if stored else "new")
+            if len(r.text) <= GITHUB_ETAG_MAX_BYTES:
+                cache.put(key, json.dumps({"etag": etag, "body": r.text}))
+        return r.json()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tokens': len([state for state in self._pool if state.token]),
+                'not_modified': self.not_modified,
+                'rate_limited': self.rate_limited,
+                'pool': [{'requests': state.requests, 'remaining': state.remaining, 'limit': state.limit,
+                          'reset': state.reset or None, 'interval': round(state.interval, 3)}
+                         for state in self._pool]
+            }
+
+github_scheduler = GitHubScheduler(GITHUB_TOKENS)
+
+def fetch_github_repo(url, token=None, session=None):
+    """The repository's metadata from the GitHub API (one conditional request)."""
+    owner, repo = _parse_repo_url(url)
+    with metrics.timer("github_repo"):
+        return github_scheduler.get_json(f"{GITHUB_API_URL}/repos/{owner}/{repo}", session=session, token=token,
+                                         what="repository")
+
+def resolve_default_branch(url, token=None, session=None):
+    """The repository's default branch, from its metadata (falls back to 'main' if not reported)."""
+    return fetch_github_repo(url, token, session).get("default_branch") or "main"
+
+def fetch_github_tree(url, branch="main", token=None, session=None):
+    """
+    List a repository branch recursively with one git tree API request.
+    Returns the parsed response ({"sha": root tree SHA, "tree": [...]}).
+    Raises RepoFetchError if the tree cannot be listed.
+    """
+    owner, repo = _parse_repo_url(url)
+    tree_url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
+    with metrics.timer("github_tree"):
+        return github_scheduler.get_json(tree_url, session=session, token=token, what="repo tree")
+
+def resolve_github_tree(url, token=None, session=None):
+    """fetch_github_tree for the repository's default branch. Returns (branch, tree)."""
+    branch = resolve_default_branch(url, token, session)
+    return branch, fetch_github_tree(url, branch, token, session)
+
+def iter_github_repo_files_raw(url, branch="main", include_exts=None, token=None, max_file_size=200000,
+                               max_workers=None, session=None, cache=None, on_file=None, read_limit=None,
+                               plan=None, tree=None, known=None):
+    """
+    Use git tree API to list files (one API request), then fetch content from
+    raw.githubusercontent.com for each file (avoids per-file GitHub API requests).
+    Raw files are downloaded concurrently (max_workers, default FETCH_WORKERS)
+    over a shared keep-alive session and yielded as RepoFiles in tree listing
+    order. At most 2 * max_workers downloads are in flight or buffered, so
+    memory does not grow with the size of the repository; read_limit caps
+    the bytes read per file. Files whose blob SHA is already in the blob
+    cache (default: blob_cache) are served locally, so only changed blobs
+    are downloaded. on_file(count, total) is called as each file is yielded.
+    The file set is chosen from the tree's paths and blob sizes by `plan`
+    (default: a FetchPlan for include_exts and max_file_size) before any
+    raw request is made; oversize files are reported without downloading.
+    `tree` reuses a listing from fetch_github_tree, and `known` maps
+    (path, blob SHA) pairs to records yielded in place of downloading them.
+    Raises RepoFetchError if the tree cannot be listed.
+    """
+    owner, repo = _parse_repo_url(url)
+    if plan is None:
+        plan = FetchPlan(include_exts, max_file_size)
+    if session is None:
+        session = get_http_session()
+    if max_workers is None:
+        max_workers = FETCH_WORKERS
+    if cache is None:
+        cache = blob_cache
+    if tree is None:
+        tree = fetch_github_tree(url, branch, token, session)
+    tree = tree.get("tree", [])
+
+    # Plan the file set from tree metadata so downloads can run in parallel
+    files = []
     for item in tree:
         if item.get("type") != "blob":
             continue
         path = item.get("path")
-        _, ext = os.path.splitext(path)
-        if ext.lower() not in include_exts:
+        size = item.get("size")
+        reason = plan.decide(path, size)
+        if reason is None or reason == "size":
+            files.append((path, item.get("sha"), size, reason))
+    tree = None
+
+    def fetch(file):
+        path, sha, size, reason = file
+        if reason == "size":
+            return _skipped_file(path, size, plan.max_file_size)
+        if known and (path, sha) in known:
+            return known[(path, sha)]
+        raw_url = f"{GITHUB_RAW_URL}/{owner}/{repo}/{branch}/{path}"
+        return _fetch_raw_file(session, raw_url, path, plan.max_file_size, sha=sha, cache=cache,
+                               read_limit=read_limit)
+
+    max_workers = max(1, max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Sliding window of downloads; results are yielded in submission
+        # order, keeping the output deterministic
+        pending = deque()
+        next_file = 0
+        for count in range(1, len(files) + 1):
+            while next_file < len(files) and len(pending) < 2 * max_workers:
+                pending.append(executor.submit(fetch, files[next_file]))
+                next_file += 1
+            f = pending.popleft().result()
+            if on_file is not None:
+                on_file(count, len(files))
+            yield f
+
+def list_github_repo_files_raw(url, branch="main", include_exts=None, token=None, max_file_size=200000,
+                               max_workers=None, session=None, cache=None, on_file=None, plan=None):
+    """List the RepoFiles of a GitHub repository (see iter_github_repo_files_raw)."""
+    return list(iter_github_repo_files_raw(url, branch, include_exts, token, max_file_size,
+                                           max_workers, session, cache, on_file, plan=plan))
+
+def document_github_repo_raw(url, branch="main", include_exts=None, token=None, max_file_size=200000,
+                             max_workers=None, session=None, cache=None, on_file=None, plan=None):
+    """
+    Build the folder-grouped codebase document for a GitHub repository using
+    the tree API and raw.githubusercontent.com (see iter_github_repo_files_raw).
+    Files are streamed through the renderer and only the bytes the document
+    keeps of each file are downloaded.
+    """
+    try:
+        files = iter_github_repo_files_raw(url, branch, include_exts, token, max_file_size,
+                                           max_workers, session, cache, on_file,
+                                           read_limit=DOCUMENT_READ_LIMIT, plan=plan)
+        return _build_document(files)
+    except RepoFetchError as e:
+        return f"[Error] {e}"
+
+def _strip_archive_root(name, root):
+    """Drop the archive's top-level "<repo>-<ref>/" directory from a member name."""
+    if root and name.startswith(root):
+        return name[len(root):]
+    return name
+
+def _archive_root(names):
+    """The top-level directory shared by every member name, or "" if there is none."""
+    if not names or not all("/" in name for name in names):
+        return ""
+    first = names[0].split("/", 1)[0] + "/"
+    return first if all(name.startswith(first) for name in names) else ""
+
+def _tar_files(tar, plan, read_limit=None, root=None):
+    """
+    Yield RepoFiles for the files `plan` selects in an open (possibly
+    streaming) tarfile, with `root` stripped from their paths. A streamed
+    tarball cannot be scanned ahead, so by default the root is its first
+    member if that is a directory (GitHub archives wrap everything in one
+    "<repo>-<ref>/" directory); pass _archive_root(...) for other archives.
+    """
+    for member in tar:
+        if root is None:
+            root = member.name.rstrip("/") + "/" if member.isdir() else ""
+        if not member.isfile():
+            continue
+        path = _strip_archive_root(member.name, root)
+        if not path:
+            continue
+        reason = plan.decide(path, member.size)
+        if reason == "size":
+            yield _skipped_file(path, member.size, plan.max_file_size)
+        if reason is not None:
             continue
-        folder = os.path.dirname(path)
-        filename = os.path.basename(path)
-        if folder != current_folder:
-            output_lines.append(f"Folder: {folder or 'Root Folder'}:")
-            current_folder = folder
-        output_lines.append(f"---> {filename}")
-        # Build raw URL
-        raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
         try:
-            resp = requests.get(raw_url, stream=True, timeout=10)
-            resp.raise_for_status()
-            size = int(resp.headers.get("content-length") or 0)
-            if size and size > max_file_size:
-                output_lines.append(f"     [Skipped {filename}: size {size} bytes > {max_file_size}]")
+            # Streaming tarfile skips whatever part of the member is left unread
+            data = tar.extractfile(member).read(read_limit if read_limit is not None else -1)
+            truncated = read_limit is not None and member.size > read_limit
+            yield RepoFile(path, data.decode("utf-8", errors="replace"), size=member.size, truncated=truncated)
+        except Exception as e:
+            yield RepoFile(path, note=f"[Error reading {os.path.basename(path)}: {e}]")
+
+def _zip_files(zf, plan, read_limit=None):
+    """Yield RepoFiles for the files `plan` selects in an open zipfile."""
+    infos = [info for info in zf.infolist() if not info.is_dir()]
+    root = _archive_root([info.filename for info in infos])
+    for info in infos:
+        path = _strip_archive_root(info.filename, root)
+        if not path:
+            continue
+        reason = plan.decide(path, info.file_size)
+        if reason == "size":
+            yield _skipped_file(path, info.file_size, plan.max_file_size)
+        if reason is not None:
+            continue
+        try:
+            with zf.open(info) as member:
+                data = member.read(read_limit if read_limit is not None else -1)
+            truncated = read_limit is not None and info.file_size > read_limit
+            yield RepoFile(path, data.decode("utf-8", errors="replace"), size=info.file_size, truncated=truncated)
+        except Exception as e:
+            yield RepoFile(path, note=f"[Error reading {os.path.basename(path)}: {e}]")
+
+# Zipballs need random access, so they are spooled to a temporary file first;
+# larger ones are refused rather than filling the disk
+ZIPBALL_MAX_BYTES = int(os.environ.get('ZIPBALL_MAX_BYTES', str(256 * 1024 * 1024)))
+
+def _spool_response(resp, out, max_bytes):
+    """Copy a streamed response body into the file `out`. Raises RepoFetchError beyond max_bytes."""
+    too_large = f"Repository zipball is larger than ZIPBALL_MAX_BYTES ({max_bytes} bytes); use the tarball format"
+    length = resp.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise RepoFetchError(too_large)
+    total = 0
+    for chunk in resp.iter_content(chunk_size=1024 * 1024):
+        total += len(chunk)
+        if total > max_bytes:
+            raise RepoFetchError(too_large)
+        out.write(chunk)
+    out.seek(0)
+
+def iter_github_repo_files_archive(source, branch="main", include_exts=None, token=None, max_file_size=200000,
+                                   archive_format="tarball", session=None, read_limit=None, plan=None):
+    """
+    Yield RepoFiles from a single repository archive instead of one request
+    per file. `source` is either a GitHub repo URL (the tarball/zipball for
+    `branch` is downloaded in one request) or a path to a local
+    .tar.gz/.tar/.zip file, accepted only inside LOCAL_REPO_ROOTS (see
+    allowed_local_path). Tarballs are streamed through tarfile without
+    touching disk; zipballs need random access, so they are spooled to a
+    temporary file of at most ZIPBALL_MAX_BYTES.
+    read_limit caps the bytes read per file. Members are selected from their
+    path and header size by `plan` (see FetchPlan) before being read.
+    Raises RepoFetchError if the archive cannot be downloaded or read.
+    """
+    if plan is None:
+        plan = FetchPlan(include_exts, max_file_size)
+
+    try:
+        local_path = allowed_local_path(source)
+        if local_path is not None:
+            if not os.path.isfile(local_path):
+                raise RepoFetchError(f"Local archive {local_path} does not exist")
+            if zipfile.is_zipfile(local_path):
+                with zipfile.ZipFile(local_path) as zf:
+                    yield from _zip_files(zf, plan, read_limit)
+                return
+            with tarfile.open(local_path, mode="r:*") as tar:
+                root = _archive_root([member.name for member in tar.getmembers() if member.isfile()])
+                yield from _tar_files(tar, plan, read_limit, root)
+            return
+
+        if archive_format not in ("tarball", "zipball"):
+            raise RepoFetchError(f"Unknown archive format: {archive_format}")
+        owner, repo = _parse_repo_url(source)
+        archive_url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/{archive_format}/{branch}"
+        with github_scheduler.get(archive_url, session=session, token=token, stream=True,
+                                  timeout=max(60, GITHUB_TIMEOUT)) as resp:
+            if resp.status_code != 200:
+                raise RepoFetchError(f"Could not fetch repo archive: {resp.status_code} {resp.text}")
+            if archive_format == "zipball":
+                with tempfile.TemporaryFile() as spool:
+                    _spool_response(resp, spool, ZIPBALL_MAX_BYTES)
+                    with zipfile.ZipFile(spool) as zf:
+                        yield from _zip_files(zf, plan, read_limit)
+                return
+            resp.raw.decode_content = True
+            with tarfile.open(fileobj=resp.raw, mode="r|gz") as tar:
+                yield from _tar_files(tar, plan, read_limit)
+    except (tarfile.TarError, zipfile.BadZipFile, requests.RequestException) as e:
+        raise RepoFetchError(f"Could not read repo archive: {e}")
+
+def _iter_archive_with_progress(source, branch="main", include_exts=None, token=None, max_file_size=200000,
+                                archive_format="tarball", session=None, on_file=None, read_limit=None,
+                                plan=None):
+    """iter_github_repo_files_archive plus progress callbacks, stage timing and counters."""
+    count = 0
+    total_bytes = 0
+    with metrics.timer("github_archive"):
+        for f in iter_github_repo_files_archive(source, branch, include_exts, token, max_file_size,
+                                                archive_format, session, read_limit, plan):
+            count += 1
+            if f.text is not None:
+                total_bytes += len(f.text)
+            if on_file is not None:
+                on_file(count, None)
+            yield f
+    metrics.inc("fetched_files_total", count, source="archive")
+    metrics.inc("fetched_bytes_total", total_bytes, source="archive")
+
+def list_github_repo_files_archive(source, branch="main", include_exts=None, token=None, max_file_size=200000,
+                                   archive_format="tarball", session=None, on_file=None, plan=None):
+    """List the RepoFiles of a repository archive (see iter_github_repo_files_archive)."""
+    return list(_iter_archive_with_progress(source, branch, include_exts, token, max_file_size,
+                                            archive_format, session, on_file, plan=plan))
+
+def document_github_repo_archive(source, branch="main", include_exts=None, token=None, max_file_size=200000,
+                                 archive_format="tarball", session=None, on_file=None, plan=None):
+    """
+    Build the same document as document_github_repo_raw from a single
+    repository archive (see iter_github_repo_files_archive).
+    on_file(count, None) is called as each file is read.
+    """
+    try:
+        files = iter_github_repo_files_archive(source, branch, include_exts, token, max_file_size,
+                                               archive_format, session, read_limit=DOCUMENT_READ_LIMIT,
+                                               plan=plan)
+        return _build_document(files, on_file)
+    except RepoFetchError as e:
+        return f"[Error] {e}"
+
+# Local git ingestion: repositories already cloned on this host, read with
+# git itself (no network). Opt-in: local paths are only accepted inside
+# LOCAL_REPO_ROOTS (comma-separated directories), and rejected when it is unset.
+LOCAL_REPO_ROOTS = [os.path.realpath(root) for root in _parse_globs(os.environ.get('LOCAL_REPO_ROOTS')) or []]
+GIT_BINARY = os.environ.get('GIT_BINARY', 'git')
+
+def allowed_local_path(source):
+    """
+    The real path named by a local source (a file:// URL, or an absolute or
+    ./ relative path), or None for a remote URL. The path is checked against
+    LOCAL_REPO_ROOTS before the filesystem is touched, so requests cannot
+    probe for files outside them. Raises RepoFetchError if it is not allowed.
+    """
+    if source.startswith("file://"):
+        path = unquote(urlparse(source).path)
+    elif os.path.isabs(source) or source.startswith(("./", "../")):
+        path = source
+    else:
+        return None
+    path = os.path.realpath(path)
+    if not LOCAL_REPO_ROOTS:
+        raise RepoFetchError("Local repositories are disabled (set LOCAL_REPO_ROOTS to enable them)")
+    if not any(path == root or path.startswith(root + os.sep) for root in LOCAL_REPO_ROOTS):
+        raise RepoFetchError(f"Local repository {path} is outside LOCAL_REPO_ROOTS")
+    return path
+
+def local_repo_path(source):
+    """
+    The working tree path of a local repository source (see
+    allowed_local_path), or None for a remote URL or a local archive file.
+    Raises RepoFetchError if the path is not allowed or does not exist.
+    """
+    path = allowed_local_path(source)
+    if path is None or os.path.isfile(path):
+        return None
+    if not os.path.isdir(path):
+        raise RepoFetchError(f"Local repository {path} does not exist")
+    return path
+
+def _git(path, *args):
+    """Run a git command in `path` and return its stdout (bytes). Raises RepoFetchError on failure."""
+    if shutil.which(GIT_BINARY) is None:
+        raise RepoFetchError(f"{GIT_BINARY} is not installed")
+    result = subprocess.run([GIT_BINARY, "-C", path, *args], capture_output=True)
+    if result.returncode != 0:
+        raise RepoFetchError(f"git {args[0]} failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+    return result.stdout
+
+def fetch_local_tree(path, rev="HEAD"):
+    """
+    List a local repository revision recursively with `git ls-tree -r -l`.
+    Returns the same shape as fetch_github_tree ({"sha": root tree SHA,
+    "tree": [{"path", "type", "sha", "size"}, ...]}).
+    """
+    with metrics.timer("git_ls_tree"):
+        tree_sha = _git(path, "rev-parse", "--verify", f"{rev}^{{tree}}").decode().strip()
+        listing = _git(path, "ls-tree", "-r", "-l", "-z", tree_sha)
+    tree = []
+    for record in listing.split(b"\0"):
+        if not record:
+            continue
+        # "<mode> <type> <sha> <size padded with spaces>\t<path>"
+        meta, _, name = record.partition(b"\t")
+        mode, kind, sha, size = meta.split()
+        tree.append({"path": name.decode("utf-8", errors="replace"), "type": kind.decode(), "mode": mode.decode(),
+                     "sha": sha.decode(), "size": int(size) if size.isdigit() else None})
+    return {"sha": tree_sha, "tree": tree}
+
+def resolve_local_tree(path):
+    """(branch, tree) for a local repository's checked-out branch ('HEAD' when detached)."""
+    branch = _git(path, "rev-parse", "--abbrev-ref", "HEAD").decode().strip() or "HEAD"
+    return branch, fetch_local_tree(path, branch)
+
+def _cat_file_batch(path, shas, read_limit=None):
+    """
+    Yield (data, size) for each blob SHA through one `git cat-file --batch`
+    process. A writer thread feeds the SHAs while results are read in the
+    same order, so git never waits for a round trip. Only read_limit bytes
+    of each blob are kept (the rest is read and dropped).
+    """
+    proc = subprocess.Popen([GIT_BINARY, "-C", path, "cat-file", "--batch"],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def feed():
+        try:
+            for sha in shas:
+                proc.stdin.write(sha.encode() + b"\n")
+            proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    writer = threading.Thread(target=feed, name="git-cat-file", daemon=True)
+    writer.start()
+    try:
+        for sha in shas:
+            header = proc.stdout.readline().split()
+            if len(header) != 3:
+                raise RepoFetchError(f"git cat-file could not read {sha}: {b' '.join(header).decode()}")
+            size = int(header[2])
+            keep = size if read_limit is None else min(size, read_limit)
+            data = proc.stdout.read(keep)
+            rest = size - keep + 1  # the rest of the blob and its trailing newline
+            while rest > 0:
+                chunk = proc.stdout.read(min(rest, 1 << 20))
+                if not chunk:
+                    raise RepoFetchError(f"git cat-file ended while reading {sha}")
+                rest -= len(chunk)
+            yield data, size
+    finally:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        writer.join()
+
+def iter_local_git_files(source, branch=None, include_exts=None, max_file_size=200000, on_file=None,
+                         read_limit=None, plan=None, tree=None, known=None):
+    """
+    Yield RepoFiles from a local git repository (a directory or file:// URL)
+    at `branch` (default HEAD): the tree is listed with `git ls-tree -r -l`
+    and the selected blobs are streamed through one `git cat-file --batch`
+    process. Files are chosen by `plan` exactly as in
+    iter_github_repo_files_raw, yielded in tree order, and `tree`/`known`
+    work the same way. Only committed content is read, not the working
+    tree. Raises RepoFetchError if the path is not a git repository.
+    """
+    path = local_repo_path(source)
+    if path is None:
+        raise RepoFetchError(f"Not a local repository: {source}")
+    if plan is None:
+        plan = FetchPlan(include_exts, max_file_size)
+    if tree is None:
+        tree = fetch_local_tree(path, branch or "HEAD")
+
+    files = []
+    for item in tree.get("tree", []):
+        if item.get("type") != "blob":
+            continue
+        reason = plan.decide(item.get("path"), item.get("size"))
+        if reason is None or reason == "size":
+            files.append((item.get("path"), item.get("sha"), item.get("size"), reason))
+    wanted = [sha for file_path, sha, _, reason in files
+              if reason is None and not (known and (file_path, sha) in known)]
+    blobs = _cat_file_batch(path, wanted, read_limit)
+
+    count = 0
+    total_bytes = 0
+    try:
+        with metrics.timer("git_cat_file"):
+            for file_path, sha, size, reason in files:
+                if reason == "size":
+                    f = _skipped_file(file_path, size, plan.max_file_size)
+                elif known and (file_path, sha) in known:
+                    f = known[(file_path, sha)]
+                else:
+                    data, size = next(blobs)
+                    total_bytes += len(data)
+                    truncated = read_limit is not None and size > read_limit
+                    f = RepoFile(file_path, data.decode("utf-8", errors="replace"), size=size, truncated=truncated)
+                count += 1
+                if on_file is not None:
+                    on_file(count, len(files))
+                yield f
+    finally:
+        blobs.close()
+        metrics.inc("fetched_files_total", len(wanted), source="git")
+        metrics.inc("fetched_bytes_total", total_bytes, source="git")
+
+def list_local_git_files(source, branch=None, include_exts=None, max_file_size=200000, on_file=None, plan=None):
+    """List the RepoFiles of a local git repository (see iter_local_git_files)."""
+    return list(iter_local_git_files(source, branch, include_exts, max_file_size, on_file, plan=plan))
+
+def document_local_git_repo(source, branch=None, include_exts=None, max_file_size=200000, on_file=None,
+                            plan=None):
+    """
+    Build the same document as document_github_repo_raw from a local git
+    repository (see iter_local_git_files), without any network access.
+    """
+    try:
+        files = iter_local_git_files(source, branch, include_exts, max_file_size, on_file,
+                                     read_limit=DOCUMENT_READ_LIMIT, plan=plan)
+        return _build_document(files)
+    except RepoFetchError as e:
+        return f"[Error] {e}"
+
+# Ingestion backends for /analyze-url ("raw": tree API + raw files, "archive": one tarball;
+# local clones always use git)
+INGEST_MODE = os.environ.get('INGEST_MODE', 'raw')
+
+def iter_codebase(repo_url, mode=None, max_file_size=100000, on_file=None, plan=None,
+                  branch=None, tree=None, known=None):
+    """
+    Stream a repository's files (as RepoFiles) with the chosen ingestion
+    mode, from `branch` or else the repository's default branch. `plan`
+    (a FetchPlan) chooses the files and records what was skipped. In raw
+    mode `tree` and `known` are passed on to iter_github_repo_files_raw.
+    Local repositories (a directory or file:// URL) are always read with
+    git (see iter_local_git_files), from `branch` or HEAD, and local
+    .tar.gz/.tar/.zip files as archives whatever the mode.
+    Raises RepoFetchError if the repository cannot be fetched.
+    """
+    mode = mode or INGEST_MODE
+    options = {"max_file_size": max_file_size, "on_file": on_file, "plan": plan}
+    local_path = allowed_local_path(repo_url)
+    if local_path is not None:
+        if os.path.isfile(local_path):
+            yield from _iter_archive_with_progress(repo_url, **options)
+        else:
+            yield from iter_local_git_files(repo_url, branch=branch, tree=tree, known=known, **options)
+        return
+    if mode == "archive":
+        fetch = _iter_archive_with_progress
+    elif mode == "raw":
+        fetch = iter_github_repo_files_raw
+        options.update(tree=tree, known=known)
+    else:
+        raise RepoFetchError(f"Unknown ingest mode: {mode}")
+    if branch is None:
+        # One metadata request names the default branch
+        branch = resolve_default_branch(repo_url)
+    yield from fetch(repo_url, branch=branch, **options)
+
+def fetch_codebase(repo_url, mode=None, max_file_size=100000, on_file=None, plan=None):
+    """List a repository's files (see iter_codebase)."""
+    return list(iter_codebase(repo_url, mode, max_file_size, on_file, plan))
+
+# Context packing for the Trainium prompt. TinyLlama has VERY limited context
+# (512 tokens total for input + output) and for code 1 token ≈ 2-3 characters,
+# so the default input budget is ~250 tokens, leaving room for 150 output tokens.
+TRAINIUM_CONTEXT_TOKENS = int(os.environ.get('TRAINIUM_CONTEXT_TOKENS', '250'))
+CHARS_PER_TOKEN = float(os.environ.get('CHARS_PER_TOKEN', '2.5'))
+
+ENTRY_POINT_NAMES = {
+    "main", "__main__", "app", "server", "index", "manage", "wsgi", "asgi", "cli", "run", "backend"
+}
+
+# Lightweight signature/import patterns for languages without a parser here
+SIGNATURE_PATTERNS = {
+    ".js": [
+        r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*\w+\s*\([^)]*\)",
+        r"^\s*(?:export\s+)?(?:default\s+)?class\s+\w+(?:\s+extends\s+[\w.]+)?",
+        r"^\s*(?:export\s+)?(?:const|let|var)\s+\w+\s*=\s*(?:async\s+)?(?:\([^)]*\)|\w+)\s*=>",
+    ],
+    ".go": [
+        r"^func\s+(?:\([^)]*\)\s*)?\w+\s*\([^)]*\)[^{]*",
+        r"^type\s+\w+\s+(?:struct|interface)",
+    ],
+    ".java": [
+        r"^\s*(?:public|protected|private|abstract|final|static|\s)*(?:class|interface|enum)\s+\w+[^{]*",
+        r"^\s*(?:public|protected|private)\s+(?:static\s+)?(?:final\s+)?[\w<>\[\],\s]+\s+\w+\s*\([^)]*\)",
+    ],
+    ".c": [
+        r"^(?!\s)(?!return\b)[\w\*][\w\s\*]*\s\**\w+\s*\([^;{]*\)\s*(?=\{|$)",
+        r"^\s*(?:typedef\s+)?struct\s+\w+",
+    ],
+    ".rb": [
+        r"^\s*(?:class|module)\s+[\w:]+(?:\s*<\s*[\w:]+)?",
+        r"^\s*def\s+[\w.?!]+(?:\([^)]*\))?",
+    ],
+    ".php": [
+        r"^\s*(?:abstract\s+|final\s+)?(?:class|interface|trait)\s+\w+[^{]*",
+        r"^\s*(?:public\s+|protected\s+|private\s+)?(?:static\s+)?function\s+\w+\s*\([^)]*\)",
+    ],
+    ".html": [
+        r"<title>[^<]*</title>",
+        r"<script[^>]+src=[\"'][^\"']+[\"']",
+        r"<form[^>]*>",
+    ],
+    ".css": [
+        r"^[^\s{}@/][^{]*(?=\{)",
+    ],
+}
+SIGNATURE_PATTERNS[".ts"] = SIGNATURE_PATTERNS[".js"] + [
+    r"^\s*(?:export\s+)?(?:interface|type|enum)\s+\w+",
+]
+SIGNATURE_PATTERNS[".cpp"] = SIGNATURE_PATTERNS[".c"] + [r"^\s*class\s+\w+[^{;]*"]
+SIGNATURE_PATTERNS[".h"] = SIGNATURE_PATTERNS[".cpp"]
+
+IMPORT_PATTERNS = {
+    ".js": r"(?:import\s+(?:[^'\"]*?\s+from\s+)?|require\(\s*)['\"]([^'\"]+)['\"]",
+    ".go": r"^\s*(?:import\s+)?(?:\w+\s+)?\"([^\"]+)\"",
+    ".java": r"^\s*import\s+(?:static\s+)?([\w.]+)",
+    ".c": r"^\s*#include\s+[<\"]([^>\"]+)[>\"]",
+    ".rb": r"^\s*require(?:_relative)?\s+['\"]([^'\"]+)['\"]",
+    ".php": r"^\s*(?:use\s+([\w\\\\]+)|(?:require|include)(?:_once)?\s*\(?\s*['\"]([^'\"]+)['\"])",
+    ".html": r"<(?:script|link)[^>]+(?:src|href)=[\"']([^\"']+)[\"']",
+}
+IMPORT_PATTERNS[".ts"] = IMPORT_PATTERNS[".js"]
+IMPORT_PATTERNS[".cpp"] = IMPORT_PATTERNS[".c"]
+IMPORT_PATTERNS[".h"] = IMPORT_PATTERNS[".c"]
+
+def estimate_tokens(text):
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+def _python_outline(text):
+    """Return (signatures, imports) for Python source using ast."""
+    tree = ast.parse(text)
+    signatures = []
+    imports = []
+
+    def describe_function(node, indent=""):
+        prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+        return f"{indent}{prefix} {node.name}({ast.unparse(node.args)})"
+
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            signatures.append(describe_function(node))
+        elif isinstance(node, ast.ClassDef):
+            bases = ", ".join(ast.unparse(base) for base in node.bases)
+            signatures.append(f"class {node.name}({bases})" if bases else f"class {node.name}")
+            for child in node.body:
+                if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    signatures.append(describe_function(child, indent="    "))
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            module = "." * node.level + (node.module or "")
+            if node.module:
+                imports.append(module)
+            # "from pkg import mod" may import a module as well as a name
+            imports.extend(f"{module}.{alias.name}" if node.module else f"{module}{alias.name}"
+                           for alias in node.names)
+    return signatures, imports
+
+def extract_outline(path, text):
+    """
+    Return (signatures, imports) for a source file: function/class
+    signatures via ast for Python and regexes for the other languages.
+    """
+    _, ext = os.path.splitext(path)
+    ext = ext.lower()
+    if ext == ".py":
+        try:
+            return _python_outline(text)
+        except (SyntaxError, ValueError):
+            pass
+        signatures = [m.group(0).rstrip(":").rstrip() for m in
+                      re.finditer(r"^\s*(?:async\s+)?(?:def|class)\s+\w+[^:\n]*", text, re.M)]
+        imports = re.findall(r"^\s*(?:from\s+([\w.]+)\s+import|import\s+([\w.]+))", text, re.M)
+        return signatures, [a or b for a, b in imports]
+
+    signatures = []
+    for pattern in SIGNATURE_PATTERNS.get(ext, []):
+        for match in re.finditer(pattern, text, re.M):
+            line = " ".join(match.group(0).split())
+            if line and line not in signatures:
+                signatures.append(line)
+    imports = []
+    if ext in IMPORT_PATTERNS:
+        for match in re.finditer(IMPORT_PATTERNS[ext], text, re.M):
+            name = next((group for group in match.groups() if group), None)
+            if name:
+                imports.append(name)
+    return signatures, imports
+
+def _module_key(name):
+    """Reduce an import or path to the bare module name used for matching."""
+    name = name.replace("\\", "/").rstrip("/").rsplit("/", 1)[-1]
+    stem, ext = os.path.splitext(name)
+    if ext.lower() in DEFAULT_INCLUDE_EXTS:
+        name = stem
+    return name.rsplit(".", 1)[-1].lower()
+
+# Signature lines and import names kept per file
+OUTLINE_MAX_SIGNATURES = 40
+OUTLINE_MAX_IMPORTS = 100
+
+class FileOutline:
+    """
+    What the packer keeps of a file: path, size, signatures, imports and
+    first lines. Built as soon as a file is fetched so its text can be freed.
+    """
+
+    def __init__(self, path, size, signatures=None, imports=None, preview=None, readable=True):
+        self.path = path
+        self.size = size
+        self.signatures = signatures or []
+        self.imports = imports or []
+        self.preview = preview or []
+        self.readable = readable
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+    @classmethod
+    def from_file(cls, f):
+        if f.note or not f.text:
+            return cls(f.path, f.size, readable=False)
+        signatures, imports = extract_outline(f.path, f.text)
+        preview = []
+        for line in f.text.splitlines():
+            if line.strip():
+                preview.append(line.strip()[:120])
+                if len(preview) == 3:
+                    break
+        signatures = [line[:120] for line in signatures[:OUTLINE_MAX_SIGNATURES]]
+        return cls(f.path, f.size, signatures, sorted(set(imports))[:OUTLINE_MAX_IMPORTS], preview)
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'size': self.size,
+            'signatures': self.signatures,
+            'imports': self.imports,
+            'preview': self.preview,
+            'readable': self.readable
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+def rank_files(files):
+    """
+    Order files (RepoFiles or FileOutlines) by how informative they are
+    likely to be: entry points first, then modules imported by many other
+    files, then shallow and reasonably sized files.
+    Returns a list of (outline, score).
+    """
+    outlines = []
+    import_counts = {}
+    for f in files:
+        outline = f if isinstance(f, FileOutline) else FileOutline.from_file(f)
+        if not outline.readable:
+            continue
+        outlines.append(outline)
+        for key in {_module_key(name) for name in outline.imports}:
+            import_counts[key] = import_counts.get(key, 0) + 1
+
+    ranked = []
+    for outline in outlines:
+        stem = os.path.splitext(outline.filename)[0].lower()
+        depth = outline.path.count("/")
+        score = 0.0
+        if stem in ENTRY_POINT_NAMES:
+            score += 10
+        score += 3 * import_counts.get(stem, 0)
+        score += min(math.log1p(outline.size), 10) * 0.5
+        score += min(len(outline.signatures), 20) * 0.25
+        score -= depth
+        lowered = outline.path.lower()
+        if stem.startswith("test") or stem.endswith("_test") or "/test" in "/" + lowered:
+            score -= 8
+        ranked.append((outline, score))
+    ranked.sort(key=lambda item: (-item[1], item[0].path))
+    return ranked
+
+def _outline_lines(outline):
+    """A file's packed representation: its path, then its signatures (or first lines)."""
+    body = outline.signatures or outline.preview
+    return [f"# {outline.path}"] + ["  " + line for line in body]
+
+def pack_context(files, token_budget=None):
+    """
+    Pack the most informative parts of a repository into `token_budget`
+    tokens (default TRAINIUM_CONTEXT_TOKENS): a one-line overview, then for
+    each file in rank order its path and function/class signatures (or the
+    first lines of the file when it has none), until the budget runs out.
+    Returns (packed_text, stats).
+    """
+    if token_budget is None:
+        token_budget = TRAINIUM_CONTEXT_TOKENS
+    char_budget = int(token_budget * CHARS_PER_TOKEN)
+    ranked = rank_files(files)
+
+    ext_counts = {}
+    for f in files:
+        ext = os.path.splitext(f.path)[1].lower()
+        ext_counts[ext] = ext_counts.get(ext, 0) + 1
+    overview = f"{len(files)} files (" + ", ".join(
+        f"{ext or 'other'}: {count}" for ext, count in sorted(ext_counts.items(), key=lambda kv: -kv[1])
+    ) + ")"
+    lines = [overview[:char_budget]]
+    used = len(lines[0])
+    packed_files = 0
+
+    for outline, _ in ranked:
+        block = _outline_lines(outline)
+        if used + len(block[0]) + 1 > char_budget:
+            break
+        packed_files += 1
+        for line in block:
+            if used + len(line) + 1 > char_budget:
+                break
+            lines.append(line)
+            used += len(line) + 1
+
+    packed = "\n".join(lines)
+    stats = {
+        'files': len(files),
+        'ranked_files': len(ranked),
+        'packed_files': packed_files,
+        'token_budget': token_budget,
+        'tokens': estimate_tokens(packed)
+    }
+    return packed, stats
+
+def split_into_chunks(files, token_budget=None, max_chunks=None):
+    """
+    Split a repository into endpoint-sized chunks for map-reduce analysis.
+    The most informative files (in rank order) are kept until max_chunks
+    chunks would be full, then their outlines are laid out in path order so
+    that editing one file only changes the chunk that contains it.
+    """
+    if token_budget is None:
+        token_budget = TRAINIUM_CONTEXT_TOKENS
+    if max_chunks is None:
+        max_chunks = TRAINIUM_MAX_CHUNKS
+    char_budget = int(token_budget * CHARS_PER_TOKEN)
+
+    selected = []
+    total = 0
+    for outline, _ in rank_files(files):
+        block = "\n".join(_outline_lines(outline))[:char_budget]
+        if total + len(block) + 1 > char_budget * max_chunks:
+            break
+        selected.append((outline.path, block))
+        total += len(block) + 1
+    # Chunks laid out in path order are not filled completely, so drop the
+    # least informative files until the layout fits in max_chunks
+    while True:
+        chunks = _layout_chunks([block for _, block in sorted(selected)], char_budget)
+        if len(chunks) <= max_chunks:
+            return chunks
+        selected.pop()
+
+def _layout_chunks(blocks, char_budget):
+    """Fill chunks of at most char_budget characters with blocks, in order."""
+    chunks = []
+    current = []
+    used = 0
+    for block in blocks:
+        if current and used + len(block) + 1 > char_budget:
+            chunks.append("\n".join(current))
+            current = []
+            used = 0
+        current.append(block)
+        used += len(block) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+MERMAID_PROMPT_TEMPLATE = """You are an expert at creating valid Mermaid diagrams for software architecture.
+
+Given the following codebase explanation, create a SIMPLE and VALID Mermaid flowchart.
+
+CRITICAL RULES:
+1. Start with: graph TB
+2. Use SIMPLE node IDs (no spaces, no special chars): A, B, C, App, DB, API
+3. Use square brackets for labels: A[Label Text]
+4. For databases use: DB[(Database Name)]
+5. Simple arrows only: A --> B
+6. Keep labels SHORT (max 20 chars per line)
+7. NO line breaks in labels
+8. NO special characters in node IDs
+9. Maximum 10-15 nodes
+10. Test each line is valid Mermaid syntax
+
+Codebase Explanation:
+{explanation}
+
+Generate ONLY valid Mermaid code. Start with 'graph TB' and keep it SIMPLE."""
+
+# Used when the router skips Trainium: Gemini reads the packed code outlines directly
+MERMAID_CODE_PROMPT_TEMPLATE = MERMAID_PROMPT_TEMPLATE.replace(
+    "Given the following codebase explanation", "Given the following outline of a codebase's files"
+).replace("Codebase Explanation:\n{explanation}", "Codebase Outline:\n{explanation}")
+
+class ResultCache:
+    """
+    Memoizes model outputs keyed on (model name, normalized prompt).
+    An in-memory LRU tier answers repeat requests without I/O; an optional
+    SQLite file (db_path) keeps results across restarts and workers.
+    Entries expire after ttl seconds and each tier holds at most max_entries.
+    With max_bytes the memory tier also holds at most that many characters
+    of values; a larger value is kept on disk only.
+    Caches sharing one SQLite file should use different `table` names.
+    """
+
+    def __init__(self, max_entries=1024, ttl=86400, db_path=None, table="results", max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self.table = table
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (created, value), least recently used first
+        self._memory_bytes = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def normalize_prompt(prompt):
+        """Ignore differences in line endings and trailing/surrounding whitespace."""
+        lines = prompt.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        return "\n".join(line.rstrip() for line in lines).strip()
+
+    @classmethod
+    def make_key(cls, model_name, prompt):
+        normalized = cls.normalize_prompt(prompt)
+        return hashlib.sha256(f"{model_name}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+                self._forget(key)
+            if self._db is not None:
+                row = self._db.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    self._db.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._remember(key, row[1], row[0])
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            if self._db is not None:
+                self._db.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now)
+                )
+                if self.ttl is not None:
+                    self._db.execute(f"DELETE FROM {self.table} WHERE created < ?", (now - self.ttl,))
+                self._db.execute(
+                    f"DELETE FROM {self.table} WHERE key NOT IN "
+                    f"(SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+                self._db.commit()
+
+    def _remember(self, key, created, value):
+        """Insert into the memory tier and evict LRU entries (lock held)."""
+        self._forget(key)
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+        self._memory[key] = (created, value)
+        self._memory_bytes += len(value)
+        while len(self._memory) > self.max_entries or \
+                (self.max_bytes is not None and self._memory_bytes > self.max_bytes):
+            self._memory_bytes -= len(self._memory.popitem(last=False)[1][1])
+
+    def _forget(self, key):
+        """Drop a key from the memory tier (lock held)."""
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= len(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self._db is not None:
+                self._db.execute(f"DELETE FROM {self.table}")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                'entries': len(self._memory),
+                'max_entries': self.max_entries,
+                'memory_bytes': self._memory_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'persistent': self._db is not None,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0
+            }
+
+class _Flight:
+    """One in-flight call: its result plus the progress events published so far."""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.events = []
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def publish(self, stage, **info):
+        with self.lock:
+            self.events.append((stage, info))
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(stage, **info)
+
+    def subscribe(self, listener):
+        """Replay the events so far to listener, then forward new ones."""
+        with self.lock:
+            events = list(self.events)
+            self.listeners.append(listener)
+        for stage, info in events:
+            listener(stage, **info)
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs
+    fn(publish) and the others wait for and share its result (or its
+    exception). Progress sent to publish(stage, **info) reaches every
+    caller's on_progress, including the events before it joined.
+    Returns (result, coalesced).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.leaders = 0
+        self.followers = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn, on_progress=None):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
             else:
-                text = resp.text
-                indented = "\n".join("     " + line for line in text.splitlines())
-                indented = indented[:50]
-                output_lines.append(indented)
+                self.followers += 1
+        if on_progress is not None:
+            flight.subscribe(on_progress)
+        if not leader:
+            metrics.inc("coalesced_requests_total", kind=self.name)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn(flight.publish)
+            return flight.result, False
         except Exception as e:
-            output_lines.append(f"     [Error fetching raw {filename}: {e}]")
-        output_lines.append("")
-    return "\n".join(output_lines)
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'coalesced': self.followers
+            }
+
+# Mermaid result cache (RESULT_CACHE_DB enables the persistent SQLite tier)
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '1024'))
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', '86400'))
+RESULT_CACHE_DB = os.environ.get('RESULT_CACHE_DB') or None
+mermaid_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL, RESULT_CACHE_DB)
+# ETags and bodies of GitHub API answers, revalidated with If-None-Match. Tree
+# listings can be megabytes, so the memory tier is bounded by size as well
+github_etag_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, None, RESULT_CACHE_DB, table="github_etags",
+                                max_bytes=GITHUB_ETAG_MEMORY_BYTES)
+mermaid_flight = SingleFlight("diagram")
+
+def clean_mermaid_output(text):
+    """Strip markdown code fences Gemini sometimes wraps around the diagram."""
+    mermaid_code = text.strip()
+    if mermaid_code.startswith('```mermaid'):
+        mermaid_code = mermaid_code.replace('```mermaid', '').replace('```', '').strip()
+    elif mermaid_code.startswith('```'):
+        mermaid_code = mermaid_code.replace('```', '').strip()
+    return mermaid_code
+
+# Mermaid validation and repair for the `graph TB` flowchart subset the
+# prompt asks for. Common faults are fixed locally and deterministically;
+# the model is only asked for a targeted fix when the diagram still fails.
+MERMAID_MAX_LABEL_CHARS = int(os.environ.get('MERMAID_MAX_LABEL_CHARS', '40'))
+MERMAID_HEADER_RE = re.compile(r'^(?:graph|flowchart)(?:\s+(TB|TD|BT|RL|LR))?$', re.IGNORECASE)
+MERMAID_ID_RE = re.compile(r'^[A-Za-z0-9_]+$')
+MERMAID_RESERVED_IDS = {'end', 'graph', 'subgraph', 'flowchart', 'style', 'class', 'classdef', 'click',
+                        'linkstyle', 'direction'}
+MERMAID_PASSTHROUGH_RE = re.compile(r'^(classDef|class|style|linkStyle|click|direction)\b')
+# Edge operators, optionally with a |label|. Heads are arrows (>), circles
+# (o) or crosses (x); o/x heads must be followed by a space or a label, so
+# they are not mistaken for the start of the next node's ID.
+MERMAID_HEAD = r'(?:>|[ox](?=[\s|]))'
+MERMAID_ARROW_RE = re.compile(r'\s*((?:<|[ox](?=[-=]))?(?:-\.+-' + MERMAID_HEAD + r'?|={2,}' + MERMAID_HEAD +
+                              r'|={3,}|-{2,}' + MERMAID_HEAD + r'|-{3,}))\s*(?:\|([^|]*)\|)?\s*')
+# The "A -- label --> B" edge form
+MERMAID_TEXT_ARROW_RE = re.compile(r'\s*(?:--|==)\s+([^\[\](){}|"]+?)\s+(-{2,}' + MERMAID_HEAD + r'|-{3,}|={2,}' +
+                                   MERMAID_HEAD + r'|={3,})\s*')
+MERMAID_OPEN_EDGE_RE = re.compile(r'(?:-{2,}[>ox]|-{3,}|={2,}[>ox]|-\.+-[>ox]?)\s*(?:\|[^|]*\|)?\s*$')
+# Node shapes as (opening, closing), longest openings first; ">" is the
+# asymmetric flag shape (B>flag]), an opening only right after an ID
+MERMAID_SHAPES = [('[(', ')]'), ('((', '))'), ('([', '])'), ('[[', ']]'), ('{{', '}}'),
+                  ('[', ']'), ('(', ')'), ('{', '}'), ('>', ']')]
+# Arrow-like text left in a node ID: an edge form the parser does not know
+MERMAID_STRAY_EDGE_RE = re.compile(r'[-=]{2}|[-=.][<>]|[<>][-=]')
+MERMAID_SAFE_LABEL_RE = re.compile(r"^[\w .,:/'+-]+$")
+# A node's class, as in A:::highlight or A[Label]:::highlight
+MERMAID_CLASS_RE = re.compile(r':::([A-Za-z_][\w-]*)$')
+
+def _opens(text, i):
+    """Whether text[i] opens a node shape: a bracket, or the '>' of a flag right after an ID."""
+    ch = text[i]
+    return ch in '[({' or (ch == '>' and i > 0 and (text[i - 1].isalnum() or text[i - 1] == '_'))
+
+def _bracket_depth(text):
+    """Open bracket count at the end of text (ignoring quoted parts), or -1 inside quotes."""
+    depth = 0
+    quoted = False
+    for i, ch in enumerate(text):
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted:
+            if _opens(text, i):
+                depth += 1
+            elif ch in '])}':
+                depth = max(0, depth - 1)
+    return -1 if quoted else depth
+
+def _split_top_level(text, separator):
+    """Split text at `separator` characters outside brackets and quotes."""
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    for i, ch in enumerate(text):
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted:
+            if _opens(text, i):
+                depth += 1
+            elif ch in '])}':
+                depth = max(0, depth - 1)
+            elif ch == separator and depth == 0:
+                parts.append(text[start:i])
+                start = i + 1
+    parts.append(text[start:])
+    return parts
+
+def _split_edges(text):
+    """
+    Split a statement at its top-level edge operators.
+    Returns (node groups, edges) where edges are (arrow, label or None).
+    """
+    groups = []
+    edges = []
+    depth = 0
+    quoted = False
+    start = 0
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted:
+            if _opens(text, i):
+                depth += 1
+            elif ch in '])}':
+                depth = max(0, depth - 1)
+            elif depth == 0 and ch in ' -=<':
+                m = MERMAID_TEXT_ARROW_RE.match(text, i)
+                if m:
+                    edges.append((m.group(2), m.group(1)))
+                else:
+                    m = MERMAID_ARROW_RE.match(text, i)
+                    if m:
+                        edges.append((m.group(1), m.group(2)))
+                if m:
+                    groups.append(text[start:i])
+                    i = start = m.end()
+                    continue
+        i += 1
+    groups.append(text[start:])
+    return groups, edges
+
+def _parse_node(part):
+    """
+    Parse 'ID', 'ID[Label]' or '[Label]', each optionally followed by
+    ':::className', into (raw id, shape, label, class name, fixes).
+    Raises ValueError when the text is not a node, including an ID that
+    still contains an edge operator the parser does not understand.
+    """
+    part = part.strip()
+    m = MERMAID_CLASS_RE.search(part)
+    class_name = m.group(1) if m else None
+    if m:
+        part = part[:m.start()].rstrip()
+    if not part:
+        raise ValueError("missing node")
+    idx = next((i for i in range(len(part)) if _opens(part, i)), None)
+    raw_id = part if idx is None else part[:idx].strip()
+    if MERMAID_STRAY_EDGE_RE.search(raw_id):
+        raise ValueError(f"unrecognized edge in '{raw_id}'")
+    if idx is None:
+        return part, None, None, class_name, []
+    rest = part[idx:]
+    for opening, closing in MERMAID_SHAPES:
+        if rest.startswith(opening):
+            break
+    body = rest[len(opening):]
+    fixes = []
+    if body.endswith(closing):
+        label = body[:-len(closing)]
+    else:
+        label = body.rstrip(')]}')
+        fixes.append(f"closed the label of {raw_id or 'a node'}")
+    inner = label.strip()
+    if not (len(inner) >= 2 and inner[0] == inner[-1] == '"') and re.search(re.escape(closing) + r'\s+\S', inner):
+        # e.g. "A[One] B[Two]": two nodes without an edge
+        raise ValueError(f"unexpected text after node {raw_id or part}")
+    return raw_id, (opening, closing), label, class_name, fixes
+
+def _clean_label(label):
+    """Single-line, quote-safe, length-limited label text."""
+    text = label.strip()
+    if len(text) >= 2 and text[0] == text[-1] == '"':
+        text = text[1:-1]
+    text = re.sub(r'<br\s*/?>|\\n', ' ', text, flags=re.IGNORECASE)
+    text = " ".join(text.replace('"', "'").split())
+    if len(text) > MERMAID_MAX_LABEL_CHARS:
+        text = text[:MERMAID_MAX_LABEL_CHARS - 3].rstrip() + "..."
+    return text
+
+def _render_label(text):
+    return text if MERMAID_SAFE_LABEL_RE.match(text) else f'"{text}"'
+
+def _join_broken_lines(lines, fixes):
+    """Re-join statements split by stray line breaks (open labels or dangling arrows)."""
+    joined = []
+    for line in lines:
+        stripped = line.strip()
+        if joined and stripped and (_bracket_depth(joined[-1]) != 0
+                                    or MERMAID_OPEN_EDGE_RE.search(joined[-1])
+                                    or MERMAID_ARROW_RE.match(stripped) and stripped[0] in '-=<'):
+            joined[-1] = f"{joined[-1].rstrip()} {stripped}"
+            fixes.append("joined a statement split across lines")
+            continue
+        joined.append(line)
+    return joined
+
+def repair_mermaid(code):
+    """
+    Validate Mermaid flowchart code and repair common faults: a missing
+    header, node IDs with spaces or special characters (renamed
+    consistently), reserved words as IDs, line breaks inside labels or
+    statements, unquoted special characters, over-long labels
+    (MERMAID_MAX_LABEL_CHARS) and unbalanced subgraph/end.
+    Returns (code, fixes, errors); errors lists what could not be repaired.
+    """
+    fixes = []
+    errors = []
+    lines = _join_broken_lines(code.replace("\r\n", "\n").replace("\r", "\n").split("\n"), fixes)
+    header = None
+    body = []
+    depth = 0
+    ids = {}
+    nodes = 0
+
+    def node_id(raw_id, label):
+        key = raw_id or f"[{label}]"
+        if key in ids:
+            return ids[key], False
+        new_id = raw_id
+        if not MERMAID_ID_RE.match(raw_id) or raw_id.lower() in MERMAID_RESERVED_IDS:
+            new_id = re.sub(r'\W+', '_', raw_id or label or '').strip('_') or f"N{len(ids) + 1}"
+            if new_id.lower() in MERMAID_RESERVED_IDS:
+                new_id += "_node"
+            if raw_id:
+                fixes.append(f"renamed node '{raw_id}' to {new_id}")
+        taken = set(ids.values())
+        base = new_id
+        suffix = 2
+        while new_id in taken:
+            new_id = f"{base}{suffix}"
+            suffix += 1
+        ids[key] = new_id
+        return new_id, new_id != raw_id
+
+    def render_node(part):
+        raw_id, shape, label, class_name, node_fixes = _parse_node(part)
+        fixes.extend(node_fixes)
+        new_id, renamed = node_id(raw_id, label or "")
+        suffix = f":::{class_name}" if class_name else ""
+        if shape is None:
+            if not renamed:
+                return new_id + suffix
+            # Keep the original text visible when the ID had to change
+            shape, label = ('[', ']'), raw_id
+        cleaned = _clean_label(label)
+        if not cleaned:
+            cleaned = raw_id or new_id
+        rendered = _render_label(cleaned)
+        if rendered != label.strip():
+            fixes.append(f"cleaned the label of {new_id}")
+        return f"{new_id}{shape[0]}{rendered}{shape[1]}{suffix}"
+
+    for number, line in enumerate(lines, 1):
+        text = line.strip()
+        if not text:
+            continue
+        if text.startswith("%%"):
+            body.append((depth, text))
+            continue
+        for statement in _split_top_level(text, ';'):
+            statement = statement.strip()
+            if not statement:
+                continue
+            m = MERMAID_HEADER_RE.match(statement)
+            if m:
+                if header is None and not body:
+                    header = f"graph {(m.group(1) or 'TB').upper()}"
+                    if not m.group(1):
+                        fixes.append("added the TB direction to the header")
+                else:
+                    fixes.append("removed a duplicate header")
+                continue
+            if header is None:
+                header = "graph TB"
+                fixes.append("added the missing 'graph TB' header")
+            first_word = statement.split(None, 1)[0]
+            if first_word == "subgraph":
+                title = statement[len("subgraph"):].strip()
+                m = re.match(r'^([A-Za-z0-9_]+)\s*\[(.*)\]$', title)
+                if MERMAID_ID_RE.match(title):
+                    body.append((depth, f"subgraph {title}"))
+                elif m:
+                    body.append((depth, f"subgraph {m.group(1)} [{_clean_label(m.group(2)).replace('[', '(').replace(']', ')')}]"))
+                else:
+                    name = _clean_label(re.sub(r'[\[\](){}]', ' ', title)) or f"Group {depth + 1}"
+                    body.append((depth, f"subgraph S{number} [{name}]"))
+                    fixes.append(f"gave subgraph '{title}' an ID")
+                depth += 1
+                continue
+            if statement.lower() == "end":
+                if depth == 0:
+                    fixes.append("removed a stray 'end'")
+                    continue
+                depth -= 1
+                body.append((depth, "end"))
+                continue
+            if MERMAID_PASSTHROUGH_RE.match(statement):
+                body.append((depth, statement))
+                continue
+            try:
+                groups, edges = _split_edges(statement)
+                rendered = []
+                for group in groups:
+                    members = [render_node(member) for member in _split_top_level(group, '&')]
+                    nodes += len(members)
+                    rendered.append(" & ".join(members))
+                out = rendered[0]
+                for (arrow, label), node in zip(edges, rendered[1:]):
+                    label = _clean_label(label.replace('|', ' ')) if label else ""
+                    out += f" {arrow}|{_render_label(label)}| {node}" if label else f" {arrow} {node}"
+                body.append((depth, out))
+            except ValueError as e:
+                errors.append(f"line {number}: {e}: {statement}")
+                body.append((depth, statement))
+    while depth > 0:
+        depth -= 1
+        body.append((depth, "end"))
+        fixes.append("closed an unterminated subgraph")
+    if nodes == 0 and not errors:
+        errors.append("the diagram has no nodes")
+    repaired = "\n".join([header or "graph TB"] + ["    " * (level + 1) + text for level, text in body])
+    return repaired, fixes, errors
+
+MERMAID_FIX_PROMPT_TEMPLATE = """This Mermaid flowchart does not parse.
+
+Problems:
+{errors}
+
+Diagram:
+{mermaid}
+
+Fix ONLY these problems. Start with 'graph TB', use simple node IDs (letters, digits, underscores), square-bracket labels and simple arrows (A --> B).
+Generate ONLY the corrected Mermaid code."""
+
+# Static dependency diagrams: the import graph the packer already extracts,
+# collapsed to a readable number of nodes. No model calls, so it is a fast
+# analysis mode and the fallback when Trainium or Gemini fails.
+STATIC_DIAGRAM_MAX_NODES = int(os.environ.get('STATIC_DIAGRAM_MAX_NODES', '15'))
+STATIC_FALLBACK = os.environ.get('STATIC_FALLBACK', '1') != '0'
+STORAGE_HINTS = {"db", "database", "databases", "model", "models", "schema", "schemas", "store", "storage",
+                 "repository", "repositories", "dao", "migrations", "sql"}
+
+def _shared_depth(a, b):
+    """Number of leading folders two paths have in common."""
+    count = 0
+    for x, y in zip(a.split("/")[:-1], b.split("/")[:-1]):
+        if x != y:
+            break
+        count += 1
+    return count
+
+def _import_target(importer, name):
+    """
+    Turn an import name into a repository module path (no extension).
+    Returns (path, exact): exact paths were resolved relative to the
+    importer; the others may sit under a source root (src/, lib/, ...).
+    """
+    ext = os.path.splitext(importer)[1].lower()
+    folder = posixpath.dirname(importer)
+    if ext == ".py":
+        level = len(name) - len(name.lstrip("."))
+        rest = name[level:].replace(".", "/")
+        if not level:
+            return rest, False
+        for _ in range(level - 1):
+            folder = posixpath.dirname(folder)
+        return posixpath.join(folder, rest) if rest else folder, True
+    name = name.replace("\\", "/")
+    if ext == ".java":
+        return name.rstrip(".*").replace(".", "/"), False
+    stem, name_ext = os.path.splitext(name)
+    if name_ext.lower() in DEFAULT_INCLUDE_EXTS or name_ext.lower() in (".jsx", ".tsx", ".mjs"):
+        name = stem
+    if name.startswith("./") or name.startswith("../"):
+        return posixpath.normpath(posixpath.join(folder, name)), True
+    return re.sub(r"^[@~]?/", "", name), False
+
+def _inside_package(folder, packages):
+    """True if folder or one of its parents is a Python package."""
+    while folder:
+        if folder in packages:
+            return True
+        folder = posixpath.dirname(folder)
+    return False
+
+def _go_package(target, packages, importer_folder):
+    """
+    The repository folder a Go import names: the longest folder the import
+    path ends with (the module prefix, e.g. github.com/acme/svc/, is not
+    part of the repository path), or None.
+    """
+    best = None
+    for folder in packages:
+        if folder == importer_folder:
+            continue
+        if (target == folder or target.endswith("/" + folder)) and (best is None or len(folder) > len(best)):
+            best = folder
+    return best
+
+def build_dependency_graph(files):
+    """
+    File-level import graph of FileOutlines (or RepoFiles): A -> B when an
+    import of A resolves to B's module path (or B's folder, for
+    __init__/index files). Relative imports resolve against A's folder;
+    absolute ones may sit under a source root, but never inside a Python
+    package (so `import json` is not flask/json). When several files
+    match, the one closest to A wins; ties are left out rather than
+    guessed. A Go import names a package folder by its full module path
+    and links A to every file of that folder. Returns (paths, edges).
+    """
+    outlines = [f if isinstance(f, FileOutline) else FileOutline.from_file(f) for f in files]
+    outlines = [o for o in outlines if o.readable]
+    modules = {}  # last path component -> [(module path, file path)]
+    packages = set()
+    go_packages = {}  # folder -> [.go file paths]
+    for o in outlines:
+        module, ext = os.path.splitext(o.path)
+        names = [module]
+        stem = posixpath.basename(module).lower()
+        if ext.lower() == ".go":
+            if "/" in o.path:
+                go_packages.setdefault(posixpath.dirname(o.path).lower(), []).append(o.path)
+            continue
+        if "/" in o.path and stem in ("index", "__init__", "mod"):
+            names.append(posixpath.dirname(module))
+        if stem == "__init__":
+            packages.add(posixpath.dirname(o.path).lower())
+        for name in names:
+            modules.setdefault(posixpath.basename(name).lower(), []).append((name.lower(), o.path))
+
+    edges = set()
+    for o in outlines:
+        python = o.path.lower().endswith(".py")
+        go = o.path.lower().endswith(".go")
+        for name in o.imports:
+            target, exact = _import_target(o.path, name)
+            target = target.lower().strip("/")
+            if not target:
+                continue
+            if go:
+                package = _go_package(target, go_packages, posixpath.dirname(o.path).lower())
+                edges.update((o.path, path) for path in go_packages.get(package, []))
+                continue
+            targets = set()
+            for module, path in modules.get(posixpath.basename(target), []):
+                if path == o.path:
+                    continue
+                if module == target:
+                    targets.add(path)
+                elif not exact and module.endswith("/" + target):
+                    if not (python and _inside_package(module[:-len(target) - 1], packages)):
+                        targets.add(path)
+            if not targets:
+                continue
+            best = max(_shared_depth(o.path, path) for path in targets)
+            targets = [path for path in targets if _shared_depth(o.path, path) == best]
+            if len(targets) == 1:
+                edges.add((o.path, targets[0]))
+    return [o.path for o in outlines], sorted(edges)
+
+def _group_key(path, level):
+    folders = path.split("/")[:-1]
+    if level is None or not folders:
+        return path
+    return "/".join(folders[:level])
+
+def collapse_graph(paths, edges, max_nodes=None):
+    """
+    Merge files into folders, using the deepest folder level that fits
+    max_nodes (default STATIC_DIAGRAM_MAX_NODES). If even top-level folders
+    do not fit, only the best connected groups (entry points first) are kept.
+    Returns (groups {key: [paths]}, group edges, omitted group count).
+    """
+    if max_nodes is None:
+        max_nodes = STATIC_DIAGRAM_MAX_NODES
+    depth = max((path.count("/") for path in paths), default=0)
+    finer = None
+    for level in [None] + list(range(depth, 0, -1)):
+        groups = {}
+        for path in paths:
+            groups.setdefault(_group_key(path, level), []).append(path)
+        if len(groups) <= max_nodes:
+            # One or two huge groups (everything under src/) say less than
+            # the best connected groups of the next finer level
+            if finer is not None and len(groups) < max(2, max_nodes // 3):
+                groups = finer
+            break
+        finer = groups
+    owner = {path: key for key, members in groups.items() for path in members}
+    group_edges = sorted({(owner[a], owner[b]) for a, b in edges if owner[a] != owner[b]})
+
+    omitted = 0
+    if len(groups) > max_nodes:
+        score = {key: math.log1p(len(members)) for key, members in groups.items()}
+        for key, members in groups.items():
+            if any(os.path.splitext(os.path.basename(p))[0].lower() in ENTRY_POINT_NAMES for p in members):
+                score[key] += 10
+        for a, b in group_edges:
+            score[a] += 1
+            score[b] += 2
+        keep = set(sorted(groups, key=lambda key: (-score[key], key))[:max_nodes])
+        omitted = len(groups) - len(keep)
+        groups = {key: members for key, members in groups.items() if key in keep}
+        group_edges = [(a, b) for a, b in group_edges if a in keep and b in keep]
+    return groups, group_edges, omitted
+
+def static_analysis(files, max_nodes=None):
+    """
+    Explain and diagram a repository from its import graph alone.
+    Returns (explanation, mermaid, stats).
+    """
+    paths, edges = build_dependency_graph(files)
+    groups, group_edges, omitted = collapse_graph(paths, edges, max_nodes)
+
+    lines = ["graph TB"]
+    ids = {}
+    for key in sorted(groups):
+        members = groups[key]
+        is_file = members == [key]
+        node_id = re.sub(r'\W+', '_', os.path.splitext(key)[0] if is_file else key).strip('_') or "root"
+        while node_id in ids.values() or node_id.lower() in MERMAID_RESERVED_IDS:
+            node_id += "_"
+        ids[key] = node_id
+        label = _clean_label(os.path.basename(key) if is_file else f"{key}/ ({len(members)} files)")
+        words = set(re.split(r'[\W_]+', key.lower()))
+        opening, closing = ("[(", ")]") if words & STORAGE_HINTS else ("[", "]")
+        lines.append(f"    {node_id}{opening}{_render_label(label)}{closing}")
+    for a, b in group_edges:
+        lines.append(f"    {ids[a]} --> {ids[b]}")
+    mermaid_code, _, _ = repair_mermaid("\n".join(lines))
+
+    imported = {}
+    for _, b in group_edges:
+        imported[b] = imported.get(b, 0) + 1
+    entry_points = [key for key in sorted(groups)
+                    if any(os.path.splitext(os.path.basename(p))[0].lower() in ENTRY_POINT_NAMES
+                           for p in groups[key])]
+    explanation = (f"Static import analysis of {len(paths)} files: {len(groups)} components "
+                   f"with {len(group_edges)} {'dependency' if len(group_edges) == 1 else 'dependencies'} "
+                   f"between them.")
+    if entry_points:
+        explanation += f" Entry points: {', '.join(entry_points[:3])}."
+    if imported:
+        top = sorted(imported.items(), key=lambda item: (-item[1], item[0]))[:3]
+        explanation += " Most depended on: " + ", ".join(f"{key} ({count})" for key, count in top) + "."
+    stats = {
+        'files': len(paths),
+        'file_edges': len(edges),
+        'nodes': len(groups),
+        'edges': len(group_edges),
+        'omitted_nodes': omitted
+    }
+    return explanation, mermaid_code, stats
+
+def generate_mermaid(explanation, gemini_model=None, cache=None, deadline=None, template=None):
+    """
+    Convert a codebase explanation to Mermaid code with Gemini.
+    The output is validated and repaired locally (see repair_mermaid); only
+    if it still does not parse is Gemini asked once for a targeted fix.
+    Valid results are memoized in `cache` (default: mermaid_cache), so a
+    repeated explanation skips the model call, and concurrent requests for
+    the same explanation share one call (mermaid_flight). Pass a fake
+    model/cache to run offline. `deadline` (a time.monotonic() value)
+    bounds the Gemini calls; `template` replaces MERMAID_PROMPT_TEMPLATE.
+    """
+    if gemini_model is None:
+        gemini_model = get_gemini_model()
+    if cache is None:
+        cache = mermaid_cache
+    prompt = (template or MERMAID_PROMPT_TEMPLATE).format(explanation=explanation)
+    model_name = getattr(gemini_model, 'model_name', None) or GEMINI_MODEL_NAME
+    key = cache.make_key(model_name, prompt)
+    mermaid_code = cache.get(key)
+    if mermaid_code is not None:
+        return mermaid_code
+    mermaid_code, _ = mermaid_flight.do(key, lambda publish: _generate_mermaid_uncached(prompt, gemini_model,
+                                                                                         cache, key, deadline))
+    return mermaid_code
+
+def _gemini_request_options(deadline=None):
+    """
+    Client-side timeout for one Gemini call (GEMINI_TIMEOUT, or less if the
+    deadline is closer), so a hung request gives its upstream thread back
+    instead of leaving it blocked behind the upstream layer's own timeout.
+    """
+    timeout = GEMINI_TIMEOUT
+    if deadline is not None:
+        timeout = max(0.1, min(timeout, deadline - time.monotonic()))
+    return {"timeout": timeout}
+
+def _generate_mermaid_uncached(prompt, gemini_model, cache, key, deadline=None):
+    """Call Gemini, repair its output and cache it if valid (see generate_mermaid)."""
+    with metrics.timer("gemini_generate"):
+        response = gemini_upstream.call(gemini_model.generate_content, prompt, deadline=deadline,
+                                        request_options=_gemini_request_options(deadline))
+    mermaid_code, fixes, errors = repair_mermaid(clean_mermaid_output(response.text))
+    outcome = "repaired" if fixes else "valid"
+    if errors and deadline is not None and deadline - time.monotonic() < gemini_upstream.estimate():
+        print(f"  Mermaid output invalid after local repair, no time left for a fix: {'; '.join(errors)}")
+        outcome = "invalid"
+    elif errors:
+        print(f"  Mermaid output invalid after local repair, asking for a fix: {'; '.join(errors)}")
+        fix_prompt = MERMAID_FIX_PROMPT_TEMPLATE.format(errors="\n".join(f"- {e}" for e in errors),
+                                                        mermaid=mermaid_code)
+        with metrics.timer("gemini_generate"):
+            response = gemini_upstream.call(gemini_model.generate_content, fix_prompt, deadline=deadline,
+                                            request_options=_gemini_request_options(deadline))
+        fixed_code, _, fixed_errors = repair_mermaid(clean_mermaid_output(response.text))
+        if len(fixed_errors) <= len(errors):
+            mermaid_code, errors = fixed_code, fixed_errors
+        outcome = "invalid" if errors else "model_fixed"
+    elif fixes:
+        print(f"  Repaired Mermaid output: {'; '.join(fixes[:5])}")
+    metrics.inc("mermaid_outputs_total", outcome=outcome)
+    if not errors:
+        cache.put(key, mermaid_code)
+    return mermaid_code
 
 @app.route('/generate-diagram', methods=['POST'])
 def generate_diagram():
@@ -118,200 +2789,1232 @@ def generate_diagram():
         if not explanation:
             return jsonify({'error': 'No explanation provided'}), 400
         
-        # Prompt for Gemini to convert explanation to Mermaid
-        prompt = f"""You are an expert at creating valid Mermaid diagrams for software architecture.
+        # Convert explanation to Mermaid with Gemini (memoized)
+        mermaid_code = generate_mermaid(explanation)
+        
+        return jsonify({
+            'success': True,
+            'mermaid': mermaid_code
+        })
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
 
-Given the following codebase explanation, create a SIMPLE and VALID Mermaid flowchart.
+class AnalysisError(Exception):
+    """A pipeline stage failed; the message is the user-facing error."""
 
-CRITICAL RULES:
-1. Start with: graph TB
-2. Use SIMPLE node IDs (no spaces, no special chars): A, B, C, App, DB, API
-3. Use square brackets for labels: A[Label Text]
-4. For databases use: DB[(Database Name)]
-5. Simple arrows only: A --> B
-6. Keep labels SHORT (max 20 chars per line)
-7. NO line breaks in labels
-8. NO special characters in node IDs
-9. Maximum 10-15 nodes
-10. Test each line is valid Mermaid syntax
+def parse_trainium_response(result):
+    """Extract the generated explanation from a Trainium endpoint response."""
+    if isinstance(result, list) and len(result) > 0:
+        return result[0].get('generated_text', '')
+    elif isinstance(result, dict):
+        return result.get('generated_text', result.get('outputs', ''))
+    return str(result)
 
-Codebase Explanation:
-{explanation}
+# Generation parameters for Trainium, with very conservative limits
+TRAINIUM_PARAMETERS = {
+    "max_new_tokens": 150,  # Further reduced to fit 512-token limit
+    "temperature": 0.7,
+    "do_sample": True
+}
 
-Generate ONLY valid Mermaid code. Start with 'graph TB' and keep it SIMPLE."""
+def _invoke_trainium_raw(inputs, client=None, endpoint=None, deadline=None):
+    """Invoke the Trainium endpoint with one prompt or a list of prompts; return the parsed JSON."""
+    payload = {
+        "inputs": inputs,
+        "parameters": TRAINIUM_PARAMETERS
+    }
+    
+    prompts = inputs if isinstance(inputs, list) else [inputs]
+    metrics.inc("trainium_prompt_chars_total", sum(len(prompt) for prompt in prompts))
+    
+    def invoke():
+        response = (client or get_sagemaker_client()).invoke_endpoint(
+            EndpointName=endpoint or TRAINIUM_ENDPOINT,
+            Body=json.dumps(payload),
+            ContentType="application/json"
+        )
+        
+        # Parse Trainium response (reading the body is covered by the deadline too)
+        return json.loads(response["Body"].read().decode())
+    
+    # Invoke Trainium endpoint with the deadline, retry and circuit breaker policy
+    with metrics.timer("trainium_invoke"):
+        return trainium_upstream.call(invoke, deadline=deadline)
+
+class _BatchItem:
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class TrainiumBatcher:
+    """
+    Micro-batching front for the Trainium endpoint. Prompts submitted by
+    concurrent callers within `window` seconds (up to max_batch_size) are
+    sent as one {"inputs": [...]} request and the list response is split
+    back out to each waiting caller. Up to max_in_flight batches run at once.
+    """
+
+    def __init__(self, window=0.01, max_batch_size=8, max_in_flight=4, client=None, endpoint=None):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.client = client
+        self.endpoint = endpoint
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='trainium-batch')
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = 0
+        self.requests = 0
+        self.errors = 0
+        self.batch_sizes = {}
+
+    def submit(self, prompt, timeout=None):
+        """Queue a prompt and block until its generated text is available."""
+        self._ensure_started()
+        item = _BatchItem(prompt)
+        self._queue.put(item)
+        if not item.done.wait(timeout):
+            raise TimeoutError("Timed out waiting for batched Trainium response")
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._collect, name='trainium-batcher', daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        with self._lock:
+            self.batches += 1
+            self.requests += len(batch)
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+        try:
+            if len(batch) == 1:
+                # A lone prompt goes out in the unbatched payload shape
+                results = [_invoke_trainium_raw(batch[0].prompt, self.client, self.endpoint)]
+            else:
+                results = _invoke_trainium_raw([item.prompt for item in batch], self.client, self.endpoint)
+                if not isinstance(results, list) or len(results) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} results from batched Trainium call, got: {results}")
+            for item, result in zip(batch, results):
+                item.result = parse_trainium_response(result)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            for item in batch:
+                item.error = e
+        finally:
+            for item in batch:
+                item.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'window_ms': self.window * 1000,
+                'max_batch_size': self.max_batch_size,
+                'batches': self.batches,
+                'requests': self.requests,
+                'errors': self.errors,
+                'mean_batch_size': round(self.requests / self.batches, 3) if self.batches else 0.0,
+                'batch_sizes': dict(sorted(self.batch_sizes.items()))
+            }
+
+# Micro-batching for the Trainium endpoint (a window of 0 disables it; the
+# endpoint must accept a list of inputs when enabled)
+TRAINIUM_BATCH_WINDOW_MS = float(os.environ.get('TRAINIUM_BATCH_WINDOW_MS', '0'))
+TRAINIUM_MAX_BATCH_SIZE = int(os.environ.get('TRAINIUM_MAX_BATCH_SIZE', '8'))
+trainium_batcher = (
+    TrainiumBatcher(TRAINIUM_BATCH_WINDOW_MS / 1000, TRAINIUM_MAX_BATCH_SIZE)
+    if TRAINIUM_BATCH_WINDOW_MS > 0 else None
+)
+# Batching used only while /analyze-batch runs are active, for endpoints
+# that accept list inputs but where interactive requests should not wait
+# for a batch window
+BATCH_TRAINIUM_WINDOW_MS = float(os.environ.get('BATCH_TRAINIUM_WINDOW_MS', '0'))
+batch_trainium_batcher = (
+    TrainiumBatcher(BATCH_TRAINIUM_WINDOW_MS / 1000, TRAINIUM_MAX_BATCH_SIZE)
+    if BATCH_TRAINIUM_WINDOW_MS > 0 else None
+)
+_active_batches = 0
+_active_batches_lock = threading.Lock()
+
+def default_trainium_batcher():
+    """trainium_batcher, or batch_trainium_batcher while a batch run is active."""
+    if trainium_batcher is not None:
+        return trainium_batcher
+    return batch_trainium_batcher if _active_batches else None
+
+def invoke_trainium(prompt, client=None, endpoint=None, batcher=None, deadline=None):
+    """
+    Send one prompt to the Trainium endpoint and return the generated text.
+    `client` (default get_sagemaker_client()) only needs an invoke_endpoint method,
+    so a local stub can stand in for SageMaker. Calls on the default client
+    go through the default batcher when batching is enabled (see
+    default_trainium_batcher).
+    """
+    if batcher is None and client is None and endpoint is None:
+        batcher = default_trainium_batcher()
+    if batcher is not None:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        explanation = batcher.submit(prompt, timeout)
+    else:
+        explanation = parse_trainium_response(_invoke_trainium_raw(prompt, client, endpoint, deadline))
+    print(f"  Trainium response: {explanation[:200]}")
+    return explanation
+
+def _trainium_code_prompt(codebase_content):
+    # Prepare VERY SHORT prompt for Trainium (limited to 512 tokens total)
+    return f"""Code analysis:
+
+{codebase_content}
+
+Explain: what does this code do?"""
+
+def _trainium_reduce_prompt(explanations):
+    parts = "\n".join(f"- {explanation}" for explanation in explanations)
+    return f"""Notes on parts of one codebase:
+
+{parts}
+
+Combine the notes: what does this codebase do?"""
+
+def explain_with_trainium(codebase_content, client=None, endpoint=None, deadline=None):
+    """Ask the Trainium endpoint what the (already packed) code does."""
+    return invoke_trainium(_trainium_code_prompt(codebase_content), client, endpoint, deadline=deadline)
+
+# Map-reduce analysis: chunk count and parallel endpoint calls per analysis
+TRAINIUM_MAX_CHUNKS = int(os.environ.get('TRAINIUM_MAX_CHUNKS', '16'))
+TRAINIUM_CONCURRENCY = int(os.environ.get('TRAINIUM_CONCURRENCY', '4'))
+ANALYSIS_MODE = os.environ.get('ANALYSIS_MODE', 'single')
+
+# Per-chunk Trainium results, so re-analysis only re-runs chunks that changed
+trainium_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES * 4, RESULT_CACHE_TTL, RESULT_CACHE_DB, table="trainium_chunks")
+
+def _cached_trainium(prompt, client, endpoint, cache, deadline=None):
+    key = cache.make_key(endpoint or TRAINIUM_ENDPOINT, prompt)
+    explanation = cache.get(key)
+    if explanation is None:
+        explanation = invoke_trainium(prompt, client, endpoint, deadline=deadline)
+        cache.put(key, explanation)
+    return explanation
+
+def explain_chunked(files, token_budget=None, max_chunks=None, max_workers=None,
+                    client=None, endpoint=None, cache=None, deadline=None):
+    """
+    Map-reduce Trainium analysis for repositories larger than one prompt:
+    explain each endpoint-sized chunk in parallel (at most max_workers calls
+    in flight, default TRAINIUM_CONCURRENCY), then merge the partial
+    explanations with reduce prompts, level by level, until one remains.
+    Every map and reduce result is cached by prompt (default trainium_cache).
+    `deadline` (a time.monotonic() value) bounds every endpoint call.
+    Returns (explanation, stats).
+    """
+    if token_budget is None:
+        token_budget = TRAINIUM_CONTEXT_TOKENS
+    if max_workers is None:
+        max_workers = TRAINIUM_CONCURRENCY
+    if cache is None:
+        cache = trainium_cache
+    char_budget = int(token_budget * CHARS_PER_TOKEN)
+    chunks = split_into_chunks(files, token_budget, max_chunks)
+    if not chunks:
+        chunks = [""]
+    hits_before = cache.stats()['memory_hits'] + cache.stats()['disk_hits']
+
+    def run(prompt):
+        return _cached_trainium(prompt, client, endpoint, cache, deadline)
+
+    reduce_calls = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        explanations = list(executor.map(run, [_trainium_code_prompt(chunk) for chunk in chunks]))
+        while len(explanations) > 1:
+            # Cut each note so at least two fit in one reduce prompt
+            notes = [explanation.strip()[:max(1, char_budget // 2 - 3)] for explanation in explanations]
+            groups = []
+            current = []
+            used = 0
+            for note in notes:
+                if len(current) >= 2 and used + len(note) + 3 > char_budget:
+                    groups.append(current)
+                    current = []
+                    used = 0
+                current.append(note)
+                used += len(note) + 3
+            groups.append(current)
+            reduce_calls += len(groups)
+            explanations = list(executor.map(run, [_trainium_reduce_prompt(group) for group in groups]))
+
+    stats = cache.stats()
+    return explanations[0], {
+        'chunks': len(chunks),
+        'reduce_calls': reduce_calls,
+        'cached_calls': stats['memory_hits'] + stats['disk_hits'] - hits_before
+    }
+
+# Incremental re-analysis: the last analysis of each repository branch (tree
+# listing, per-file outlines, explanation and Mermaid) is kept, so a new
+# request only downloads changed blobs and skips the models when the
+# Trainium input did not change. A snapshot of a large repository is over a
+# megabyte, so the memory tier is bounded by size as well
+INCREMENTAL_ANALYSIS = os.environ.get('INCREMENTAL_ANALYSIS', '1') != '0'
+ANALYSIS_STORE_MEMORY_BYTES = int(os.environ.get('ANALYSIS_STORE_MEMORY_BYTES', str(64 * 1024 * 1024)))
+analysis_store = ResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL, RESULT_CACHE_DB, table="analyses",
+                             max_bytes=ANALYSIS_STORE_MEMORY_BYTES)
+
+def _snapshot_key(repo_url, branch):
+    return f"{normalize_repo_url(repo_url)}@{branch}"
+
+def load_snapshot(key, store=None):
+    """The stored analysis snapshot for a repository branch, or None."""
+    value = (store or analysis_store).get(key)
+    return json.loads(value) if value else None
+
+def save_snapshot(key, snapshot, store=None):
+    (store or analysis_store).put(key, json.dumps(snapshot))
+
+def diff_trees(old, new):
+    """Compare two {path: blob SHA} listings. Returns added/modified/removed counts."""
+    return {
+        'added': sum(1 for path in new if path not in old),
+        'modified': sum(1 for path, sha in new.items() if path in old and old[path] != sha),
+        'removed': sum(1 for path in old if path not in new)
+    }
+
+def _analysis_settings(analysis_mode, context_tokens, plan):
+    """Everything besides the tree that determines an analysis result."""
+    return {
+        'analysis_mode': analysis_mode,
+        'context_tokens': context_tokens or TRAINIUM_CONTEXT_TOKENS,
+        'endpoint': TRAINIUM_ENDPOINT,
+        'max_file_size': plan.max_file_size,
+        'include_globs': plan.include_globs,
+        'exclude_globs': plan.exclude_globs,
+        'max_files': plan.max_files
+    }
+
+def _material_fingerprint(files, codebase_content, analysis_mode, context_tokens):
+    """Hash of the exact analysis input: equal fingerprints give the same explanation."""
+    if analysis_mode == 'static':
+        material = [f"{f.path}:{','.join(f.imports)}" for f in files if f.readable]
+    elif analysis_mode == 'chunked':
+        material = split_into_chunks(files, context_tokens)
+    else:
+        material = [codebase_content]
+    digest = hashlib.sha256(f"{analysis_mode}\0{TRAINIUM_ENDPOINT}".encode("utf-8"))
+    for part in material:
+        digest.update(b"\0" + part.encode("utf-8"))
+    return digest.hexdigest()
+
+# Latency budgets: a synchronous request may carry a deadline ("deadline_ms",
+# default ANALYZE_DEADLINE_MS, 0 for none). The router picks the most complete
+# path whose estimated latency fits in the time left; background jobs and
+# batches have no deadline and always run the full chain.
+ANALYZE_DEADLINE_MS = float(os.environ.get('ANALYZE_DEADLINE_MS', '0'))
+
+def request_deadline(deadline_ms):
+    """time.monotonic() deadline for a budget in milliseconds, or None for no budget."""
+    deadline_ms = float(deadline_ms or 0)
+    return time.monotonic() + deadline_ms / 1000 if deadline_ms > 0 else None
+
+def trainium_rounds(files, analysis_mode, context_tokens=None):
+    """Sequential Trainium calls the explanation needs (chunked: map waves plus reduce levels)."""
+    if analysis_mode != 'chunked':
+        return 1
+    chunks = len(split_into_chunks(files, context_tokens)) or 1
+    if chunks == 1:
+        return 1
+    return math.ceil(chunks / max(1, TRAINIUM_CONCURRENCY)) + math.ceil(math.log2(chunks))
+
+def plan_route(deadline, rounds=1, has_stored=False):
+    """
+    Choose how to answer before `deadline` (a time.monotonic() value, or
+    None): 'full' (Trainium explains, Gemini diagrams), 'direct' (Gemini
+    diagrams the packed code, the explanation comes from the import graph),
+    'cached' (the stored result, if has_stored) or 'static'. Each model path
+    is costed with the upstreams' live latency estimates, Trainium for
+    `rounds` sequential calls, and ruled out while its circuit is open or
+    when it is not configured (and no client was assigned).
+    Returns {'path', 'reason', 'remaining_ms', 'estimates_ms'}.
+    """
+    def cost(upstream, client, config_error, calls=1):
+        if upstream.state == "open" or (client is None and config_error()):
+            return None
+        return calls * (upstream.estimate() or 0.0)
+
+    trainium = cost(trainium_upstream, sagemaker_client, trainium_config_error, rounds)
+    gemini = cost(gemini_upstream, model, gemini_config_error)
+    estimates = {
+        'full': trainium + gemini if trainium is not None and gemini is not None else None,
+        'direct': gemini
+    }
+    remaining = deadline - time.monotonic() if deadline is not None else None
+
+    def fits(path):
+        return estimates[path] is not None and (remaining is None or estimates[path] <= remaining)
+
+    if fits('full'):
+        path, reason = 'full', 'no deadline' if remaining is None else 'full chain fits the deadline'
+    elif fits('direct'):
+        path, reason = 'direct', 'Trainium unavailable' if trainium is None else 'full chain would miss the deadline'
+    else:
+        path = 'cached' if has_stored else 'static'
+        reason = 'models unavailable' if remaining is None else 'no model path fits the deadline'
+    metrics.inc("analysis_routes_total", path=path)
+    return {
+        'path': path,
+        'reason': reason,
+        'remaining_ms': round(1000 * remaining) if remaining is not None else None,
+        'estimates_ms': {k: round(1000 * v) if v is not None else None for k, v in estimates.items()}
+    }
+
+@contextmanager
+def _timed(timings, stage):
+    """Add the wall time of the block to timings[stage], in milliseconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = round(timings.get(stage, 0) + 1000 * (time.perf_counter() - start), 1)
+
+def _degraded_result(stored, files):
+    """(fallback, explanation, mermaid, static stats): the stored result if any, else the static diagram."""
+    if stored is not None:
+        return 'cached', stored['result']['explanation'], stored['result']['mermaid'], None
+    explanation, mermaid_code, static_stats = static_analysis(files)
+    return 'static', explanation, mermaid_code, static_stats
+
+def run_analysis(repo_url, ingest_mode=None, on_progress=None, context_tokens=None, analysis_mode=None,
+                 plan=None, incremental=None, deadline=None):
+    """
+    Run the full /analyze-url pipeline: scrape the repository, pack it into
+    the Trainium context budget (context_tokens, default
+    TRAINIUM_CONTEXT_TOKENS), explain it with Trainium, then turn the
+    explanation into Mermaid with Gemini.
+    analysis_mode 'chunked' (default ANALYSIS_MODE) explains the repository
+    in map-reduce chunks instead of one packed prompt, and 'static' draws
+    the import graph without any model call (see static_analysis). If
+    Trainium or Gemini fails (after the retries of the upstream layer, or
+    at once while its circuit is open), the last stored result for the
+    repository with the same settings is returned with 'fallback':
+    'cached', or else the static
+    diagram with 'fallback': 'static' (unless STATIC_FALLBACK is off).
+    `plan` (default: a FetchPlan with the FETCH_* settings) selects the
+    files to download; its decisions are returned under 'plan'.
+    With incremental (default INCREMENTAL_ANALYSIS) the new tree is diffed
+    against the stored snapshot by blob SHA: an unchanged tree returns the
+    stored result, only changed files are downloaded and outlined, and
+    Trainium and Gemini are skipped when the packed input is unchanged.
+    What was reused is reported under 'incremental'.
+    With a `deadline` (a time.monotonic() value) plan_route picks the model
+    path that fits the time left and model calls stop at the deadline; the
+    path is returned under 'route' and the time of each stage under
+    'timings_ms'. Direct-path results are not stored for later reuse.
+    `on_progress(stage, **info)` is called as each stage starts and finishes.
+    Raises AnalysisError if a stage fails.
+    """
+    def progress(stage, **info):
+        if on_progress is not None:
+            on_progress(stage, **info)
+
+    timings = {}
+    started = time.perf_counter()
+
+    def finish(result, route):
+        timings['total'] = round(1000 * (time.perf_counter() - started), 1)
+        return dict(result, incremental=incremental_stats, route=route, timings_ms=timings)
+
+    print(f"Analyzing repository: {repo_url}")
+    
+    # STEP 1: Scrape the GitHub repository
+    print("Step 1: Fetching code from GitHub...")
+    progress('fetching')
+
+    def on_file(count, total):
+        # Report roughly every 2% of the files (or every 25 when the total is unknown)
+        step = max(1, total // 50) if total else 25
+        if count % step == 0 or count == total:
+            progress('files', fetched=count, total=total)
 
-        # Call Gemini API
-        response = model.generate_content(prompt)
-        mermaid_code = response.text.strip()
+    if plan is None:
+        plan = FetchPlan(max_file_size=100000)
+    analysis_mode = analysis_mode or ANALYSIS_MODE
+    ingest_mode = ingest_mode or INGEST_MODE
+    if incremental is None:
+        incremental = INCREMENTAL_ANALYSIS
+    settings = _analysis_settings(analysis_mode, context_tokens, plan)
+
+    branch = tree = previous = snapshot_key = None
+    listing = {}
+    if incremental:
+        try:
+            local_path = local_repo_path(repo_url)
+            if local_path is not None:
+                with _timed(timings, 'tree'):
+                    branch, tree = resolve_local_tree(local_path)
+            elif allowed_local_path(repo_url) is None:
+                # (a local archive has no tree listing to diff against)
+                with _timed(timings, 'tree'):
+                    branch, tree = resolve_github_tree(repo_url)
+        except (RepoFetchError, requests.RequestException, CircuitOpenError) as e:
+            print(f"  Incremental analysis unavailable: {e}")
+    if tree is not None:
+        snapshot_key = _snapshot_key(repo_url, branch)
+        listing = {item.get("path"): item.get("sha") for item in tree.get("tree", []) if item.get("type") == "blob"}
+        # A snapshot made with other settings (e.g. static mode) is neither reused nor a fallback
+        previous = load_snapshot(snapshot_key)
+        if previous is not None and previous['settings'] != settings:
+            previous = None
+    incremental_stats = {
+        'enabled': tree is not None,
+        'branch': branch,
+        'tree_sha': tree.get("sha") if tree else None,
+        'previous_tree_sha': previous['tree_sha'] if previous else None,
+        'reused_summaries': 0,
+        'reused_result': False
+    }
+    if previous is not None:
+        incremental_stats.update(diff_trees(previous['files'], listing))
+        if incremental_stats['tree_sha'] and previous['tree_sha'] == incremental_stats['tree_sha']:
+            # Same tree and settings: nothing to fetch or explain
+            print(f"  Tree {previous['tree_sha'][:12]} unchanged, reusing stored analysis")
+            metrics.inc("incremental_reuse_total", level="tree")
+            result = previous['result']
+            incremental_stats['reused_result'] = True
+            incremental_stats['reused_summaries'] = len(previous['outlines'])
+            progress('fetched', files=result['context'].get('files', 0), characters=0,
+                     context=result['context'], plan=result['plan'])
+            progress('explained', explanation=result['explanation'])
+            progress('diagrammed', mermaid=result['mermaid'])
+            return finish(result, {'path': 'reused', 'reason': 'tree unchanged'})
+
+    known = None
+    if previous is not None and (ingest_mode == "raw" or local_repo_path(repo_url) is not None):
+        known = {(path, sha): FileOutline.from_dict(outline)
+                 for path, (sha, outline) in previous['outlines'].items()}
+
+    try:
+        # Files are reduced to outlines as they stream in, so only one file's
+        # text per fetch worker is held in memory at a time. Outlines of
+        # unchanged blobs come from the previous snapshot without a download.
+        files = []
+        with _timed(timings, 'fetch'):
+            for f in iter_codebase(repo_url, mode=ingest_mode, max_file_size=plan.max_file_size,
+                                   on_file=on_file, plan=plan, branch=branch, tree=tree, known=known):
+                if isinstance(f, FileOutline):
+                    incremental_stats['reused_summaries'] += 1
+                    files.append(f)
+                else:
+                    files.append(FileOutline.from_file(f))
+        fetched_chars = sum(f.size for f in files if f.readable)
+        plan_stats = plan.to_dict()
+        print(f"  Fetched {len(files)} files ({fetched_chars} characters of code), "
+              f"skipped {plan_stats['skipped_files']} ({plan_stats['skipped_bytes']} bytes) before download")
+        if incremental_stats['reused_summaries']:
+            print(f"  Reused {incremental_stats['reused_summaries']} unchanged file summaries")
         
-        # Clean up response (remove markdown code blocks if present)
-        if mermaid_code.startswith('```mermaid'):
-            mermaid_code = mermaid_code.replace('```mermaid', '').replace('```', '').strip()
-        elif mermaid_code.startswith('```'):
-            mermaid_code = mermaid_code.replace('```', '').strip()
+        # Rank files and pack their signatures into the Trainium token budget
+        with metrics.timer("packing"), _timed(timings, 'pack'):
+            codebase_content, context_stats = pack_context(files, context_tokens)
+            fingerprint = _material_fingerprint(files, codebase_content, analysis_mode, context_tokens)
+        print(f"  Packed {context_stats['packed_files']} files into ~{context_stats['tokens']} tokens")
+    except Exception as e:
+        print(f"Error fetching GitHub repo: {str(e)}")
+        raise AnalysisError(f'Failed to fetch repository: {str(e)}')
+    progress('fetched', files=len(files), characters=fetched_chars, context=context_stats, plan=plan_stats)
+    
+    fallback = None
+    if previous is not None and previous['fingerprint'] == fingerprint:
+        # The changes did not touch what Trainium sees: keep the explanation and diagram
+        print("  Packed context unchanged, reusing stored explanation and diagram")
+        metrics.inc("incremental_reuse_total", level="context")
+        incremental_stats['reused_result'] = True
+        route = {'path': 'reused', 'reason': 'packed context unchanged'}
+        trainium_explanation = previous['result']['explanation']
+        mermaid_code = previous['result']['mermaid']
+        context_stats = dict(previous['result']['context'], **context_stats)
+        progress('explained', explanation=trainium_explanation)
+        progress('diagrammed', mermaid=mermaid_code)
+    elif analysis_mode == 'static':
+        # STEP 2: Diagram the import graph locally, without model calls
+        print("Step 2: Building dependency diagram from imports...")
+        progress('explaining')
+        route = {'path': 'static', 'reason': 'static analysis mode'}
+        with metrics.timer("static_analysis"), _timed(timings, 'static'):
+            trainium_explanation, mermaid_code, static_stats = static_analysis(files)
+        context_stats = dict(context_stats, static=static_stats)
+        progress('explained', explanation=trainium_explanation)
+        progress('diagrammed', mermaid=mermaid_code)
+        print(f"✓ Analysis complete for {repo_url} ({static_stats['nodes']} components)")
+    else:
+        route = plan_route(deadline, trainium_rounds(files, analysis_mode, context_tokens), previous is not None)
+        print(f"  Route: {route['path']} ({route['reason']})")
+        progress('explaining')
+        mermaid_code = None
+        if route['path'] in ('cached', 'static'):
+            # No model answers in time: serve the stored result or the import graph
+            with _timed(timings, 'static'):
+                fallback, trainium_explanation, mermaid_code, static_stats = _degraded_result(previous, files)
+            if static_stats is not None:
+                context_stats = dict(context_stats, static=static_stats)
+        elif route['path'] == 'direct':
+            # STEP 2: No time for Trainium: explain from the import graph, diagram the code itself
+            print("Step 2: Skipping Trainium, summarizing imports locally...")
+            with _timed(timings, 'static'):
+                trainium_explanation, _, static_stats = static_analysis(files)
+            context_stats = dict(context_stats, static=static_stats)
+        else:
+            # STEP 2: Call Trainium model with the actual code
+            print("Step 2: Analyzing code with Trainium model...")
+            try:
+                with _timed(timings, 'trainium'):
+                    if analysis_mode == 'chunked':
+                        trainium_explanation, chunk_stats = explain_chunked(files, context_tokens, deadline=deadline)
+                        context_stats = dict(context_stats, **chunk_stats)
+                        print(f"  Explained {chunk_stats['chunks']} chunks ({chunk_stats['cached_calls']} cached calls)")
+                    else:
+                        trainium_explanation = explain_with_trainium(codebase_content, deadline=deadline)
+                print(f"  Generated explanation: {len(trainium_explanation)} characters")
+            except Exception as e:
+                print(f"Error calling Trainium: {str(e)}")
+                traceback.print_exc()
+                if previous is None and not STATIC_FALLBACK:
+                    raise AnalysisError(f'Failed to call Trainium model: {str(e)}')
+                # A stale result for this repository beats a degraded one
+                fallback, trainium_explanation, mermaid_code, static_stats = _degraded_result(previous, files)
+                print(f"  Falling back to the {fallback} analysis")
+                if static_stats is not None:
+                    context_stats = dict(context_stats, static=static_stats)
+        progress('explained', explanation=trainium_explanation)
         
+        # STEP 3: Use Gemini to convert the Trainium explanation (or, on the direct path, the code) to Mermaid
+        if mermaid_code is None:
+            print("Step 3: Generating Mermaid diagram with Gemini...")
+            progress('diagramming')
+            try:
+                with _timed(timings, 'gemini'):
+                    if route['path'] == 'direct':
+                        mermaid_code = generate_mermaid(codebase_content, deadline=deadline,
+                                                        template=MERMAID_CODE_PROMPT_TEMPLATE)
+                    else:
+                        mermaid_code = generate_mermaid(trainium_explanation, deadline=deadline)
+                
+                print(f"✓ Analysis complete for {repo_url}")
+            except Exception as e:
+                print(f"Error in Step 3: {str(e)}")
+                if previous is None and not STATIC_FALLBACK:
+                    raise AnalysisError(f'Failed to generate diagram: {str(e)}')
+                fallback, _, mermaid_code, static_stats = _degraded_result(previous, files)
+                print(f"  Falling back to the {fallback} diagram")
+                if static_stats is not None:
+                    context_stats = dict(context_stats, static=static_stats)
+        progress('diagrammed', mermaid=mermaid_code)
+    
+    result = {
+        'success': True,
+        'repo_url': repo_url,
+        'explanation': trainium_explanation,
+        'mermaid': mermaid_code,
+        'context': context_stats,
+        'plan': plan_stats,
+        'fallback': fallback
+    }
+    if fallback is not None:
+        metrics.inc("analysis_fallbacks_total", fallback=fallback)
+    elif snapshot_key is not None and route['path'] in ('full', 'reused', 'static'):
+        # Degraded and direct results are not stored, so the next request retries the full chain
+        save_snapshot(snapshot_key, {
+            'tree_sha': incremental_stats['tree_sha'],
+            'settings': settings,
+            'fingerprint': fingerprint,
+            'files': listing,
+            # Unreadable files (fetch errors) are retried next time
+            'outlines': {f.path: [listing[f.path], f.to_dict()] for f in files
+                         if f.readable and f.path in listing},
+            'result': result
+        })
+    return finish(result, route)
+
+# Concurrent analyses of the same repository with the same options share one run
+analysis_flight = SingleFlight("analysis")
+
+def normalize_repo_url(url):
+    """Canonical form of a repository URL: "owner/repo" (case, .git and slashes ignored), or a local path."""
+    url = url.strip()
+    local_path = allowed_local_path(url)
+    if local_path is not None:
+        return local_path
+    owner, repo = _parse_repo_url(url)
+    return f"{owner.lower()}/{repo.lower()}"
+
+def check_repo_source(url):
+    """Raise RepoFetchError unless url names a GitHub repository or an allowed, existing local source."""
+    normalize_repo_url(url)
+    local_repo_path(url.strip())
+
+def _analysis_key(repo_url, ingest_mode, context_tokens, analysis_mode, plan):
+    """Identity of an analysis: normalized repository URL and every option that changes the result."""
+    return json.dumps([
+        normalize_repo_url(repo_url), ingest_mode or INGEST_MODE, analysis_mode or ANALYSIS_MODE,
+        context_tokens, plan.max_file_size, plan.include_globs, plan.exclude_globs, plan.max_files
+    ])
+
+# Results precomputed by /analyze-batch, served to /analyze-url without any
+# upstream call until they expire (on disk by default, so they survive restarts)
+BATCH_STORE_DB = os.environ.get('BATCH_STORE_DB', os.path.join('.cache', 'precomputed.db')) or None
+BATCH_RESULT_TTL = int(os.environ.get('BATCH_RESULT_TTL', '86400'))
+BATCH_STORE_MAX_ENTRIES = int(os.environ.get('BATCH_STORE_MAX_ENTRIES', '10000'))
+# Opened on first use, not at import; assign a ResultCache to use another store
+precomputed_store = None
+_precomputed_store_lock = threading.Lock()
+
+def get_precomputed_store():
+    """The precomputed result store, opened (and BATCH_STORE_DB's folder created) on first use."""
+    global precomputed_store
+    with _precomputed_store_lock:
+        if precomputed_store is None:
+            if BATCH_STORE_DB:
+                os.makedirs(os.path.dirname(BATCH_STORE_DB) or '.', exist_ok=True)
+            precomputed_store = ResultCache(BATCH_STORE_MAX_ENTRIES, BATCH_RESULT_TTL, BATCH_STORE_DB,
+                                            table="precomputed")
+        return precomputed_store
+
+def load_precomputed(repo_url, ingest_mode=None, context_tokens=None, analysis_mode=None, plan=None, store=None):
+    """The stored batch result for this repository and options (marked with 'precomputed'), or None."""
+    if plan is None:
+        plan = FetchPlan(max_file_size=100000)
+    key = _analysis_key(repo_url, ingest_mode, context_tokens, analysis_mode, plan)
+    value = (store or get_precomputed_store()).get(key)
+    if not value:
+        return None
+    entry = json.loads(value)
+    return dict(entry['result'], precomputed={'batch_id': entry['batch_id'], 'computed_at': entry['computed_at']})
+
+def save_precomputed(result, batch_id, ingest_mode=None, context_tokens=None, analysis_mode=None, plan=None,
+                     store=None):
+    """Store a finished analysis under its repository and options for later requests."""
+    if plan is None:
+        plan = FetchPlan(max_file_size=100000)
+    key = _analysis_key(result['repo_url'], ingest_mode, context_tokens, analysis_mode, plan)
+    result = {k: v for k, v in result.items()
+              if k not in ('coalesced', 'incremental', 'precomputed', 'route', 'timings_ms')}
+    (store or get_precomputed_store()).put(key, json.dumps({'result': result, 'batch_id': batch_id,
+                                                            'computed_at': time.time()}))
+
+def run_analysis_coalesced(repo_url, ingest_mode=None, on_progress=None, context_tokens=None,
+                           analysis_mode=None, plan=None, incremental=None, use_precomputed=True,
+                           deadline=None):
+    """
+    run_analysis shared by concurrent requests for the same repository
+    (normalized URL, default branch) and options: one request scrapes and
+    calls the models, the others receive its progress events and result,
+    marked 'coalesced': True. Requests with a deadline only share runs with
+    other requests that have one. With use_precomputed, a result stored by
+    /analyze-batch for the same options is returned instead (marked
+    'precomputed').
+    """
+    if plan is None:
+        plan = FetchPlan(max_file_size=100000)
+    if use_precomputed:
+        result = load_precomputed(repo_url, ingest_mode, context_tokens, analysis_mode, plan)
+        if result is not None:
+            print(f"  Serving precomputed analysis of {repo_url}")
+            if on_progress is not None:
+                on_progress('fetched', files=result['context'].get('files', 0), characters=0,
+                            context=result['context'], plan=result['plan'])
+                on_progress('explained', explanation=result['explanation'])
+                on_progress('diagrammed', mermaid=result['mermaid'])
+            return dict(result, route={'path': 'precomputed', 'reason': 'stored by /analyze-batch'})
+    key = json.dumps([_analysis_key(repo_url, ingest_mode, context_tokens, analysis_mode, plan), incremental,
+                      deadline is not None])
+    result, coalesced = analysis_flight.do(
+        key,
+        lambda publish: run_analysis(repo_url, ingest_mode, on_progress=publish, context_tokens=context_tokens,
+                                     analysis_mode=analysis_mode, plan=plan, incremental=incremental,
+                                     deadline=deadline),
+        on_progress
+    )
+    if coalesced:
+        print(f"  Shared in-flight analysis of {repo_url}")
+        return dict(result, coalesced=True)
+    return result
+
+class Job:
+    """One background analysis: status, progress events and final result."""
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = 'queued'
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.updated = self.created
+        self.events = []
+        self._cond = threading.Condition()
+
+    def add_event(self, stage, **info):
+        with self._cond:
+            self.stage = stage
+            self.updated = time.time()
+            self.events.append(dict(info, stage=stage, time=self.updated))
+            self._cond.notify_all()
+
+    def finish(self, status, result=None, error=None):
+        with self._cond:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.updated = time.time()
+            event = {'stage': status, 'time': self.updated}
+            if error is not None:
+                event['error'] = error
+            self.events.append(event)
+            self._cond.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def wait_for_events(self, since, timeout=15):
+        """Block until there are events after index `since` (or the job ends); return them."""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.events) > since or self.finished, timeout=timeout)
+            return self.events[since:]
+
+    def to_dict(self):
+        with self._cond:
+            return {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'stage': self.stage,
+                'created': self.created,
+                'updated': self.updated,
+                'events': list(self.events),
+                'result': self.result,
+                'error': self.error
+            }
+
+class JobQueue:
+    """
+    In-process job queue: work runs on a bounded thread pool and finished
+    jobs are kept for `retention` seconds so clients can poll for results.
+    """
+
+    def __init__(self, max_workers=8, retention=3600):
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, params, fn):
+        """Queue fn(job) to run in the background and return the Job."""
+        job = Job(kind, params)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        with job._cond:
+            job.status = 'running'
+        try:
+            job.finish('done', result=fn(job))
+        except AnalysisError as e:
+            job.finish('failed', error=str(e))
+        except Exception as e:
+            traceback.print_exc()
+            job.finish('failed', error=f'Server error: {str(e)}')
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        """Forget finished jobs older than the retention window (lock held)."""
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.updated < cutoff]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+# Background analysis workers (POST /analyze-url with "async": true)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '8'))
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', '3600'))
+job_queue = JobQueue(JOB_WORKERS, JOB_RETENTION)
+
+def _fetch_plan_from_request(include=None, exclude=None, max_files=None):
+    """FetchPlan for /analyze-url; globs may be lists or comma-separated strings."""
+    if isinstance(include, str):
+        include = _parse_globs(include)
+    if isinstance(exclude, str):
+        exclude = _parse_globs(exclude)
+    return FetchPlan(max_file_size=100000, include_globs=include, exclude_globs=exclude,
+                     max_files=int(max_files) if max_files is not None else None)
+
+# Bulk precomputation (POST /analyze-batch): repositories per batch analyzed
+# at once (a request may ask for up to BATCH_MAX_WORKERS), and the most
+# repositories one batch (or organization) may list
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', '4'))
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', '16'))
+BATCH_MAX_REPOS = int(os.environ.get('BATCH_MAX_REPOS', '500'))
+
+def list_org_repos(org, max_repos=None, include_forks=False, session=None):
+    """HTML URLs of an organization's non-archived repositories (GitHub API, 100 per page)."""
+    max_repos = max_repos or BATCH_MAX_REPOS
+    urls = []
+    page = 1
+    while len(urls) < max_repos:
+        repos = github_scheduler.get_json(f"{GITHUB_API_URL}/orgs/{org}/repos?per_page=100&page={page}",
+                                          session=session, what=f"repositories of {org}")
+        urls += [r['html_url'] for r in repos
+                 if not r.get('archived') and (include_forks or not r.get('fork'))]
+        if len(repos) < 100:
+            break
+        page += 1
+    return urls[:max_repos]
+
+class BatchRun:
+    """
+    Per-repository status and timing of one /analyze-batch run. Results go
+    to precomputed_store, so later /analyze-url requests for the same
+    options are answered from it.
+    """
+
+    def __init__(self, repo_urls, options):
+        self.repos = [{'repo_url': url, 'status': 'queued', 'seconds': None, 'files': None,
+                       'fallback': None, 'precomputed': False, 'error': None} for url in repo_urls]
+        self.options = options
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def run(self, job, max_workers=None):
+        """
+        Analyze every repository on a pool of max_workers threads (default
+        BATCH_WORKERS, at most BATCH_MAX_WORKERS); progress is published as
+        'repo' job events.
+        """
+        global _active_batches
+        self.started = time.time()
+        options = dict(self.options)
+        plan_options = options.pop('plan')
+        with _active_batches_lock:
+            _active_batches += 1
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers or BATCH_WORKERS, BATCH_MAX_WORKERS)),
+                                    thread_name_prefix='batch') as executor:
+                for entry in self.repos:
+                    executor.submit(self._analyze, job, entry, options, plan_options)
+        finally:
+            with _active_batches_lock:
+                _active_batches -= 1
+            self.finished = time.time()
+        return self.to_dict(include_repos=False)
+
+    def _analyze(self, job, entry, options, plan_options):
+        with self._lock:
+            entry['status'] = 'running'
+        start = time.perf_counter()
+        try:
+            # Each repository gets its own plan, since plans record their decisions
+            plan = _fetch_plan_from_request(**plan_options)
+            result = run_analysis_coalesced(entry['repo_url'], plan=plan, use_precomputed=False, **options)
+            # A degraded result (a model failed) is not served for BATCH_RESULT_TTL:
+            # /analyze-url will retry the models instead
+            precomputed = result['fallback'] is None
+            if precomputed:
+                save_precomputed(result, job.id, plan=plan, ingest_mode=options['ingest_mode'],
+                                 context_tokens=options['context_tokens'], analysis_mode=options['analysis_mode'])
+            update = {'status': 'done', 'files': result['context'].get('files'), 'fallback': result['fallback'],
+                      'precomputed': precomputed}
+        except Exception as e:
+            print(f"  Batch analysis of {entry['repo_url']} failed: {e}")
+            update = {'status': 'failed', 'error': str(e)}
+        with self._lock:
+            entry.update(update, seconds=round(time.perf_counter() - start, 3))
+        metrics.inc("batch_repos_total", status=update['status'])
+        job.add_event('repo', **dict(entry), **self._progress())
+
+    def _progress(self):
+        """Counts by status and throughput so far (lock not held)."""
+        with self._lock:
+            counts = {status: 0 for status in ('queued', 'running', 'done', 'failed')}
+            for entry in self.repos:
+                counts[entry['status']] += 1
+            timed = [entry['seconds'] for entry in self.repos if entry['seconds'] is not None]
+        elapsed = ((self.finished or time.time()) - self.started) if self.started else 0.0
+        completed = counts['done'] + counts['failed']
+        rate = completed / elapsed if elapsed else 0.0
+        return {
+            'total': len(self.repos),
+            'counts': counts,
+            'elapsed_seconds': round(elapsed, 3),
+            'repos_per_minute': round(60 * rate, 2),
+            'mean_seconds_per_repo': round(sum(timed) / len(timed), 3) if timed else None,
+            'eta_seconds': round((len(self.repos) - completed) / rate, 1) if rate and not self.finished else None
+        }
+
+    def to_dict(self, include_repos=True):
+        progress = self._progress()
+        if include_repos:
+            with self._lock:
+                progress['repos'] = [dict(entry) for entry in self.repos]
+        return progress
+
+@app.route('/analyze-batch', methods=['POST'])
+def analyze_batch():
+    """
+    Precompute analyses for many repositories in the background: a list of
+    "repo_urls" and/or an "org" whose repositories are listed from GitHub.
+    Accepts the /analyze-url options. Returns 202 with a batch ID; progress
+    and per-repository timings are at GET /batches/<batch_id> (or as events
+    of GET /jobs/<batch_id>/events).
+    """
+    try:
+        data = request.json or {}
+        repo_urls = list(data.get('repo_urls') or [])
+        org = data.get('org')
+        if org:
+            try:
+                repo_urls += list_org_repos(org, include_forks=bool(data.get('include_forks')))
+            except (RepoFetchError, requests.RequestException, CircuitOpenError) as e:
+                return jsonify({'success': False, 'error': str(e)}), 502
+        # Drop duplicates (same normalized repository), keeping the first spelling;
+        # malformed or disallowed entries are reported and left out
+        unique = {}
+        invalid = []
+        for url in repo_urls:
+            if isinstance(url, str) and url.strip():
+                try:
+                    check_repo_source(url)
+                    unique.setdefault(normalize_repo_url(url), url.strip())
+                except RepoFetchError as e:
+                    invalid.append({'repo_url': url.strip(), 'error': str(e)})
+        repo_urls = list(unique.values())
+        if not repo_urls:
+            if invalid:
+                return jsonify({'success': False, 'error': 'No valid repository URLs', 'invalid': invalid}), 400
+            return jsonify({'error': 'No repository URLs provided'}), 400
+        if len(repo_urls) > BATCH_MAX_REPOS:
+            return jsonify({'error': f'At most {BATCH_MAX_REPOS} repositories per batch'}), 400
+
+        options = {
+            'ingest_mode': data.get('ingest_mode'),
+            'context_tokens': data.get('context_tokens'),
+            'analysis_mode': data.get('analysis_mode'),
+            'incremental': data.get('incremental'),
+            'plan': {'include': data.get('include'), 'exclude': data.get('exclude'),
+                     'max_files': data.get('max_files')}
+        }
+        _fetch_plan_from_request(**options['plan'])  # reject bad options before queueing
+        workers = data.get('workers')
+        if workers is not None and (type(workers) is not int or not 1 <= workers <= BATCH_MAX_WORKERS):
+            return jsonify({'error': f'workers must be between 1 and {BATCH_MAX_WORKERS}'}), 400
+        batch = BatchRun(repo_urls, options)
+        job = job_queue.submit('analyze-batch', dict(options, repos=len(repo_urls), org=org),
+                               lambda job: batch.run(job, workers))
+        job.batch = batch
         return jsonify({
             'success': True,
-            'mermaid': mermaid_code
-        })
-    
+            'batch_id': job.id,
+            'repos': len(repo_urls),
+            'invalid': invalid,
+            'status_url': f'/batches/{job.id}'
+        }), 202
+
     except Exception as e:
+        print(f"✗ Unexpected error: {str(e)}")
+        traceback.print_exc()
         return jsonify({
             'success': False,
-            'error': str(e)
+            'error': f'Server error: {str(e)}'
         }), 500
 
+@app.route('/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """Progress, throughput and per-repository status of an /analyze-batch run"""
+    job = job_queue.get(batch_id)
+    if job is None or job.kind != 'analyze-batch':
+        return jsonify({'success': False, 'error': 'Unknown batch'}), 404
+    return jsonify(dict(job.batch.to_dict(), batch_id=job.id, status=job.status, error=job.error))
+
 @app.route('/analyze-url', methods=['POST'])
 def analyze_url():
     """
     TEMPORARY: Simulates the complete workflow using Gemini for both explanation generation (simulating Trainium)
     and Mermaid diagram generation.
+    With "async": true the analysis is queued and a job ID is returned
+    immediately (202); poll GET /jobs/<job_id> for progress and the result.
+    "deadline_ms" (default ANALYZE_DEADLINE_MS for synchronous requests,
+    none for async ones) is the latency budget the model path is chosen for.
+    Works without Gemini credentials: "analysis_mode": "static" makes no
+    model calls, and other modes fall back to the static diagram.
     """
     try:
-        if not GEMINI_API_KEY:
-            return jsonify({'error': 'GEMINI_API_KEY not configured'}), 500
-        
         data = request.json
         repo_url = data.get('repo_url', '')
+        ingest_mode = data.get('ingest_mode')
+        context_tokens = data.get('context_tokens')
+        analysis_mode = data.get('analysis_mode')
+        include, exclude, max_files = data.get('include'), data.get('exclude'), data.get('max_files')
+        incremental = data.get('incremental')
+        use_precomputed = not data.get('refresh')
+        deadline_ms = data.get('deadline_ms', 0 if data.get('async') else ANALYZE_DEADLINE_MS)
+        deadline = request_deadline(deadline_ms)
         
         if not repo_url:
             return jsonify({'error': 'No repository URL provided'}), 400
-        
-        print(f"Analyzing repository: {repo_url}")
-        
-        # STEP 1: Scrape the GitHub repository
-        print("Step 1: Fetching code from GitHub...")
         try:
-            codebase_content = document_github_repo_raw(repo_url, branch="main", max_file_size=100000)
-            
-            if codebase_content.startswith("[Error]"):
-                # Try 'master' branch if 'main' fails
-                print("  Trying 'master' branch...")
-                codebase_content = document_github_repo_raw(repo_url, branch="master", max_file_size=100000)
-            
-            print(f"  Fetched {len(codebase_content)} characters of code")
-            
-            # TinyLlama has VERY limited context (512 tokens total for input + output)
-            # For code: 1 token ≈ 2-3 characters (not 4!)
-            # Need: 250 input tokens + 150 output tokens = 400 total (safe buffer)
-            max_context = 500  # ~250 tokens input, leaving room for 150 output tokens
-            if len(codebase_content) > max_context:
-                codebase_content = codebase_content[:max_context]
-                print(f"  Truncated to {max_context} characters due to TinyLlama 512-token limit")
-        except Exception as e:
-            print(f"Error fetching GitHub repo: {str(e)}")
-            return jsonify({
-                'success': False,
-                'error': f'Failed to fetch repository: {str(e)}'
-            }), 500
+            check_repo_source(repo_url)
+        except RepoFetchError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        plan = _fetch_plan_from_request(include, exclude, max_files)
         
-        # STEP 2: Call Trainium model with the actual code
-        print("Step 2: Analyzing code with Trainium model...")
-        try:
-            # Prepare VERY SHORT prompt for Trainium (limited to 512 tokens total)
-            trainium_prompt = f"""Code analysis:
-
-{codebase_content}
-
-Explain: what does this code do?"""
-
-            # Prepare payload for Trainium with very conservative limits
-            payload = {
-                "inputs": trainium_prompt,
-                "parameters": {
-                    "max_new_tokens": 150,  # Further reduced to fit 512-token limit
-                    "temperature": 0.7,
-                    "do_sample": True
-                }
-            }
-            
-            # Invoke Trainium endpoint
-            response = sagemaker_client.invoke_endpoint(
-                EndpointName=TRAINIUM_ENDPOINT,
-                Body=json.dumps(payload),
-                ContentType="application/json"
+        if data.get('async'):
+            job = job_queue.submit(
+                'analyze-url',
+                {'repo_url': repo_url, 'ingest_mode': ingest_mode, 'context_tokens': context_tokens,
+                 'analysis_mode': analysis_mode, 'include': include, 'exclude': exclude,
+                 'max_files': max_files, 'incremental': incremental, 'deadline_ms': deadline_ms},
+                lambda job: run_analysis_coalesced(repo_url, ingest_mode, on_progress=job.add_event,
+                                                   context_tokens=context_tokens, analysis_mode=analysis_mode,
+                                                   plan=plan, incremental=incremental,
+                                                   use_precomputed=use_precomputed, deadline=deadline)
             )
-            
-            # Parse Trainium response
-            result = json.loads(response["Body"].read().decode())
-            print(f"  Trainium response: {result}")
-            
-            # Extract explanation from Trainium response
-            if isinstance(result, list) and len(result) > 0:
-                trainium_explanation = result[0].get('generated_text', '')
-            elif isinstance(result, dict):
-                trainium_explanation = result.get('generated_text', result.get('outputs', ''))
-            else:
-                trainium_explanation = str(result)
-            
-            print(f"  Generated explanation: {len(trainium_explanation)} characters")
-            
-        except Exception as e:
-            print(f"Error calling Trainium: {str(e)}")
-            import traceback
-            traceback.print_exc()
             return jsonify({
-                'success': False,
-                'error': f'Failed to call Trainium model: {str(e)}'
-            }), 500
+                'success': True,
+                'job_id': job.id,
+                'status': job.status,
+                'status_url': f'/jobs/{job.id}'
+            }), 202
         
-        # STEP 3: Use Gemini to convert Trainium explanation to Mermaid diagram
-        print("Step 3: Generating Mermaid diagram with Gemini...")
-        mermaid_prompt = f"""You are an expert at creating valid Mermaid diagrams for software architecture.
-
-Given the following codebase explanation, create a SIMPLE and VALID Mermaid flowchart.
-
-CRITICAL RULES:
-1. Start with: graph TB
-2. Use SIMPLE node IDs (no spaces, no special chars): A, B, C, App, DB, API
-3. Use square brackets for labels: A[Label Text]
-4. For databases use: DB[(Database Name)]
-5. Simple arrows only: A --> B
-6. Keep labels SHORT (max 20 chars per line)
-7. NO line breaks in labels
-8. NO special characters in node IDs
-9. Maximum 10-15 nodes
-10. Test each line is valid Mermaid syntax
-
-Codebase Explanation:
-{trainium_explanation}
-
-Generate ONLY valid Mermaid code. Start with 'graph TB' and keep it SIMPLE."""
-
         try:
-            mermaid_response = model.generate_content(mermaid_prompt)
-            mermaid_code = mermaid_response.text.strip()
-            
-            # Clean up response
-            if mermaid_code.startswith('```mermaid'):
-                mermaid_code = mermaid_code.replace('```mermaid', '').replace('```', '').strip()
-            elif mermaid_code.startswith('```'):
-                mermaid_code = mermaid_code.replace('```', '').strip()
-            
-            print(f"✓ Analysis complete for {repo_url}")
-        except Exception as e:
-            print(f"Error in Step 2: {str(e)}")
+            return jsonify(run_analysis_coalesced(repo_url, ingest_mode, context_tokens=context_tokens,
+                                                  analysis_mode=analysis_mode, plan=plan, incremental=incremental,
+                                                  use_precomputed=use_precomputed, deadline=deadline))
+        except AnalysisError as e:
             return jsonify({
                 'success': False,
-                'error': f'Failed to generate diagram: {str(e)}'
+                'error': str(e)
             }), 500
-        
-        return jsonify({
-            'success': True,
-            'repo_url': repo_url,
-            'explanation': trainium_explanation,
-            'mermaid': mermaid_code
-        })
     
     except Exception as e:
         print(f"✗ Unexpected error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({
             'success': False,
             'error': f'Server error: {str(e)}'
         }), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status, progress events and (when finished) the result of a background job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict())
+
+def _sse_events(job):
+    """
+    Yield a job's progress as server-sent events, one per stage event, until
+    the job finishes. The final "done" event carries the full result.
+    """
+    sent = 0
+    while True:
+        events = job.wait_for_events(sent)
+        if not events:
+            yield ": keep-alive\n\n"
+        for event in events:
+            if event['stage'] == 'done':
+                event = dict(event, result=job.result)
+            yield f"event: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+        sent += len(events)
+        if job.finished and sent >= len(job.events):
+            return
+
+def _sse_response(job):
+    return Response(_sse_events(job), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_job(job_id):
+    """Server-sent events stream of a background job's progress"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return _sse_response(job)
+
+@app.route('/analyze-url/stream', methods=['GET'])
+def analyze_url_stream():
+    """
+    Start an analysis and stream its progress as server-sent events:
+    "files" (running fetch count), "explained" (Trainium explanation),
+    "diagrammed" (Mermaid code), then "done" or "failed".
+    Usable directly from the browser's EventSource (GET ?repo_url=...).
+    "deadline_ms" defaults to ANALYZE_DEADLINE_MS, as for /analyze-url.
+    """
+    deadline_ms = request.args.get('deadline_ms', ANALYZE_DEADLINE_MS, type=float)
+    deadline = request_deadline(deadline_ms)
+    repo_url = request.args.get('repo_url', '')
+    ingest_mode = request.args.get('ingest_mode')
+    context_tokens = request.args.get('context_tokens', type=int)
+    analysis_mode = request.args.get('analysis_mode')
+    include, exclude = request.args.get('include'), request.args.get('exclude')
+    max_files = request.args.get('max_files', type=int)
+    incremental = request.args.get('incremental', type=lambda v: v.lower() not in ('0', 'false', 'no'))
+    use_precomputed = request.args.get('refresh', 'false').lower() in ('0', 'false', 'no')
+    if not repo_url:
+        return jsonify({'error': 'No repository URL provided'}), 400
+    try:
+        check_repo_source(repo_url)
+    except RepoFetchError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    plan = _fetch_plan_from_request(include, exclude, max_files)
+    job = job_queue.submit(
+        'analyze-url',
+        {'repo_url': repo_url, 'ingest_mode': ingest_mode, 'context_tokens': context_tokens,
+         'analysis_mode': analysis_mode, 'include': include, 'exclude': exclude, 'max_files': max_files,
+         'incremental': incremental, 'deadline_ms': deadline_ms},
+        lambda job: run_analysis_coalesced(repo_url, ingest_mode, on_progress=job.add_event,
+                                           context_tokens=context_tokens, analysis_mode=analysis_mode, plan=plan,
+                                           incremental=incremental, use_precomputed=use_precomputed,
+                                           deadline=deadline)
+    )
+    return _sse_response(job)
+
 @app.route('/analyze', methods=['POST'])
 def analyze_codebase():
     """
@@ -336,36 +4039,7 @@ def analyze_codebase():
             return jsonify({'error': 'No explanation provided'}), 400
         
         # Generate Mermaid diagram from explanation
-        prompt = f"""You are an expert at creating valid Mermaid diagrams for software architecture.
-
-Given the following codebase explanation, create a SIMPLE and VALID Mermaid flowchart.
-
-CRITICAL RULES:
-1. Start with: graph TB
-2. Use SIMPLE node IDs (no spaces, no special chars): A, B, C, App, DB, API
-3. Use square brackets for labels: A[Label Text]
-4. For databases use: DB[(Database Name)]
-5. Simple arrows only: A --> B
-6. Keep labels SHORT (max 20 chars per line)
-7. NO line breaks in labels
-8. NO special characters in node IDs
-9. Maximum 10-15 nodes
-10. Test each line is valid Mermaid syntax
-
-Codebase Explanation:
-{trainium_explanation}
-
-Generate ONLY valid Mermaid code. Start with 'graph TB' and keep it SIMPLE."""
-
-        # Call Gemini API
-        response = model.generate_content(prompt)
-        mermaid_code = response.text.strip()
-        
-        # Clean up response
-        if mermaid_code.startswith('```mermaid'):
-            mermaid_code = mermaid_code.replace('```mermaid', '').replace('```', '').strip()
-        elif mermaid_code.startswith('```'):
-            mermaid_code = mermaid_code.replace('```', '').strip()
+        mermaid_code = generate_mermaid(trainium_explanation)
         
         return jsonify({
             'success': True,
@@ -380,10 +4054,118 @@ Generate ONLY valid Mermaid code. Start with 'graph TB' and keep it SIMPLE."""
             'error': str(e)
         }), 500
 
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters and sizes of the backend caches"""
+    return jsonify({
+        'blob_cache': blob_cache.stats() if blob_cache else None,
+        'mermaid_cache': mermaid_cache.stats(),
+        'trainium_cache': trainium_cache.stats(),
+        'analysis_store': analysis_store.stats(),
+        'precomputed_store': get_precomputed_store().stats(),
+        'github_etags': github_etag_cache.stats(),
+        'coalescing': {
+            'analysis': analysis_flight.stats(),
+            'diagram': mermaid_flight.stats()
+        }
+    })
+
+@app.route('/upstream-stats', methods=['GET'])
+def upstream_stats():
+    """Call, retry, hedge and timeout counters and circuit breaker state per upstream"""
+    stats = {name: upstream.stats() for name, upstream in upstreams.items()}
+    stats['github']['rate_limit'] = github_scheduler.stats()
+    return jsonify(stats)
+
+@app.route('/batch-stats', methods=['GET'])
+def batch_stats():
+    """Achieved batch sizes of the Trainium micro-batchers (always on, and batch runs only)"""
+    return jsonify({
+        'trainium_batcher': trainium_batcher.stats() if trainium_batcher else None,
+        'batch_trainium_batcher': batch_trainium_batcher.stats() if batch_trainium_batcher else None
+    })
+
+def _collect_backend_gauges():
+    caches = {'mermaid': mermaid_cache, 'trainium': trainium_cache}
+    for name, cache in caches.items():
+        stats = cache.stats()
+        yield ('cache_hits_total', 'counter', 'Cache hits', {'cache': name}, stats['memory_hits'] + stats['disk_hits'])
+        yield ('cache_misses_total', 'counter', 'Cache misses', {'cache': name}, stats['misses'])
+    if blob_cache is not None:
+        stats = blob_cache.stats()
+        yield ('cache_hits_total', 'counter', 'Cache hits', {'cache': 'blob'}, stats['hits'])
+        yield ('cache_misses_total', 'counter', 'Cache misses', {'cache': 'blob'}, stats['misses'])
+        yield ('blob_cache_bytes', 'gauge', 'Bytes stored in the blob cache', {}, stats['bytes'])
+    for status, count in job_queue.stats().items():
+        yield ('jobs', 'gauge', 'Background jobs by status', {'status': status}, count)
+    for i, state in enumerate(github_scheduler.stats()['pool']):
+        if state['remaining'] is not None:
+            yield ('github_rate_limit_remaining', 'gauge', 'GitHub API requests left per pooled token',
+                   {'token': i}, state['remaining'])
+    for name, upstream in upstreams.items():
+        yield ('upstream_circuit_open', 'gauge', 'Whether the upstream circuit breaker is open (1) or half open (0.5)',
+               {'service': name}, {'closed': 0, 'half_open': 0.5, 'open': 1}[upstream.state])
+    if trainium_batcher is not None:
+        stats = trainium_batcher.stats()
+        yield ('trainium_batches_total', 'counter', 'Batched Trainium requests sent', {}, stats['batches'])
+        yield ('trainium_batched_prompts_total', 'counter', 'Prompts sent through the batcher', {}, stats['requests'])
+
+metrics.add_collector(_collect_backend_gauges)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Per-stage latency histograms, counters and cache stats in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/health', methods=['GET'])
 def health():
-    """Health check endpoint"""
-    return jsonify({'status': 'healthy'})
+    """
+    Health check endpoint with readiness per upstream: whether it is
+    configured, whether this process has created its client yet and the
+    state of its circuit breaker. 'degraded' means some analyses will be
+    answered with a fallback.
+    """
+    gemini_error = None if model is not None else gemini_config_error()
+    trainium_error = None if sagemaker_client is not None else trainium_config_error()
+    status = {
+        'github': {'configured': True, 'error': None, 'tokens': len(GITHUB_TOKENS)},
+        'trainium': {'configured': trainium_error is None, 'error': trainium_error,
+                     'client': sagemaker_client is not None, 'endpoint': TRAINIUM_ENDPOINT},
+        'gemini': {'configured': gemini_error is None, 'error': gemini_error,
+                   'client': model is not None, 'model': GEMINI_MODEL_NAME}
+    }
+    for name, info in status.items():
+        info['circuit'] = upstreams[name].state
+        info['ready'] = info['configured'] and info['circuit'] != 'open'
+    return jsonify({
+        'status': 'healthy' if all(info['ready'] for info in status.values()) else 'degraded',
+        'pid': os.getpid(),
+        'upstreams': status
+    })
+
+WARM_CLIENTS = os.environ.get('WARM_CLIENTS', '0') != '0'
+
+def create_app(warm=None):
+    """
+    App factory for WSGI servers, e.g. gunicorn -w 1 --threads 16
+    'backend:create_app()' (jobs and batches are kept per process, see README).
+    Reports missing upstream settings (requests that need them fail, and
+    /analyze-url falls back to the static diagram) instead of exiting.
+    With warm (default WARM_CLIENTS) the Gemini model and SageMaker client
+    are created now rather than on the first request that needs them.
+    """
+    for name, error in (('Gemini', gemini_config_error()), ('Trainium', trainium_config_error())):
+        if error:
+            print(f"WARNING: {name} unavailable: {error}")
+    if warm is None:
+        warm = WARM_CLIENTS
+    if warm:
+        for getter in (get_gemini_model, get_sagemaker_client):
+            try:
+                getter()
+            except ConfigError:
+                pass
+    return app
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5001)
+    create_app().run(debug=os.environ.get('FLASK_DEBUG', '1') != '0', port=int(os.environ.get('PORT', '5001')))
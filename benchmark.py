@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the backend API.
+
+Runs the Flask app against local stand-ins for all three upstreams:
+- a fake GitHub server (tree API, raw files and tarballs) serving synthetic
+  repositories of configurable size
+- a fake SageMaker runtime with configurable latency
+- a fake Gemini GenerativeModel with configurable latency
+
+Then drives /analyze-url, /analyze and /generate-diagram at a configurable
+concurrency and reports p50/p95/p99 latency and requests per second.
+Results are saved as JSON so runs can be compared before and after changes.
+
+--fault-rate and --slow-rate make each fake upstream fail (connection
+errors, HTTP 503) or answer ten times slower on that fraction of calls, to
+exercise the retry, hedging and circuit breaker settings. --deadline-ms
+sends a latency budget with each /analyze-url request; the results count
+which path (full, direct, cached, static) the router took.
+
+With --startup it measures, in fresh interpreters, how long importing the
+backend and create_app() take and what the first use of each model client
+costs (the clients are created lazily).
+
+With --ingest it times ingesting the synthetic repository through each
+backend: raw files and the tarball from the fake GitHub, and a local git
+clone read with git cat-file --batch.
+
+With --memory it instead measures peak Python heap (tracemalloc) while
+ingesting synthetic repositories of increasing size, comparing the streaming
+document builder and outline pipeline with materializing every file.
+
+Usage:
+    python benchmark.py --files 500 --requests 40 --concurrency 8
+    python benchmark.py --endpoints analyze-url --ingest-mode archive -o after.json
+    python benchmark.py --memory --memory-sizes 250,1000,4000 --file-size 20000
+    TRAINIUM_HEDGE_AFTER_MS=400 python benchmark.py --slow-rate 0.05 --fault-rate 0.05
+    python benchmark.py --startup --startup-runs 5
+    python benchmark.py --ingest --files 2000
+    python benchmark.py --endpoints analyze-url --deadline-ms 400 --slow-rate 0.2
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+EXTENSIONS = [".py", ".js", ".ts", ".go", ".java", ".html", ".css"]
+
+
+def synthetic_file(path, size):
+    """Deterministic pseudo-source for `path`, roughly `size` bytes long."""
+    rnd = random.Random(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    lines = [f"import module_{rnd.randint(0, 50)}", ""]
+    i = 0
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.append(f"def {stem}_func_{i}(arg_{rnd.randint(0, 9)}, value=None):")
+        lines.append(f"    return arg_{rnd.randint(0, 9)}  # {'x' * rnd.randint(10, 60)}")
+        lines.append("")
+        i += 1
+    return "\n".join(lines).encode()
+
+
+def git_blob_sha(data):
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class SyntheticRepo:
+    """A fake repository: `files` source files spread over nested folders."""
+
+    def __init__(self, files, file_size):
+        self.paths = []
+        for i in range(files):
+            folder = "/".join(f"pkg{(i // 10 ** depth) % 7}" for depth in range(i % 3))
+            ext = EXTENSIONS[i % len(EXTENSIONS)]
+            self.paths.append(f"{folder}/file_{i}{ext}".lstrip("/"))
+        self.paths.sort()
+        self.contents = {path: synthetic_file(path, file_size) for path in self.paths}
+        self._tarball = None
+
+    def tree(self):
+        return {
+            "sha": "0" * 40,
+            "truncated": False,
+            "tree": [
+                {"path": path, "type": "blob", "sha": git_blob_sha(data), "size": len(data)}
+                for path, data in self.contents.items()
+            ],
+        }
+
+    def tarball(self, repo):
+        if self._tarball is None:
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+                root = tarfile.TarInfo(f"{repo}-main")
+                root.type = tarfile.DIRTYPE
+                tar.addfile(root)
+                for path, data in self.contents.items():
+                    info = tarfile.TarInfo(f"{repo}-main/{path}")
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            self._tarball = buf.getvalue()
+        return self._tarball
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    """Clients that stop reading early (partial downloads) are not errors."""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FaultInjector:
+    """Decides, per call, whether a fake upstream fails or answers slowly."""
+
+    def __init__(self, fault_rate=0.0, slow_rate=0.0, slow_factor=10.0, seed=0):
+        self.fault_rate = fault_rate
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.faults = 0
+        self.slow = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def fail(self):
+        with self._lock:
+            failed = self._random.random() < self.fault_rate
+            self.faults += failed
+        return failed
+
+    def latency(self, base):
+        with self._lock:
+            slow = self._random.random() < self.slow_rate
+            self.slow += slow
+        return base * self.slow_factor if slow else base
+
+    def stats(self):
+        return {"faults": self.faults, "slow": self.slow}
+
+
+class FakeGitHub:
+    """
+    Local HTTP stand-in for api.github.com and raw.githubusercontent.com.
+    Every owner/repo name maps to the same synthetic repository.
+    """
+
+    def __init__(self, repo, latency=0.0, faults=None):
+        self.repo = repo
+        self.latency = latency
+        self.faults = faults or FaultInjector()
+        self.requests = 0
+        self.api_requests = 0
+        self.not_modified = 0
+        self.rate_limit = 5000
+        self._lock = threading.Lock()
+        handler = self._make_handler()
+        self.server = QuietHTTPServer(("127.0.0.1", 0), handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type="application/octet-stream", headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_api(self, body):
+                # Rate-limit headers like api.github.com, and 304s for a matching ETag
+                with fake._lock:
+                    fake.api_requests += 1
+                    remaining = max(0, fake.rate_limit - fake.api_requests)
+                headers = {"ETag": '"%s"' % hashlib.sha1(body).hexdigest(),
+                           "X-RateLimit-Limit": str(fake.rate_limit),
+                           "X-RateLimit-Remaining": str(remaining),
+                           "X-RateLimit-Reset": str(int(time.time()) + 3600)}
+                if self.headers.get("If-None-Match") == headers["ETag"]:
+                    with fake._lock:
+                        fake.not_modified += 1
+                    return self._send(304, b"", "application/json", headers)
+                self._send(200, body, "application/json", headers)
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.faults.latency(fake.latency))
+                if fake.faults.fail():
+                    return self._send(503, b'{"message": "Service Unavailable"}', "application/json")
+                parts = urlparse(self.path).path.strip("/").split("/")
+                # /api/repos/<owner>/<repo>
+                if parts[:2] == ["api", "repos"] and len(parts) == 4:
+                    return self._send_api(json.dumps({"full_name": "/".join(parts[2:4]),
+                                                      "default_branch": "main"}).encode())
+                # /api/repos/<owner>/<repo>/git/trees/<branch>
+                if parts[:2] == ["api", "repos"] and parts[4:6] == ["git", "trees"]:
+                    return self._send_api(json.dumps(fake.repo.tree()).encode())
+                # /api/repos/<owner>/<repo>/tarball/<branch>
+                if parts[:2] == ["api", "repos"] and parts[4:5] == ["tarball"]:
+                    return self._send(200, fake.repo.tarball(parts[3]), "application/gzip")
+                # /raw/<owner>/<repo>/<branch>/<path>
+                if parts[:1] == ["raw"] and len(parts) > 4:
+                    data = fake.repo.contents.get("/".join(parts[4:]))
+                    if data is not None:
+                        return self._send(200, data, "text/plain")
+                self._send(404, b'{"message": "Not Found"}', "application/json")
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class FakeSageMakerRuntime:
+    """Stand-in for the boto3 sagemaker-runtime client."""
+
+    def __init__(self, latency=0.0, faults=None):
+        self.latency = latency
+        self.faults = faults or FaultInjector()
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType="application/json", **kwargs):
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.faults.latency(self.latency))
+        if self.faults.fail():
+            raise ConnectionError("fake SageMaker endpoint dropped the connection")
+        inputs = json.loads(Body)["inputs"]
+        prompts = inputs if isinstance(inputs, list) else [inputs]
+        # Sampled output differs per call, like the real model at temperature 0.7
+        outputs = [
+            [{"generated_text": f"A web service with an API layer, a service layer and a database "
+                                f"({len(p)} chars analyzed, sample {call}.{i})."}]
+            for i, p in enumerate(prompts)
+        ]
+        body = outputs if isinstance(inputs, list) else outputs[0]
+        return {"Body": io.BytesIO(json.dumps(body).encode())}
+
+
+class FakeGenerativeModel:
+    """Stand-in for google.generativeai.GenerativeModel."""
+
+    model_name = "models/fake-gemini"
+
+    class _Response:
+        def __init__(self, text):
+            self.text = text
+
+    def __init__(self, latency=0.0, faults=None):
+        self.latency = latency
+        self.faults = faults or FaultInjector()
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, **kwargs):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.faults.latency(self.latency))
+        if self.faults.fail():
+            raise ConnectionError("fake Gemini API dropped the connection")
+        return self._Response("```mermaid\ngraph TB\n    App[App] --> API[API]\n    API --> DB[(Database)]\n```")
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_load(url, payloads, concurrency):
+    """POST every payload to `url` with `concurrency` parallel clients."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+
+    def one(payload):
+        start = time.perf_counter()
+        route = None
+        try:
+            resp = session.post(url, json=payload, timeout=600)
+            body = resp.json()
+            ok = resp.status_code == 200 and body.get("success", False)
+            route = (body.get("route") or {}).get("path")
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok, route
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(one, payloads))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _, _ in samples)
+    errors = sum(1 for _, ok, _ in samples if not ok)
+    routes = {}
+    for _, _, route in samples:
+        if route is not None:
+            routes[route] = routes.get(route, 0) + 1
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "concurrency": concurrency,
+        "wall_seconds": round(wall, 4),
+        "rps": round(len(samples) / wall, 3) if wall else 0.0,
+        "mean_ms": round(1000 * sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        "p50_ms": round(1000 * percentile(latencies, 50), 3),
+        "p95_ms": round(1000 * percentile(latencies, 95), 3),
+        "p99_ms": round(1000 * percentile(latencies, 99), 3),
+        "max_ms": round(1000 * latencies[-1], 3) if latencies else 0.0,
+        "routes": routes,
+    }
+
+
+def run_batch(base_url, count, workers):
+    """Submit one /analyze-batch of `count` repositories and poll it to completion."""
+    repo_urls = [f"https://github.com/batch/repo{i}" for i in range(count)]
+    start = time.perf_counter()
+    resp = requests.post(f"{base_url}/analyze-batch", json={"repo_urls": repo_urls, "workers": workers}, timeout=60)
+    status_url = base_url + resp.json()["status_url"]
+    while True:
+        batch = requests.get(status_url, timeout=60).json()
+        if batch["status"] in ("done", "failed"):
+            break
+        time.sleep(0.05)
+    wall = time.perf_counter() - start
+    return {
+        "requests": count,
+        "errors": batch["counts"]["failed"] + (1 if batch["status"] == "failed" else 0),
+        "workers": workers,
+        "wall_seconds": round(wall, 4),
+        "repos_per_minute": batch["repos_per_minute"],
+        "mean_seconds_per_repo": batch["mean_seconds_per_repo"],
+    }
+
+
+def build_payloads(endpoint, count, repeat, deadline_ms=0):
+    """Request bodies; unique per request unless `repeat` (to measure cache hits)."""
+    payloads = []
+    for i in range(count):
+        tag = 0 if repeat else i
+        if endpoint == "analyze-url":
+            payloads.append({"repo_url": f"https://github.com/bench/repo{tag}", "deadline_ms": deadline_ms})
+        else:
+            payloads.append({
+                "repo_url": f"https://github.com/bench/repo{tag}",
+                "explanation": f"Benchmark service #{tag} ({endpoint}): routes call services which read a database.",
+            })
+    return payloads
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the backend API")
+    parser.add_argument("--endpoints", default="analyze-url,analyze,generate-diagram",
+                        help="comma-separated endpoints to drive (analyze-batch runs one batch of "
+                             "--requests repositories on --concurrency workers)")
+    parser.add_argument("--requests", type=int, default=20, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel clients")
+    parser.add_argument("--files", type=int, default=200, help="files in the synthetic repository")
+    parser.add_argument("--file-size", type=int, default=2000, help="approximate bytes per file")
+    parser.add_argument("--github-latency-ms", type=float, default=5.0)
+    parser.add_argument("--sagemaker-latency-ms", type=float, default=200.0)
+    parser.add_argument("--gemini-latency-ms", type=float, default=300.0)
+    parser.add_argument("--fault-rate", type=float, default=0.0,
+                        help="fraction of upstream calls that fail (connection error or HTTP 503)")
+    parser.add_argument("--slow-rate", type=float, default=0.0,
+                        help="fraction of upstream calls that take 10x their normal latency")
+    parser.add_argument("--deadline-ms", type=float, default=0,
+                        help="latency budget sent with each /analyze-url request (0: none)")
+    parser.add_argument("--ingest-mode", choices=["raw", "archive"], default="raw")
+    parser.add_argument("--repeat", action="store_true",
+                        help="send identical requests (measures cached paths)")
+    parser.add_argument("--blob-cache", action="store_true", help="enable the on-disk blob cache")
+    parser.add_argument("--memory", action="store_true",
+                        help="measure peak ingestion memory instead of endpoint latency")
+    parser.add_argument("--memory-sizes", default="250,1000,4000",
+                        help="comma-separated repository sizes (files) for --memory")
+    parser.add_argument("--ingest", action="store_true",
+                        help="compare ingestion throughput of the raw, archive and local git backends")
+    parser.add_argument("--startup", action="store_true",
+                        help="measure import, create_app() and first-client times instead of endpoint latency")
+    parser.add_argument("--startup-runs", type=int, default=5, help="fresh interpreters to time for --startup")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="where to save the JSON results")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir):
+    """Point the backend at the fakes before it is imported."""
+    for name in ("GEMINI_API_KEY", "AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"):
+        os.environ.setdefault(name, "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("TRAINIUM_ENDPOINT", "benchmark-endpoint")
+    os.environ["INGEST_MODE"] = args.ingest_mode
+    os.environ["BLOB_CACHE_DIR"] = os.path.join(workdir, "blobs") if args.blob_cache else ""
+    os.environ["BATCH_STORE_DB"] = os.path.join(workdir, "precomputed.db")
+    os.environ["LOCAL_REPO_ROOTS"] = workdir
+    # Start the latency router from the fakes' latencies rather than the production priors
+    os.environ.setdefault("TRAINIUM_LATENCY_PRIOR_MS", str(args.sagemaker_latency_ms))
+    os.environ.setdefault("GEMINI_LATENCY_PRIOR_MS", str(args.gemini_latency_ms))
+
+
+def measure_peak(fn):
+    """Run fn() under tracemalloc and return (result, peak bytes)."""
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def run_memory(args):
+    """Peak memory of each ingestion path as the repository grows."""
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(args, workdir)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import backend
+
+        def uncapped(max_file_size):
+            # No FETCH_MAX_FILES cap, so every path ingests the whole repository
+            return backend.FetchPlan(max_file_size=max_file_size, max_files=0)
+
+        paths = {
+            "document": lambda url: len(backend.document_github_repo_raw(url, plan=uncapped(200000))),
+            "outlines": lambda url: len([backend.FileOutline.from_file(f)
+                                         for f in backend.iter_codebase(url, args.ingest_mode,
+                                                                        plan=uncapped(100000))]),
+            "materialized": lambda url: sum(len(f.text) for f in backend.fetch_codebase(url, args.ingest_mode,
+                                                                                        plan=uncapped(100000))),
+        }
+        results = []
+        for files in [int(n) for n in args.memory_sizes.split(",") if n.strip()]:
+            repo = SyntheticRepo(files, args.file_size)
+            github = FakeGitHub(repo, args.github_latency_ms / 1000).start()
+            backend.GITHUB_API_URL = f"{github.url}/api"
+            backend.GITHUB_RAW_URL = f"{github.url}/raw"
+            repo_bytes = sum(len(data) for data in repo.contents.values())
+            row = {"files": files, "repo_bytes": repo_bytes}
+            print(f"{files} files, {repo_bytes / 1e6:.1f} MB of source:")
+            for name, fn in paths.items():
+                _, peak = measure_peak(lambda: fn("https://github.com/o/r"))
+                row[f"{name}_peak_bytes"] = peak
+                print(f"  {name:<13} peak {peak / 1e6:8.2f} MB  ({peak / files:,.0f} bytes/file)")
+            github.stop()
+            results.append(row)
+    return results
+
+
+def write_git_repo(repo, path):
+    """Commit the synthetic repository's files into a new git repository at `path`."""
+    for name, data in repo.contents.items():
+        full = os.path.join(path, name)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, "wb") as f:
+            f.write(data)
+    git = ["git", "-C", path, "-c", "user.name=bench", "-c", "user.email=bench@example.com"]
+    subprocess.run(["git", "init", "-q", path], check=True)
+    subprocess.run(git + ["add", "-A"], check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "synthetic"], check=True)
+
+
+def run_ingest(args):
+    """Files per second through each ingestion backend for the same repository."""
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(args, workdir)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import backend
+
+        repo = SyntheticRepo(args.files, args.file_size)
+        github = FakeGitHub(repo, args.github_latency_ms / 1000).start()
+        backend.GITHUB_API_URL = f"{github.url}/api"
+        backend.GITHUB_RAW_URL = f"{github.url}/raw"
+        clone = os.path.join(workdir, "clone")
+        write_git_repo(repo, clone)
+        sources = {
+            "raw": lambda: backend.iter_codebase("https://github.com/o/r", "raw", branch="main"),
+            "archive": lambda: backend.iter_codebase("https://github.com/o/r", "archive", branch="main"),
+            "git": lambda: backend.iter_codebase(clone),
+        }
+        results = {}
+        for name, files in sources.items():
+            start = time.perf_counter()
+            count = sum(1 for _ in files())
+            seconds = time.perf_counter() - start
+            results[name] = {"files": count, "seconds": round(seconds, 4),
+                             "files_per_second": round(count / seconds, 1) if seconds else 0.0}
+            print(f"  {name:<8} {count} files in {seconds:7.3f}s  ({results[name]['files_per_second']:,} files/s)")
+        github.stop()
+    return results
+
+
+STARTUP_SNIPPET = """
+import json, time
+start = time.perf_counter()
+import backend
+imported = time.perf_counter()
+backend.create_app()
+timings = {"import": imported - start, "create_app": time.perf_counter() - imported}
+for name in ("get_gemini_model", "get_sagemaker_client"):
+    began = time.perf_counter()
+    getattr(backend, name)()
+    timings[name] = time.perf_counter() - began
+print(json.dumps(timings))
+"""
+
+
+def run_startup(args):
+    """Time backend startup phases in fresh interpreters (nothing is cached between runs)."""
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(args, workdir)
+        here = os.path.dirname(os.path.abspath(__file__))
+        runs = []
+        for i in range(args.startup_runs):
+            out = subprocess.run([sys.executable, "-W", "ignore", "-c", STARTUP_SNIPPET], cwd=here, env=os.environ,
+                                 capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+    results = {}
+    for phase in runs[0]:
+        samples = sorted(run[phase] for run in runs)
+        results[phase] = {"median_ms": round(1000 * statistics.median(samples), 1),
+                          "max_ms": round(1000 * samples[-1], 1)}
+        print(f"  {phase:<22} median {results[phase]['median_ms']:8.1f} ms  max {results[phase]['max_ms']:8.1f} ms")
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("=" * 60)
+    print("Backend Offline Benchmark")
+    print("=" * 60)
+
+    if args.memory or args.startup or args.ingest:
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": vars(args),
+        }
+        if args.ingest:
+            print(f"Ingesting {args.files} files (~{args.file_size} bytes each):")
+            report["ingest"] = run_ingest(args)
+        if args.startup:
+            print(f"Startup over {args.startup_runs} fresh interpreters:")
+            report["startup"] = run_startup(args)
+        if args.memory:
+            report["memory"] = run_memory(args)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("=" * 60)
+        print(f"✓ Results saved to {args.output}")
+        print("=" * 60)
+        return report
+
+    with tempfile.TemporaryDirectory() as workdir:
+        repo = SyntheticRepo(args.files, args.file_size)
+        github = FakeGitHub(repo, args.github_latency_ms / 1000,
+                            FaultInjector(args.fault_rate, args.slow_rate, seed=1)).start()
+        os.environ["GITHUB_API_URL"] = f"{github.url}/api"
+        os.environ["GITHUB_RAW_URL"] = f"{github.url}/raw"
+        configure_environment(args, workdir)
+
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import backend
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        sagemaker = FakeSageMakerRuntime(args.sagemaker_latency_ms / 1000,
+                                         FaultInjector(args.fault_rate, args.slow_rate, seed=2))
+        gemini = FakeGenerativeModel(args.gemini_latency_ms / 1000,
+                                     FaultInjector(args.fault_rate, args.slow_rate, seed=3))
+        backend.sagemaker_client = sagemaker
+        backend.model = gemini
+
+        server = make_server("127.0.0.1", 0, backend.app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        print(f"Synthetic repo: {args.files} files, ~{args.file_size} bytes each")
+        print(f"Backend on {base_url}, fake GitHub on {github.url}\n")
+
+        results = {}
+        for endpoint in [e.strip() for e in args.endpoints.split(",") if e.strip()]:
+            if endpoint == "analyze-batch":
+                print(f"Driving /analyze-batch: {args.requests} repositories on {args.concurrency} workers...")
+                result = results[endpoint] = run_batch(base_url, args.requests, args.concurrency)
+                print(f"  {result['repos_per_minute']} repos/min | {result['mean_seconds_per_repo']} s/repo | "
+                      f"{result['errors']} errors\n")
+                continue
+            print(f"Driving /{endpoint}: {args.requests} requests at concurrency {args.concurrency}...")
+            payloads = build_payloads(endpoint, args.requests, args.repeat, args.deadline_ms)
+            result = run_load(f"{base_url}/{endpoint}", payloads, args.concurrency)
+            results[endpoint] = result
+            print(f"  p50 {result['p50_ms']} ms | p95 {result['p95_ms']} ms | p99 {result['p99_ms']} ms | "
+                  f"{result['rps']} req/s | {result['errors']} errors")
+            if result["routes"]:
+                print(f"  routes: {', '.join(f'{path} {n}' for path, n in sorted(result['routes'].items()))}")
+            print()
+
+        server.shutdown()
+        github.stop()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "results": results,
+        "upstream_calls": {
+            "github_requests": github.requests,
+            "github_api_requests": github.api_requests,
+            "github_not_modified": github.not_modified,
+            "sagemaker_calls": sagemaker.calls,
+            "gemini_calls": gemini.calls,
+        },
+        "injected_faults": {
+            "github": github.faults.stats(),
+            "sagemaker": sagemaker.faults.stats(),
+            "gemini": gemini.faults.stats(),
+        },
+        "upstreams": {name: upstream.stats() for name, upstream in backend.upstreams.items()},
+        "stages": backend.metrics.summary().get("stage_duration_seconds", {}),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print("=" * 60)
+    print(f"✓ Results saved to {args.output}")
+    print("=" * 60)
+    return report
+
+
+if __name__ == "__main__":
+    main()
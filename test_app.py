@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the app factory and lazy client setup (run with:
+python -m pytest test_app.py). No server or API keys needed.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import backend
+from backend import ConfigError, create_app, get_gemini_model, get_sagemaker_client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def unconfigured(monkeypatch):
+    for name in ("GEMINI_API_KEY", "AWS_ACCESS_KEY_ID", "TRAINIUM_ENDPOINT"):
+        monkeypatch.setattr(backend, name, None)
+    monkeypatch.setattr(backend, "model", None)
+    monkeypatch.setattr(backend, "sagemaker_client", None)
+
+
+def test_import_does_no_setup(tmp_path):
+    # Run in an empty folder: nothing may be created there and no model SDK imported
+    code = ("import sys, backend; "
+            "print(sorted(m for m in ('google.generativeai', 'boto3') if m in sys.modules))")
+    env = dict(os.environ, PYTHONPATH=HERE)
+    env.pop("BATCH_STORE_DB", None)
+    env.pop("RESULT_CACHE_DB", None)
+    out = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "[]"
+    assert os.listdir(tmp_path) == []
+
+
+def test_create_app_without_credentials(unconfigured, capsys):
+    app = create_app(warm=True)
+    assert app is backend.app
+    out = capsys.readouterr().out
+    assert "WARNING: Gemini unavailable: GEMINI_API_KEY not configured" in out
+    assert "WARNING: Trainium unavailable" in out
+
+
+def test_health_reports_unconfigured_upstreams(unconfigured):
+    health = create_app().test_client().get("/health").get_json()
+    assert health["status"] == "degraded"
+    gemini = health["upstreams"]["gemini"]
+    assert not gemini["configured"] and not gemini["ready"] and not gemini["client"]
+    assert health["upstreams"]["github"]["ready"]
+
+
+def test_clients_are_not_created_without_credentials(unconfigured):
+    with pytest.raises(ConfigError, match="GEMINI_API_KEY"):
+        get_gemini_model()
+    with pytest.raises(ConfigError, match="AWS_ACCESS_KEY_ID"):
+        get_sagemaker_client()
+
+
+def test_assigned_clients_are_used(unconfigured, monkeypatch):
+    fake = object()
+    monkeypatch.setattr(backend, "model", fake)
+    assert get_gemini_model() is fake
+
+
+def test_clients_from_a_parent_process_are_dropped(unconfigured, monkeypatch):
+    monkeypatch.setattr(backend, "model", object())
+    monkeypatch.setattr(backend, "_client_pid", -1)
+    # After a fork the inherited client is discarded and rebuilt (here: not configured)
+    with pytest.raises(ConfigError):
+        get_gemini_model()
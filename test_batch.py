@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Unit tests for batch precomputation: the precomputed store, BatchRun and
+the /analyze-batch request checks (run with: python -m pytest test_batch.py).
+Analyses are stubbed, so no server, network or API keys are needed.
+"""
+
+import pytest
+
+import backend
+from backend import BatchRun, FetchPlan, Job, ResultCache, load_precomputed, save_precomputed
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch):
+    store = ResultCache(ttl=None)
+    monkeypatch.setattr(backend, "precomputed_store", store)
+    return store
+
+
+def result(repo_url, fallback=None):
+    return {'success': True, 'repo_url': repo_url, 'explanation': 'An app.', 'mermaid': 'graph TB\n    A --> B',
+            'context': {'files': 2}, 'plan': {}, 'fallback': fallback,
+            'route': {'path': 'full'}, 'timings_ms': {'total': 1.0}, 'coalesced': False}
+
+
+OPTIONS = {'ingest_mode': None, 'context_tokens': None, 'analysis_mode': None, 'incremental': None,
+           'plan': {'include': None, 'exclude': None, 'max_files': None}}
+
+
+def test_precomputed_result_round_trip():
+    save_precomputed(result("https://github.com/o/r"), "batch-1")
+    loaded = load_precomputed("https://github.com/O/R.git")
+    assert loaded['mermaid'] == 'graph TB\n    A --> B'
+    assert loaded['precomputed']['batch_id'] == "batch-1"
+    # Per-request fields are not stored
+    assert 'route' not in loaded and 'timings_ms' not in loaded and 'coalesced' not in loaded
+
+
+def test_precomputed_result_is_keyed_on_options():
+    save_precomputed(result("https://github.com/o/r"), "batch-1", analysis_mode="static")
+    assert load_precomputed("https://github.com/o/r") is None
+    assert load_precomputed("https://github.com/o/r", analysis_mode="static") is not None
+    plan = FetchPlan(max_file_size=100000, include_globs=["src/*"])
+    assert load_precomputed("https://github.com/o/r", analysis_mode="static", plan=plan) is None
+
+
+def test_batch_run_stores_only_complete_results(monkeypatch):
+    def analyze(repo_url, **kwargs):
+        if repo_url.endswith("/broken"):
+            raise RuntimeError("fetch failed")
+        return result(repo_url, fallback="static" if repo_url.endswith("/degraded") else None)
+
+    monkeypatch.setattr(backend, "run_analysis_coalesced", analyze)
+    urls = ["https://github.com/o/good", "https://github.com/o/degraded", "https://github.com/o/broken"]
+    batch = BatchRun(urls, OPTIONS)
+    job = Job('analyze-batch', {})
+    summary = batch.run(job, max_workers=2)
+
+    assert summary['counts'] == {'queued': 0, 'running': 0, 'done': 2, 'failed': 1}
+    repos = {entry['repo_url']: entry for entry in batch.to_dict()['repos']}
+    assert repos[urls[0]]['precomputed'] and not repos[urls[1]]['precomputed']
+    assert repos[urls[2]]['error'] == "fetch failed"
+    assert load_precomputed(urls[0]) is not None
+    assert load_precomputed(urls[1]) is None
+    assert [event['stage'] for event in job.events] == ['repo'] * 3
+
+
+@pytest.fixture
+def client():
+    return backend.app.test_client()
+
+
+def test_batch_request_without_repositories(client):
+    assert client.post('/analyze-batch', json={}).status_code == 400
+
+
+def test_batch_request_with_only_invalid_entries(client):
+    response = client.post('/analyze-batch', json={'repo_urls': ['foo', 'https://github.com/']})
+    assert response.status_code == 400
+    assert [entry['repo_url'] for entry in response.get_json()['invalid']] == ['foo', 'https://github.com/']
+
+
+@pytest.mark.parametrize("workers", [0, 10 ** 6, "8", 2.5, True])
+def test_batch_request_rejects_bad_worker_counts(client, workers):
+    response = client.post('/analyze-batch', json={'repo_urls': ['https://github.com/o/r'], 'workers': workers})
+    assert response.status_code == 400
+    assert 'workers' in response.get_json()['error']
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the offline benchmark's stand-ins: the synthetic
+repository, the local fake GitHub server and the fake model clients (run
+with: python -m pytest test_benchmark.py). Everything listens on
+127.0.0.1, so no network or API keys are needed.
+"""
+
+import io
+import json
+import tarfile
+
+import pytest
+import requests
+
+from benchmark import (FakeGenerativeModel, FakeGitHub, FakeSageMakerRuntime, FaultInjector, SyntheticRepo,
+                       git_blob_sha, percentile)
+
+
+@pytest.fixture
+def github():
+    fake = FakeGitHub(SyntheticRepo(20, 300)).start()
+    yield fake
+    fake.stop()
+
+
+def test_synthetic_repo_is_deterministic():
+    a, b = SyntheticRepo(30, 500), SyntheticRepo(30, 500)
+    assert a.contents == b.contents and len(a.paths) == 30
+    assert all(450 < len(data) < 650 for data in a.contents.values())
+    entry = a.tree()["tree"][0]
+    assert entry["sha"] == git_blob_sha(a.contents[entry["path"]])
+
+
+def test_tarball_holds_every_file_under_one_root():
+    repo = SyntheticRepo(10, 200)
+    with tarfile.open(fileobj=io.BytesIO(repo.tarball("r")), mode="r:gz") as tar:
+        files = {m.name: tar.extractfile(m).read() for m in tar.getmembers() if m.isfile()}
+    assert files == {f"r-main/{path}": data for path, data in repo.contents.items()}
+
+
+def test_fake_github_serves_tree_and_raw_files(github):
+    tree = requests.get(f"{github.url}/api/repos/o/r/git/trees/main").json()
+    path = tree["tree"][0]["path"]
+    raw = requests.get(f"{github.url}/raw/o/r/main/{path}")
+    assert raw.content == github.repo.contents[path]
+    assert requests.get(f"{github.url}/raw/o/r/main/missing.py").status_code == 404
+
+
+def test_fake_github_answers_conditional_requests(github):
+    url = f"{github.url}/api/repos/o/r"
+    first = requests.get(url)
+    assert first.json()["default_branch"] == "main"
+    assert int(first.headers["X-RateLimit-Remaining"]) == github.rate_limit - 1
+    second = requests.get(url, headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 304 and github.not_modified == 1
+
+
+def test_fault_injection(github):
+    github.faults = FaultInjector(fault_rate=1.0)
+    assert requests.get(f"{github.url}/api/repos/o/r").status_code == 503
+    assert github.faults.stats() == {"faults": 1, "slow": 0}
+    slow = FaultInjector(slow_rate=1.0, slow_factor=4)
+    assert slow.latency(0.5) == 2.0 and FaultInjector().latency(0.5) == 0.5
+
+
+def test_fake_sagemaker_answers_single_and_batched_prompts():
+    client = FakeSageMakerRuntime()
+    single = json.loads(client.invoke_endpoint("e", json.dumps({"inputs": "abc"}))["Body"].read())
+    assert "3 chars analyzed" in single[0]["generated_text"]
+    batch = json.loads(client.invoke_endpoint("e", json.dumps({"inputs": ["a", "bb"]}))["Body"].read())
+    assert len(batch) == 2 and client.calls == 2
+    with pytest.raises(ConnectionError):
+        FakeSageMakerRuntime(faults=FaultInjector(fault_rate=1.0)).invoke_endpoint("e", json.dumps({"inputs": "a"}))
+
+
+def test_fake_gemini_returns_a_mermaid_block():
+    assert "```mermaid\ngraph TB" in FakeGenerativeModel().generate_content("prompt").text
+
+
+def test_percentile():
+    values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert percentile(values, 50) == 5
+    assert percentile(values, 95) == 10
+    assert percentile(values, 0) == 1
+    assert percentile([], 99) == 0.0
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the blob cache and the result cache (run with:
+python -m pytest test_caches.py).
+No server or API keys needed.
+"""
+
+import os
+import time
+
+from backend import BlobCache, ResultCache
+
+sha = BlobCache.git_blob_sha
+
+
+def test_blob_round_trip(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1000)
+    data = b"print('hello')\n"
+    assert cache.get(sha(data)) is None
+    cache.put(sha(data), data)
+    assert cache.get(sha(data)) == data
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_git_blob_sha_matches_git():
+    # `printf 'hello\n' | git hash-object --stdin`
+    assert sha(b"hello\n") == "ce013625030ba8dba906f756967f9e9ca394464a"
+
+
+def test_content_that_does_not_match_its_sha_is_ignored(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1000)
+    cache.put(sha(b"one"), b"two")
+    assert cache.get(sha(b"one")) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_blobs_are_evicted(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=25)
+    blobs = [bytes([ord("a") + i]) * 10 for i in range(3)]
+    cache.put(sha(blobs[0]), blobs[0])
+    cache.put(sha(blobs[1]), blobs[1])
+    cache.get(sha(blobs[0]))
+    cache.put(sha(blobs[2]), blobs[2])
+    assert cache.get(sha(blobs[1])) is None
+    assert cache.get(sha(blobs[0])) == blobs[0] and cache.get(sha(blobs[2])) == blobs[2]
+    assert cache.stats()["bytes"] == 20 and cache.stats()["evictions"] == 1
+    assert not os.path.exists(cache._path(sha(blobs[1])))
+
+
+def test_blob_larger_than_the_cache_is_not_stored(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=5)
+    cache.put(sha(b"too large"), b"too large")
+    assert cache.stats()["entries"] == 0
+
+
+def test_index_is_rebuilt_from_disk(tmp_path):
+    BlobCache(str(tmp_path), max_bytes=1000).put(sha(b"kept"), b"kept")
+    cache = BlobCache(str(tmp_path), max_bytes=1000)
+    assert cache.get(sha(b"kept")) == b"kept"
+    assert cache.stats()["bytes"] == 4
+
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ResultCache(max_entries=2, ttl=None)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
+    assert cache.stats()["entries"] == 2
+
+
+def test_result_cache_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = ResultCache(max_entries=10, ttl=60)
+    cache.put("a", "1")
+    now[0] += 59
+    assert cache.get("a") == "1"
+    now[0] += 2
+    assert cache.get("a") is None
+
+
+def test_result_cache_memory_bounded_by_size(tmp_path):
+    cache = ResultCache(max_entries=10, ttl=None, db_path=str(tmp_path / "cache.db"), max_bytes=10)
+    cache.put("a", "x" * 6)
+    cache.put("b", "y" * 4)
+    cache.put("c", "z" * 4)
+    assert cache.stats()["memory_bytes"] == 8
+    # Evicted from memory, still on disk
+    assert cache.get("a") == "x" * 6
+    assert cache.disk_hits == 1
+    # Larger than the memory bound: kept on disk only
+    cache.put("big", "w" * 20)
+    assert cache.get("big") == "w" * 20
+    assert cache.stats()["memory_bytes"] <= 10
+
+
+def test_result_cache_persists_across_instances(tmp_path):
+    db = str(tmp_path / "cache.db")
+    ResultCache(db_path=db, table="one").put("k", "v")
+    assert ResultCache(db_path=db, table="one").get("k") == "v"
+    assert ResultCache(db_path=db, table="two").get("k") is None
+
+
+def test_result_cache_key_ignores_whitespace_differences():
+    key = ResultCache.make_key("model", "graph TB\r\n  A --> B   \n")
+    assert key == ResultCache.make_key("model", "graph TB\n  A --> B")
+    assert key != ResultCache.make_key("other-model", "graph TB\n  A --> B")
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Unit tests for request coalescing with SingleFlight (run with:
+python -m pytest test_coalescing.py). No server or API keys needed.
+"""
+
+import threading
+import time
+
+import pytest
+
+from backend import SingleFlight, normalize_repo_url
+
+
+def run_followers(flight, key, count, results, on_progress=None):
+    """Start `count` callers of flight.do(key) that must join the running leader."""
+    def follower():
+        try:
+            results.append(flight.do(key, lambda publish: "follower ran", on_progress))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=follower) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 2
+    while flight.stats()["coalesced"] < count and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return threads
+
+
+def test_concurrent_calls_share_one_run():
+    flight = SingleFlight("test")
+    calls = []
+    results = []
+
+    def leader_fn(publish):
+        calls.append(None)
+        threads = run_followers(flight, "k", 3, results)
+        return "result", threads
+
+    (_, threads), coalesced = flight.do("k", leader_fn)
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and not coalesced
+    assert results == [(("result", threads), True)] * 3
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 3}
+
+
+def test_followers_receive_earlier_and_later_progress():
+    flight = SingleFlight("test")
+    seen = []
+    results = []
+
+    def leader_fn(publish):
+        publish("fetching")
+        threads = run_followers(flight, "k", 1, results,
+                                on_progress=lambda stage, **info: seen.append((stage, info)))
+        publish("files", fetched=3)
+        return threads
+
+    threads, _ = flight.do("k", leader_fn)
+    for thread in threads:
+        thread.join()
+    assert seen == [("fetching", {}), ("files", {"fetched": 3})]
+
+
+def test_errors_reach_every_caller():
+    flight = SingleFlight("test")
+    results = []
+
+    def leader_fn(publish):
+        threads = run_followers(flight, "k", 2, results)
+        leader_fn.threads = threads
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError):
+        flight.do("k", leader_fn)
+    for thread in leader_fn.threads:
+        thread.join()
+    assert [type(r) for r in results] == [ValueError, ValueError]
+
+
+def test_calls_after_completion_run_again():
+    flight = SingleFlight("test")
+    assert flight.do("k", lambda publish: 1) == (1, False)
+    assert flight.do("k", lambda publish: 2) == (2, False)
+    assert flight.do("other", lambda publish: 3) == (3, False)
+    assert flight.stats()["coalesced"] == 0
+
+
+def test_repository_urls_are_compared_normalized():
+    assert normalize_repo_url("https://github.com/Owner/Repo.git/") == normalize_repo_url("github.com/owner/repo")
+    assert normalize_repo_url("https://github.com/owner/repo") != normalize_repo_url("https://github.com/owner/other")
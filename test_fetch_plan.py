@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Unit tests for FetchPlan, which picks the files to download from paths and
+sizes alone (run with: python -m pytest test_fetch_plan.py).
+No server or API keys needed.
+"""
+
+import io
+import tarfile
+
+from backend import FetchPlan, _fetch_plan_from_request, _tar_files
+
+
+def decisions(plan, files):
+    return {path: plan.decide(path, size) for path, size in files}
+
+
+def test_default_decisions():
+    plan = FetchPlan(max_file_size=1000, max_files=0)
+    assert decisions(plan, [
+        ("src/app.py", 100),
+        ("README.md", 100),
+        ("node_modules/lib/index.js", 100),
+        ("vendor/pkg/a.go", 100),
+        ("static/app.min.js", 100),
+        ("api/service_pb2.py", 100),
+        ("src/big.py", 5000),
+    ]) == {
+        "src/app.py": None,
+        "README.md": "extension",
+        "node_modules/lib/index.js": "excluded",
+        "vendor/pkg/a.go": "excluded",
+        "static/app.min.js": "excluded",
+        "api/service_pb2.py": "excluded",
+        "src/big.py": "size",
+    }
+
+
+def test_include_globs():
+    plan = FetchPlan(include_globs=["src/*"], max_files=0)
+    assert plan.decide("src/app.py") is None
+    assert plan.decide("scripts/tool.py") == "not_included"
+
+
+def test_custom_excludes_replace_the_defaults():
+    plan = FetchPlan(exclude_globs=["*/legacy/*"], max_files=0)
+    assert plan.decide("legacy/old.py") == "excluded"
+    assert plan.decide("vendor/pkg/a.go") is None
+
+
+def test_max_files_counts_selected_files_only():
+    plan = FetchPlan(max_files=2)
+    results = [plan.decide(path, 10) for path in ["a.py", "notes.txt", "b.py", "c.py"]]
+    assert results == [None, "extension", None, "max_files"]
+
+
+def test_unknown_size_is_not_skipped_for_size():
+    plan = FetchPlan(max_file_size=10, max_files=0)
+    assert plan.decide("a.py") is None
+
+
+def test_summary():
+    plan = FetchPlan(max_file_size=1000, max_files=0)
+    decisions(plan, [("a.py", 100), ("b.py", 50), ("c.txt", 30), ("d.py", 2000)])
+    summary = plan.to_dict()
+    assert summary["considered"] == 4
+    assert summary["selected"] == 2 and summary["selected_bytes"] == 150
+    assert summary["skipped"] == {"extension": 1, "size": 1}
+    assert summary["skipped_files"] == 2 and summary["skipped_bytes"] == 2030
+
+
+def test_request_options_accept_comma_separated_globs():
+    plan = _fetch_plan_from_request(include="src/*, lib/*", exclude="*/gen/*", max_files="5")
+    assert plan.include_globs == ["src/*", "lib/*"]
+    assert plan.exclude_globs == ["*/gen/*"]
+    assert plan.max_files == 5
+
+
+def test_archive_members_are_planned_before_reading():
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tar:
+        for name, text in [("repo-main/app.py", b"import os\n"), ("repo-main/big.py", b"x" * 500),
+                           ("repo-main/notes.txt", b"notes\n")]:
+            info = tarfile.TarInfo(name)
+            info.size = len(text)
+            tar.addfile(info, io.BytesIO(text))
+    data.seek(0)
+    plan = FetchPlan(max_file_size=100, max_files=0)
+    with tarfile.open(fileobj=data, mode="r:gz") as tar:
+        files = list(_tar_files(tar, plan, root="repo-main/"))
+    assert [(f.path, f.text) for f in files] == [("app.py", "import os\n"), ("big.py", None)]
+    assert "Skipped big.py" in files[1].note
+    assert plan.to_dict()["skipped"] == {"size": 1, "extension": 1}
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the GitHub request scheduler: token rotation, rate-limit
+handling and ETag revalidation (run with: python -m pytest test_github_scheduler.py).
+Uses a fake session, so no network or tokens are needed.
+"""
+
+import json
+import time
+
+import pytest
+
+from backend import GitHubScheduler, RepoFetchError, ResultCache, github_retry_delay
+
+URL = "https://api.github.com/repos/o/r"
+
+
+class Resp:
+    def __init__(self, status, body=None, headers=None):
+        self.status_code = status
+        self.text = json.dumps(body) if body is not None else ""
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+    def close(self):
+        pass
+
+
+class Session:
+    """Answers each GET with the next queued response (or the last one) and records the headers."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+def limits(remaining, reset_in=3600, limit=5000):
+    return {"X-RateLimit-Remaining": str(remaining), "X-RateLimit-Limit": str(limit),
+            "X-RateLimit-Reset": str(int(time.time() + reset_in))}
+
+
+def scheduler(tokens=("a", "b"), **kwargs):
+    return GitHubScheduler(list(tokens), cache=ResultCache(ttl=None), **kwargs)
+
+
+def test_retry_delay():
+    assert github_retry_delay(Resp(200)) is None
+    assert github_retry_delay(Resp(404)) is None
+    assert github_retry_delay(Resp(502)) == 0.0
+    assert github_retry_delay(Resp(429, headers={"Retry-After": "7"})) == 7.0
+    assert github_retry_delay(Resp(403, headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "0"})) == 0.0
+    # A 403 that is not a rate limit (e.g. no access) is returned as is
+    assert github_retry_delay(Resp(403)) is None
+
+
+def test_rate_limited_token_is_skipped():
+    s = scheduler()
+    session = Session(Resp(403, {"message": "rate limited"}, limits(0)), Resp(200, {"id": 1}, limits(4000)))
+    assert s.get(URL, session=session).status_code == 200
+    assert [r["Authorization"] for r in session.requests] == ["token a", "token b"]
+    # Token a stays out of rotation until its reset
+    s.get(URL, session=session)
+    s.get(URL, session=session)
+    assert [r["Authorization"] for r in session.requests[2:]] == ["token b", "token b"]
+    assert s.stats()["rate_limited"] == 1
+
+
+def test_tokens_take_turns():
+    s = scheduler()
+    session = Session(Resp(200, {}, limits(4000)))
+    for _ in range(4):
+        s.get(URL, session=session)
+    assert sorted(r["Authorization"] for r in session.requests) == ["token a", "token a", "token b", "token b"]
+
+
+def test_fails_fast_when_every_token_is_exhausted():
+    s = scheduler(max_wait=5)
+    session = Session(Resp(403, {"message": "rate limited"}, limits(0, reset_in=600)))
+    s.get(URL, session=session)
+    with pytest.raises(RepoFetchError, match="rate limit exhausted"):
+        s.get(URL, session=session)
+
+
+def test_rate_limit_without_reset_rests_the_token():
+    s = scheduler(tokens=["a"], max_wait=5, backoff=60)
+    session = Session(Resp(429, {"message": "slow down"}), Resp(200, {}))
+    # The retry finds the only token resting for 60s and gives up instead of spinning
+    start = time.monotonic()
+    with pytest.raises(RepoFetchError, match="resets in 60s"):
+        s.get(URL, session=session)
+    assert len(session.requests) == 1
+    assert time.monotonic() - start < 5
+
+
+def test_unchanged_resource_is_served_from_the_etag_cache():
+    s = scheduler(tokens=["a"])
+    session = Session(Resp(200, {"default_branch": "main"}, {"ETag": '"v1"'}), Resp(304))
+    assert s.get_json(URL, session=session) == {"default_branch": "main"}
+    assert s.get_json(URL, session=session) == {"default_branch": "main"}
+    assert "If-None-Match" not in session.requests[0]
+    assert session.requests[1]["If-None-Match"] == '"v1"'
+    assert s.stats()["not_modified"] == 1
+
+
+def test_changed_resource_replaces_the_stored_copy():
+    s = scheduler(tokens=["a"])
+    session = Session(Resp(200, {"v": 1}, {"ETag": '"v1"'}), Resp(200, {"v": 2}, {"ETag": '"v2"'}), Resp(304))
+    s.get_json(URL, session=session)
+    assert s.get_json(URL, session=session) == {"v": 2}
+    assert s.get_json(URL, session=session) == {"v": 2}
+    assert session.requests[2]["If-None-Match"] == '"v2"'
+
+
+def test_error_answers_raise():
+    s = scheduler(tokens=["a"])
+    with pytest.raises(RepoFetchError, match="404"):
+        s.get_json(URL, session=Session(Resp(404, {"message": "Not Found"})), what="repository")
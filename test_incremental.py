@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Unit tests for incremental re-analysis: tree diffs and snapshot reuse
+(run with: python -m pytest test_incremental.py). Uses a throwaway local
+git repository and the static analysis mode, so no server, network or API
+keys are needed.
+"""
+
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import backend
+from backend import ResultCache, diff_trees, run_analysis
+
+needs_git = pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+
+
+def commit(path, files):
+    for name, text in files.items():
+        full = path / name
+        full.parent.mkdir(parents=True, exist_ok=True)
+        full.write_text(text)
+    git = ["git", "-C", str(path), "-c", "user.name=test", "-c", "user.email=test@example.com"]
+    subprocess.run(git + ["add", "-A"], check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "change"], check=True)
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, "LOCAL_REPO_ROOTS", [os.path.realpath(tmp_path)])
+    monkeypatch.setattr(backend, "analysis_store", ResultCache(ttl=None))
+    subprocess.run(["git", "init", "-q", str(tmp_path)], check=True)
+    commit(tmp_path, {
+        "main.py": "from app import core\n\ndef main():\n    core.run()\n",
+        "app/__init__.py": "VALUE = 1\n",
+        "app/core.py": "from app import db\n\ndef run():\n    return db.load()\n",
+        "app/db.py": "def load():\n    return 1\n",
+    })
+    return tmp_path
+
+
+def analyze(path):
+    return run_analysis(str(path), analysis_mode="static", incremental=True)
+
+
+def test_diff_trees():
+    old = {"a.py": "1", "b.py": "2", "c.py": "3"}
+    new = {"a.py": "1", "b.py": "9", "d.py": "4"}
+    assert diff_trees(old, new) == {"added": 1, "modified": 1, "removed": 1}
+
+
+@needs_git
+def test_unchanged_tree_reuses_the_stored_result(repo):
+    first = analyze(repo)
+    assert first["incremental"]["enabled"] and not first["incremental"]["reused_result"]
+    second = analyze(repo)
+    assert second["route"] == {"path": "reused", "reason": "tree unchanged"}
+    assert second["incremental"]["previous_tree_sha"] == first["incremental"]["tree_sha"]
+    assert second["mermaid"] == first["mermaid"]
+
+
+@needs_git
+def test_only_changed_files_are_read_again(repo):
+    first = analyze(repo)
+    # A new function body with the same imports leaves the static input unchanged
+    commit(repo, {"app/db.py": "def load():\n    return 2\n"})
+    second = analyze(repo)
+    assert second["incremental"]["modified"] == 1
+    assert second["incremental"]["reused_summaries"] == 3
+    assert second["route"] == {"path": "reused", "reason": "packed context unchanged"}
+    assert second["mermaid"] == first["mermaid"]
+
+
+@needs_git
+def test_changed_imports_are_analyzed_again(repo):
+    analyze(repo)
+    commit(repo, {"app/api.py": "from app import core\n"})
+    result = analyze(repo)
+    assert result["incremental"]["added"] == 1
+    assert not result["incremental"]["reused_result"]
+    assert result["route"]["path"] == "static"
+
+
+@needs_git
+def test_snapshot_from_other_settings_is_not_reused(repo):
+    analyze(repo)
+    result = run_analysis(str(repo), analysis_mode="static", incremental=True,
+                          plan=backend.FetchPlan(max_file_size=100000, exclude_globs=["*/db.py"]))
+    assert result["incremental"]["previous_tree_sha"] is None
+    assert not result["incremental"]["reused_result"]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Unit tests for local repository ingestion: the LOCAL_REPO_ROOTS check,
+git-backed file reading and local archives (run with:
+python -m pytest test_local_git.py). Uses throwaway repositories under a
+temporary folder, so no server, network or API keys are needed.
+"""
+
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+import backend
+from backend import FetchPlan, RepoFetchError, allowed_local_path, iter_codebase, iter_local_git_files
+
+needs_git = pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+
+
+def git(path, *args):
+    subprocess.run(["git", "-C", str(path), "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+                   check=True, capture_output=True)
+
+
+def commit(path, files):
+    for name, text in files.items():
+        full = path / name
+        full.parent.mkdir(parents=True, exist_ok=True)
+        full.write_text(text)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "change")
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, "LOCAL_REPO_ROOTS", [os.path.realpath(tmp_path)])
+    return tmp_path
+
+
+@pytest.fixture
+def repo(root):
+    path = root / "repo"
+    subprocess.run(["git", "init", "-q", "-b", "main", str(path)], check=True)
+    commit(path, {"main.py": "print('hi')\n", "lib/util.py": "X = 1\n"})
+    return path
+
+
+def read(source, **kwargs):
+    return {f.path: f.text for f in iter_local_git_files(str(source), **kwargs)}
+
+
+def test_remote_urls_are_not_local(root):
+    assert allowed_local_path("https://github.com/o/r") is None
+    assert allowed_local_path("github.com/o/r") is None
+
+
+def test_local_paths_need_local_repo_roots(root, monkeypatch):
+    monkeypatch.setattr(backend, "LOCAL_REPO_ROOTS", [])
+    with pytest.raises(RepoFetchError, match="disabled"):
+        allowed_local_path(str(root))
+
+
+def test_paths_outside_the_roots_are_rejected(root):
+    with pytest.raises(RepoFetchError, match="outside LOCAL_REPO_ROOTS"):
+        allowed_local_path("/etc/passwd")
+    # .. and symlinks are resolved before the check
+    with pytest.raises(RepoFetchError, match="outside LOCAL_REPO_ROOTS"):
+        allowed_local_path(str(root / ".." / ".."))
+    os.symlink("/etc", root / "escape")
+    with pytest.raises(RepoFetchError, match="outside LOCAL_REPO_ROOTS"):
+        allowed_local_path(str(root / "escape"))
+
+
+def test_file_urls_are_accepted(root):
+    path = os.path.realpath(root / "some repo")
+    assert allowed_local_path("file://" + str(root / "some%20repo")) == path
+
+
+@needs_git
+def test_only_committed_content_is_read(repo):
+    (repo / "main.py").write_text("print('uncommitted')\n")
+    (repo / "new.py").write_text("Y = 2\n")
+    assert read(repo) == {"main.py": "print('hi')\n", "lib/util.py": "X = 1\n"}
+
+
+@needs_git
+def test_branches_are_read_without_checking_them_out(repo):
+    git(repo, "checkout", "-q", "-b", "feature")
+    commit(repo, {"feature.py": "Z = 3\n"})
+    git(repo, "checkout", "-q", "main")
+    assert "feature.py" not in read(repo)
+    assert "feature.py" in read(repo, branch="feature")
+    with pytest.raises(RepoFetchError, match="rev-parse"):
+        read(repo, branch="missing")
+
+
+@needs_git
+def test_plan_chooses_the_files(repo):
+    commit(repo, {"big.py": "x = 1\n" * 100})
+    files = list(iter_local_git_files(str(repo), plan=FetchPlan(max_file_size=100, exclude_globs=["lib/*"])))
+    by_path = {f.path: f for f in files}
+    assert "lib/util.py" not in by_path
+    assert by_path["big.py"].text is None and by_path["big.py"].note
+    assert by_path["main.py"].text == "print('hi')\n"
+
+
+def test_missing_and_non_git_folders_raise(root):
+    with pytest.raises(RepoFetchError, match="does not exist"):
+        read(root / "missing")
+    (root / "plain").mkdir()
+    with pytest.raises(RepoFetchError):
+        read(root / "plain")
+
+
+def test_local_archives_are_read_in_any_mode(root):
+    archive = root / "project.tar.gz"
+    with tarfile.open(archive, "w:gz") as tar:
+        data = b"def run():\n    pass\n"
+        info = tarfile.TarInfo("project-main/app.py")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    for mode in ("raw", "archive"):
+        files = list(iter_codebase(str(archive), mode=mode))
+        assert [(f.path, f.text) for f in files] == [("app.py", "def run():\n    pass\n")]
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Unit tests for repair_mermaid (run with: python -m pytest test_mermaid.py).
+No server or API keys needed.
+"""
+
+import pytest
+
+from backend import repair_mermaid
+
+
+def body(code):
+    """The repaired statements without the header and indentation."""
+    return [line.strip() for line in code.split("\n")[1:]]
+
+
+def test_valid_diagram_is_unchanged():
+    code, fixes, errors = repair_mermaid("graph TB\n    A[App] --> B[DB]")
+    assert code == "graph TB\n    A[App] --> B[DB]"
+    assert fixes == [] and errors == []
+
+
+def test_adds_missing_header():
+    code, fixes, errors = repair_mermaid("A --> B")
+    assert code.startswith("graph TB\n")
+    assert "added the missing 'graph TB' header" in fixes
+    assert errors == []
+
+
+def test_renames_ids_consistently():
+    code, fixes, errors = repair_mermaid("graph TB\n    my app[App] --> end\n    my app --> B")
+    assert body(code) == ["my_app[App] --> end_node[end]", "my_app --> B"]
+    assert errors == []
+
+
+def test_quotes_special_characters_in_labels():
+    code, _, errors = repair_mermaid("graph TB\n    A[Calls (sync)] --> B")
+    assert body(code) == ['A["Calls (sync)"] --> B']
+    assert errors == []
+
+
+def test_joins_statement_split_across_lines():
+    code, fixes, errors = repair_mermaid("graph TB\n    A -->\n    B")
+    assert body(code) == ["A --> B"]
+    assert "joined a statement split across lines" in fixes
+
+
+def test_closes_unterminated_subgraph():
+    code, fixes, errors = repair_mermaid("graph TB\n    subgraph API\n    A --> B")
+    assert body(code) == ["subgraph API", "A --> B", "end"]
+    assert "closed an unterminated subgraph" in fixes
+
+
+@pytest.mark.parametrize("edge", ["-->", "---", "-.->", "-.-", "==>", "===", "--o", "--x", "<-->", "o--o", "x--x"])
+def test_edge_operators_are_kept(edge):
+    code, fixes, errors = repair_mermaid(f"graph TB\n    A {edge} B")
+    assert body(code) == [f"A {edge} B"]
+    assert fixes == [] and errors == []
+
+
+def test_circle_and_cross_heads_need_a_space():
+    code, _, errors = repair_mermaid("graph TB\n    A --> xray\n    B --> ox[Ox]")
+    assert body(code) == ["A --> xray", "B --> ox[Ox]"]
+    assert errors == []
+
+
+def test_edge_labels():
+    code, _, errors = repair_mermaid("graph TB\n    A -- uses --o B\n    A -->|reads| C")
+    assert body(code) == ["A --o|uses| B", "A -->|reads| C"]
+    assert errors == []
+
+
+def test_flag_shape():
+    code, fixes, errors = repair_mermaid("graph TB\n    B>flag] --> C")
+    assert body(code) == ["B>flag] --> C"]
+    assert fixes == [] and errors == []
+
+
+def test_class_suffix_stays_on_the_node():
+    code, fixes, errors = repair_mermaid("graph TB\n    A:::hot --> B[DB]:::cold & C\n    classDef hot fill:#f96")
+    assert body(code) == ["A:::hot --> B[DB]:::cold & C", "classDef hot fill:#f96"]
+    assert fixes == [] and errors == []
+
+
+def test_class_suffix_on_a_renamed_node():
+    code, _, errors = repair_mermaid("graph TB\n    my app:::hot --> B")
+    assert body(code) == ["my_app[my app]:::hot --> B"]
+    assert errors == []
+
+
+@pytest.mark.parametrize("statement", ["A --* B", "A -> B", "A <-- B"])
+def test_unknown_edges_are_errors(statement):
+    code, _, errors = repair_mermaid(f"graph TB\n    {statement}")
+    assert len(errors) == 1 and "unrecognized edge" in errors[0]
+    # The statement is left for the model to fix, not turned into a node
+    assert body(code) == [statement]
+
+
+def test_two_nodes_without_edge_is_an_error():
+    _, _, errors = repair_mermaid("graph TB\n    A[One] B[Two]")
+    assert errors and "unexpected text after node" in errors[0]
+
+
+def test_empty_diagram_is_an_error():
+    _, _, errors = repair_mermaid("graph TB")
+    assert errors == ["the diagram has no nodes"]
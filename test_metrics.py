@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Unit tests for per-stage instrumentation and the /metrics endpoint (run
+with: python -m pytest test_metrics.py). No server or API keys needed.
+"""
+
+import pytest
+
+import backend
+from backend import Metrics
+
+
+def test_counters_are_kept_per_label_set():
+    m = Metrics(prefix="test")
+    m.inc("requests_total", endpoint="/a")
+    m.inc("requests_total", 2, endpoint="/a")
+    m.inc("requests_total", endpoint="/b")
+    text = m.render()
+    assert "# TYPE test_requests_total counter" in text
+    assert 'test_requests_total{endpoint="/a"} 3' in text
+    assert 'test_requests_total{endpoint="/b"} 1' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    m = Metrics(prefix="test")
+    for value in (0.003, 0.2, 7):
+        m.observe("latency_seconds", value)
+    text = m.render()
+    assert 'test_latency_seconds_bucket{le="0.005"} 1' in text
+    assert 'test_latency_seconds_bucket{le="0.25"} 2' in text
+    assert 'test_latency_seconds_bucket{le="10"} 3' in text
+    assert 'test_latency_seconds_bucket{le="+Inf"} 3' in text
+    assert "test_latency_seconds_count 3" in text
+
+
+def test_timer_records_duration_and_errors():
+    m = Metrics(prefix="test")
+    with m.timer("fetch"):
+        pass
+    with pytest.raises(ValueError):
+        with m.timer("fetch"):
+            raise ValueError("boom")
+    assert m.summary()["stage_duration_seconds"]["stage=fetch"]["count"] == 2
+    assert 'test_stage_errors_total{stage="fetch"} 1' in m.render()
+
+
+def test_label_values_are_escaped():
+    m = Metrics(prefix="test")
+    m.inc("errors_total", reason='bad "quote"\nnext')
+    assert 'test_errors_total{reason="bad \\"quote\\"\\nnext"} 1' in m.render()
+
+
+def test_collectors_are_read_at_scrape_time():
+    m = Metrics(prefix="test")
+    size = [1]
+    m.add_collector(lambda: [("queue_depth", "gauge", "Jobs waiting", {}, size[0])])
+    assert "test_queue_depth 1" in m.render()
+    size[0] = 5
+    text = m.render()
+    assert "# TYPE test_queue_depth gauge" in text and "test_queue_depth 5" in text
+
+
+def test_metrics_endpoint():
+    response = backend.app.test_client().get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert response.get_data(as_text=True).endswith("\n")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Unit tests for context packing: extract_outline, rank_files, pack_context
+and split_into_chunks (run with: python -m pytest test_packing.py).
+No server or API keys needed.
+"""
+
+import pytest
+
+from backend import CHARS_PER_TOKEN, RepoFile, extract_outline, pack_context, rank_files, split_into_chunks
+
+
+def module(name, functions=5):
+    body = "".join(f"def {name}_{i}(arg, *, flag=False):\n    return arg * {i}\n\n" for i in range(functions))
+    return f"import os\n\n{body}"
+
+
+def repo(count=30):
+    files = [RepoFile("main.py", "from app import core\n\ndef main():\n    core.run()\n")]
+    files += [RepoFile(f"app/mod{i}.py", module(f"mod{i}")) for i in range(count)]
+    files += [RepoFile("tests/test_core.py", module("test_core"))]
+    return files
+
+
+def test_python_outline_keeps_signatures_not_bodies():
+    signatures, imports = extract_outline("app/core.py", "import os\nfrom app import db\n\n"
+                                                         "class Core(Base):\n    def run(self, n=1):\n"
+                                                         "        return n\n\nasync def serve(port):\n    pass\n")
+    assert signatures == ["class Core(Base)", "    def run(self, n=1)", "async def serve(port)"]
+    assert imports == ["os", "app", "app.db"]
+
+
+def test_regex_outline_for_other_languages():
+    signatures, imports = extract_outline("web/app.js", "import api from './api'\n\n"
+                                                        "export async function load(id) {\n  return api.get(id)\n}\n")
+    assert signatures == ["export async function load(id)"]
+    assert imports == ["./api"]
+
+
+def test_entry_points_rank_first_and_tests_last():
+    ranked = [outline.path for outline, _ in rank_files(repo(5))]
+    assert ranked[0] == "main.py"
+    assert ranked[-1] == "tests/test_core.py"
+
+
+@pytest.mark.parametrize("budget", [20, 100, 250, 1000])
+def test_packed_context_fits_the_budget(budget):
+    packed, stats = pack_context(repo(), token_budget=budget)
+    assert len(packed) <= int(budget * CHARS_PER_TOKEN)
+    assert stats["tokens"] <= budget
+    assert stats["token_budget"] == budget
+
+
+def test_packed_context_starts_with_overview_and_entry_point():
+    packed, stats = pack_context(repo(), token_budget=250)
+    lines = packed.split("\n")
+    assert lines[0] == "32 files (.py: 32)"
+    assert lines[1] == "# main.py"
+    assert "  def main()" in lines
+    assert "return" not in packed
+    assert 0 < stats["packed_files"] < stats["files"]
+
+
+def test_larger_budget_packs_more_files():
+    _, small = pack_context(repo(), token_budget=100)
+    _, large = pack_context(repo(), token_budget=1000)
+    assert large["packed_files"] > small["packed_files"]
+
+
+def test_chunks_fit_the_budget_and_are_capped():
+    chunks = split_into_chunks(repo(), token_budget=100, max_chunks=4)
+    assert 1 < len(chunks) <= 4
+    assert all(len(chunk) <= int(100 * CHARS_PER_TOKEN) for chunk in chunks)
+
+
+def test_chunks_are_in_path_order():
+    # Editing one file only changes the chunk that contains it
+    chunks = split_into_chunks(repo(3), token_budget=1000, max_chunks=4)
+    paths = [line[2:] for chunk in chunks for line in chunk.split("\n") if line.startswith("# ")]
+    assert paths == sorted(paths)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Unit tests for latency-budget routing with plan_route (run with:
+python -m pytest test_routing.py). The upstreams are fresh Upstream objects
+with known latency estimates and the clients are placeholders, so no server
+or API keys are needed.
+"""
+
+import time
+
+import pytest
+
+import backend
+from backend import Upstream, plan_route, request_deadline
+
+
+@pytest.fixture
+def upstreams(monkeypatch):
+    """Trainium estimated at 2s per call and Gemini at 1s, both configured."""
+    trainium = Upstream("trainium-test", 10, retries=0, failure_threshold=1, reset_timeout=60, prior=2.0)
+    gemini = Upstream("gemini-test", 10, retries=0, failure_threshold=1, reset_timeout=60, prior=1.0)
+    monkeypatch.setattr(backend, "trainium_upstream", trainium)
+    monkeypatch.setattr(backend, "gemini_upstream", gemini)
+    monkeypatch.setattr(backend, "sagemaker_client", object())
+    monkeypatch.setattr(backend, "model", object())
+    return trainium, gemini
+
+
+def within(seconds):
+    return time.monotonic() + seconds
+
+
+def open_circuit(upstream):
+    with pytest.raises(ConnectionError):
+        upstream.call(lambda: (_ for _ in ()).throw(ConnectionError("down")))
+    assert upstream.state == "open"
+
+
+def test_no_deadline_takes_the_full_chain(upstreams):
+    route = plan_route(None)
+    assert route["path"] == "full" and route["reason"] == "no deadline"
+    assert route["estimates_ms"] == {"full": 3000, "direct": 1000}
+    assert route["remaining_ms"] is None
+
+
+def test_full_chain_when_it_fits(upstreams):
+    assert plan_route(within(5))["path"] == "full"
+
+
+def test_direct_when_only_gemini_fits(upstreams):
+    route = plan_route(within(2))
+    assert route["path"] == "direct"
+    assert route["reason"] == "full chain would miss the deadline"
+
+
+def test_static_or_cached_when_nothing_fits(upstreams):
+    assert plan_route(within(0.5))["path"] == "static"
+    route = plan_route(within(0.5), has_stored=True)
+    assert route["path"] == "cached" and route["reason"] == "no model path fits the deadline"
+
+
+def test_trainium_rounds_add_up(upstreams):
+    # Chunked analysis: 3 sequential Trainium calls (6s) plus Gemini
+    assert plan_route(within(5), rounds=3)["path"] == "direct"
+    assert plan_route(within(8), rounds=3)["path"] == "full"
+
+
+def test_open_circuit_is_routed_around(upstreams):
+    trainium, gemini = upstreams
+    open_circuit(trainium)
+    route = plan_route(None)
+    assert route["path"] == "direct" and route["reason"] == "Trainium unavailable"
+    open_circuit(gemini)
+    assert plan_route(None, has_stored=True)["path"] == "cached"
+
+
+def test_unconfigured_models_are_not_routed_to(upstreams, monkeypatch):
+    monkeypatch.setattr(backend, "model", None)
+    monkeypatch.setattr(backend, "GEMINI_API_KEY", None)
+    route = plan_route(None)
+    assert route["path"] == "static" and route["reason"] == "models unavailable"
+
+
+def test_measured_latency_replaces_the_prior(upstreams):
+    _, gemini = upstreams
+    gemini.call(lambda: None)
+    # A fast measured Gemini call now fits a budget its 1s prior did not
+    assert plan_route(within(0.5))["path"] == "direct"
+
+
+def test_request_deadline():
+    assert request_deadline(0) is None
+    assert request_deadline(None) is None
+    assert 0.9 < request_deadline(1000) - time.monotonic() <= 1.0
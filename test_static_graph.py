@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the static import graph: build_dependency_graph,
+collapse_graph and static_analysis (run with: python -m pytest test_static_graph.py).
+No server or API keys needed.
+"""
+
+from backend import RepoFile, build_dependency_graph, collapse_graph, repair_mermaid, static_analysis
+
+
+def repo(files):
+    return [RepoFile(path, text) for path, text in files.items()]
+
+
+def test_python_absolute_and_relative_imports():
+    paths, edges = build_dependency_graph(repo({
+        "app/main.py": "from app import routes\nfrom .services import billing\n",
+        "app/routes.py": "import json\nfrom app.models import user\n",
+        "app/services/billing.py": "from ..models import user\n",
+        "app/models/user.py": "import os\n",
+    }))
+    assert sorted(paths) == ["app/main.py", "app/models/user.py", "app/routes.py", "app/services/billing.py"]
+    assert edges == [
+        ("app/main.py", "app/routes.py"),
+        ("app/main.py", "app/services/billing.py"),
+        ("app/routes.py", "app/models/user.py"),
+        ("app/services/billing.py", "app/models/user.py"),
+    ]
+
+
+def test_stdlib_name_inside_a_package_is_not_matched():
+    # `import json` must not resolve to flask/json.py inside the flask package
+    _, edges = build_dependency_graph(repo({
+        "flask/__init__.py": "VALUE = 1\n",
+        "flask/json.py": "VALUE = 1\n",
+        "flask/app.py": "import json\n",
+    }))
+    assert edges == []
+
+
+def test_source_root_imports_resolve():
+    _, edges = build_dependency_graph(repo({
+        "main.py": "from utils import helpers\n",
+        "src/utils/helpers.py": "VALUE = 1\n",
+    }))
+    assert edges == [("main.py", "src/utils/helpers.py")]
+
+
+def test_ambiguous_targets_are_left_out():
+    _, edges = build_dependency_graph(repo({
+        "main.py": "import config\n",
+        "a/config.py": "VALUE = 1\n",
+        "b/config.py": "VALUE = 1\n",
+    }))
+    assert edges == []
+
+
+def test_javascript_relative_and_index_imports():
+    _, edges = build_dependency_graph(repo({
+        "web/app.js": "import api from './api'\nimport { Button } from './components'\n",
+        "web/api.js": "export function get() {}\n",
+        "web/components/index.js": "export const Button = 1\n",
+    }))
+    assert edges == [("web/app.js", "web/api.js"), ("web/app.js", "web/components/index.js")]
+
+
+def test_collapse_keeps_files_when_they_fit():
+    paths = ["a/x.py", "a/y.py", "b/z.py"]
+    groups, group_edges, omitted = collapse_graph(paths, [("a/x.py", "b/z.py")], max_nodes=5)
+    assert sorted(groups) == paths
+    assert group_edges == [("a/x.py", "b/z.py")]
+    assert omitted == 0
+
+
+def test_collapse_merges_into_folders():
+    paths = [f"{folder}/m{i}.py" for folder in ("api", "core", "db") for i in range(4)]
+    edges = [("api/m0.py", "core/m1.py"), ("core/m2.py", "db/m3.py"), ("api/m1.py", "api/m2.py")]
+    groups, group_edges, omitted = collapse_graph(paths, edges, max_nodes=3)
+    assert sorted(groups) == ["api", "core", "db"]
+    assert len(groups["api"]) == 4
+    # Edges inside a group disappear
+    assert group_edges == [("api", "core"), ("core", "db")]
+    assert omitted == 0
+
+
+def test_collapse_keeps_best_connected_groups():
+    paths = ["main.py"] + [f"pkg{i}/mod.py" for i in range(6)]
+    edges = [("main.py", "pkg0/mod.py"), ("main.py", "pkg1/mod.py"), ("pkg1/mod.py", "pkg0/mod.py")]
+    groups, group_edges, omitted = collapse_graph(paths, edges, max_nodes=3)
+    assert set(groups) == {"main.py", "pkg0", "pkg1"}
+    assert omitted == 4
+    assert all(a in groups and b in groups for a, b in group_edges)
+
+
+def test_static_analysis_diagram_is_valid():
+    explanation, mermaid, stats = static_analysis(repo({
+        "main.py": "from services import users\n",
+        "services/users.py": "from db import models\n",
+        "db/models.py": "VALUE = 1\n",
+    }), max_nodes=10)
+    _, _, errors = repair_mermaid(mermaid)
+    assert errors == []
+    assert mermaid.startswith("graph TB")
+    assert "-->" in mermaid
+    assert stats["files"] == 3 and stats["file_edges"] == 2
+    assert "Entry points: main.py" in explanation
+
+
+def test_go_imports_resolve_by_module_path():
+    _, edges = build_dependency_graph(repo({
+        "cmd/server/main.go": 'package main\n\nimport (\n\t"fmt"\n\n\t"github.com/acme/svc/internal/store"\n'
+                              '\tapi "github.com/acme/svc/pkg/api"\n)\n',
+        "internal/store/store.go": 'package store\n\nimport "github.com/acme/svc/pkg/api/types"\n',
+        "internal/store/cache.go": "package store\n",
+        "pkg/api/api.go": "package api\n",
+        "pkg/api/types/types.go": "package types\n",
+    }))
+    assert edges == [
+        ("cmd/server/main.go", "internal/store/cache.go"),
+        ("cmd/server/main.go", "internal/store/store.go"),
+        ("cmd/server/main.go", "pkg/api/api.go"),
+        ("internal/store/store.go", "pkg/api/types/types.go"),
+    ]
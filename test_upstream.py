@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the Upstream call policy: retries, deadlines, hedging, the
+circuit breaker and the latency estimate (run with: python -m pytest test_upstream.py).
+No server or API keys needed.
+"""
+
+import threading
+import time
+
+import pytest
+
+from backend import CircuitOpenError, Upstream, UpstreamTimeout
+
+
+class Flaky:
+    """Callable that raises the queued errors in turn, then returns 'ok'."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def upstream(**kwargs):
+    kwargs.setdefault("timeout", 1.0)
+    kwargs.setdefault("backoff", 0)
+    return Upstream("test", **kwargs)
+
+
+def test_retries_retryable_errors():
+    u = upstream(retries=2)
+    fn = Flaky(ConnectionError("reset"), TimeoutError("slow"))
+    assert u.call(fn) == "ok"
+    assert fn.calls == 3
+    assert u.stats()["retries"] == 2 and u.state == "closed"
+
+
+def test_gives_up_after_the_last_retry():
+    u = upstream(retries=1)
+    fn = Flaky(*[ConnectionError("reset")] * 3)
+    with pytest.raises(ConnectionError):
+        u.call(fn)
+    assert fn.calls == 2
+    assert u.stats()["failures"] == 1
+
+
+def test_client_errors_are_not_retried():
+    u = upstream(retries=2, failure_threshold=1)
+    fn = Flaky(ValueError("bad request"))
+    with pytest.raises(ValueError):
+        u.call(fn)
+    assert fn.calls == 1
+    # A bad request says nothing about the upstream's health
+    assert u.state == "closed"
+
+
+def test_attempt_timeout():
+    u = upstream(timeout=0.05, retries=0)
+    start = time.monotonic()
+    with pytest.raises(UpstreamTimeout):
+        u.call(time.sleep, 0.5)
+    assert time.monotonic() - start < 0.4
+    assert u.stats()["timeouts"] == 1
+
+
+def test_deadline_already_passed():
+    u = upstream()
+    fn = Flaky()
+    with pytest.raises(UpstreamTimeout):
+        u.call(fn, deadline=time.monotonic() - 1)
+    assert fn.calls == 0
+
+
+def test_circuit_opens_then_recovers():
+    u = upstream(retries=0, failure_threshold=2, reset_timeout=0.1)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            u.call(Flaky(ConnectionError("down")))
+    assert u.state == "open"
+    fn = Flaky()
+    with pytest.raises(CircuitOpenError):
+        u.call(fn)
+    assert fn.calls == 0 and u.stats()["short_circuited"] == 1
+
+    time.sleep(0.15)
+    assert u.state == "half_open"
+    assert u.call(fn) == "ok"
+    assert u.state == "closed"
+
+
+def test_failed_trial_reopens_the_circuit():
+    u = upstream(retries=0, failure_threshold=1, reset_timeout=0.1)
+    with pytest.raises(ConnectionError):
+        u.call(Flaky(ConnectionError("down")))
+    time.sleep(0.15)
+    with pytest.raises(ConnectionError):
+        u.call(Flaky(ConnectionError("still down")))
+    assert u.state == "open"
+    assert u.stats()["circuit_opened"] == 2
+
+
+def test_hedged_call_takes_the_first_answer():
+    calls = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            calls.append(None)
+            first = len(calls) == 1
+        time.sleep(0.5 if first else 0.01)
+        return "slow" if first else "fast"
+
+    u = upstream(hedge_after=0.05)
+    start = time.monotonic()
+    assert u.call(fn) == "fast"
+    assert time.monotonic() - start < 0.3
+    assert u.stats()["hedges"] == 1
+
+
+def test_retry_response():
+    responses = iter([429, 429, 200])
+    u = upstream(retries=3, retry_response=lambda status: 0.01 if status == 429 else None)
+    assert u.call(lambda: next(responses)) == 200
+    assert u.stats()["retries"] == 2
+
+
+def test_retry_response_returns_the_last_response_when_retries_run_out():
+    u = upstream(retries=1, retry_response=lambda status: 0.01)
+    assert u.call(lambda: 503) == 503
+    assert u.stats()["failures"] == 1
+
+
+def test_latency_estimate():
+    u = upstream(prior=5.0)
+    assert u.estimate() == 5.0
+    u.call(time.sleep, 0.05)
+    assert 0.05 <= u.estimate() < 1.0
+    assert u.stats()["estimate_ms"] == round(1000 * u.estimate(), 1)
+
+
+def test_cut_short_call_does_not_open_the_circuit():
+    u = upstream(timeout=5.0, failure_threshold=1, prior=0.01)
+    with pytest.raises(UpstreamTimeout):
+        u.call(time.sleep, 0.5, deadline=time.monotonic() + 0.1)
+    assert u.state == "closed" and u.stats()["failures"] == 0
+    # ...but the estimate learns the call takes at least that long
+    assert u.estimate() >= 0.1